@@ -1,8 +1,8 @@
 from django.contrib import admin
-from dpn_registry.models import Node, RegistryEntry, NodeEntry
+from dpn_registry.models import Node, RegistryEntry, NodeEntry, RegistrySyncReply, RegistryStats
 
 class NodeAdmin(admin.ModelAdmin):
-    pass
+    list_display = ('name', 'last_sync_date')
 admin.site.register(Node, NodeAdmin)
 
 class RegistryEntryAdmin(admin.ModelAdmin):
@@ -15,3 +15,12 @@ class NodeEntryAdmin(admin.ModelAdmin):
     list_display = ('dpn_object_id', 'first_node_name', 'node', 'bag_size', 'last_modified_date')
     list_filter = ('first_node_name', 'node')
 admin.site.register(NodeEntry, NodeEntryAdmin)
+
+class RegistrySyncReplyAdmin(admin.ModelAdmin):
+    list_display = ('correlation_id', 'node', 'parts', 'parts_total', 'entries', 'synced_until', 'reconciled', 'updated_at')
+    list_filter = ('node',)
+admin.site.register(RegistrySyncReply, RegistrySyncReplyAdmin)
+
+class RegistryStatsAdmin(admin.ModelAdmin):
+    list_display = ('scope', 'count', 'total_size', 'max_size', 'updated_at')
+admin.site.register(RegistryStats, RegistryStatsAdmin)
@@ -0,0 +1,220 @@
+"""
+    A journey of a thousand miles begins with a single step.
+
+            - Lao Tzu
+
+"""
+
+# Read only JSON views of the registry and the workflows for the tooling.
+# Pages are selected by keyset: the cursor holds the ordering values of the
+# last row sent and the next page starts after it with an indexed range
+# scan, a deep page costs as much as the first one. There are no offsets
+# and no counts.
+
+import json
+import base64
+import binascii
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from dpnode.exceptions import DPNDataError
+from dpn_workflows.models import Workflow
+from .models import RegistryEntry, NodeEntry
+
+REGISTRY_PREFETCH = ['replicating_nodes', 'brightening_objects',
+                     'rights_objects']
+
+
+def _date(value):
+    try:
+        date = parse_datetime(value)
+    except ValueError:  # well formed but not a valid date
+        date = None
+    if date is None:
+        raise DPNDataError("Invalid date %s" % value)
+    if timezone.is_naive(date):
+        date = timezone.make_aware(date, timezone.utc)
+    return date
+
+
+def _text(value):
+    return value
+
+
+class KeysetQuery(object):
+    """
+    A filtered queryset read in pages ordered by (date field, primary key),
+    or by primary key only when there is no date field.
+
+    Subclasses set the model, the date field of the ordering, the filters
+    accepted as a dict of parameter name to a (lookup, parser) tuple and
+    the serialization of a row.
+    """
+    model = None
+    date_field = None
+    filters = {}
+    prefetch = ()
+
+    def __init__(self, params):
+        """
+        :param params: dict like of the query parameters, the unknown ones
+            are ignored
+        :raises DPNDataError: if a filter value or the cursor is invalid
+        """
+        self.queryset = self.model.objects.all()
+        for name, (lookup, parse) in self.filters.items():
+            value = params.get(name)
+            if value:
+                self.queryset = self.queryset.filter(**{lookup: parse(value)})
+        self.cursor = self.decode_cursor(params.get('cursor'))
+
+    def key(self, obj):
+        if self.date_field:
+            return [getattr(obj, self.date_field), obj.pk]
+        return [obj.pk]
+
+    def decode_cursor(self, cursor):
+        if not cursor:
+            return None
+        try:
+            key = json.loads(base64.urlsafe_b64decode(
+                str(cursor)).decode('utf-8'))
+            if len(key) != (2 if self.date_field else 1):
+                raise ValueError(key)
+            if self.date_field:
+                key[0] = _date(key[0])
+            return key
+        except (TypeError, ValueError, IndexError, binascii.Error):
+            raise DPNDataError("Invalid cursor %s" % cursor)
+
+    def encode_cursor(self, obj):
+        key = [v.isoformat() if hasattr(v, 'isoformat') else v
+               for v in self.key(obj)]
+        return base64.urlsafe_b64encode(
+            json.dumps(key).encode('utf-8')).decode('ascii')
+
+    def after(self, key):
+        """
+        Returns the rows after a cursor key in the order of the pages.
+        """
+        if not self.date_field:
+            queryset = self.queryset.order_by('pk')
+            return queryset if key is None else queryset.filter(pk__gt=key[0])
+        queryset = self.queryset.order_by(self.date_field, 'pk')
+        if key is None:
+            return queryset
+        date, pk = key
+        # the >= bound alone lets the database seek in the index, the
+        # OR only discards the rows of the same date already sent
+        return queryset.filter(**{'%s__gte' % self.date_field: date}).filter(
+            Q(**{'%s__gt' % self.date_field: date}) | Q(pk__gt=pk))
+
+    def page(self, limit):
+        """
+        Returns the rows of a page and the cursor of the next one, None
+        on the last page.
+
+        :param limit: Integer max number of rows
+        :return: tuple of (list of dicts, String cursor or None)
+        """
+        # one row more tells if there is a next page
+        rows = list(self.after(self.cursor).prefetch_related(
+            *self.prefetch)[:limit + 1])
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = self.encode_cursor(rows[-1])
+        return [self.as_dict(obj) for obj in rows], next_cursor
+
+    def stream(self, chunk_size):
+        """
+        Yields every row from the cursor on, reading chunk_size rows per
+        query.
+        """
+        key = self.cursor
+        while True:
+            rows = list(self.after(key).prefetch_related(
+                *self.prefetch)[:chunk_size])
+            for obj in rows:
+                yield self.as_dict(obj)
+            if len(rows) < chunk_size:
+                return
+            key = self.key(rows[-1])
+
+    def as_dict(self, obj):
+        raise NotImplementedError
+
+
+REGISTRY_FILTERS = {
+    'first_node_name': ('first_node_name', _text),
+    'replicating_node': ('replicating_nodes__name', _text),
+    'state': ('state', _text),
+    'object_type': ('object_type', _text),
+    'modified_after': ('last_modified_date__gte', _date),
+    'modified_before': ('last_modified_date__lt', _date),
+}
+
+
+class RegistryEntryQuery(KeysetQuery):
+    model = RegistryEntry
+    date_field = 'last_modified_date'
+    filters = REGISTRY_FILTERS
+    prefetch = REGISTRY_PREFETCH
+
+    def as_dict(self, entry):
+        return dict(entry.to_message_dict(), state=entry.state)
+
+
+class NodeEntryQuery(KeysetQuery):
+    model = NodeEntry
+    date_field = 'last_modified_date'
+    filters = dict(REGISTRY_FILTERS, node=('node_id', _text))
+    prefetch = REGISTRY_PREFETCH
+
+    def as_dict(self, entry):
+        return dict(entry.to_message_dict(), state=entry.state,
+                    node=entry.node_id)
+
+
+class WorkflowQuery(KeysetQuery):
+    # created_at is empty on old workflows, the id follows it anyway
+    model = Workflow
+    filters = {
+        'dpn_object_id': ('dpn_object_id', _text),
+        'correlation_id': ('correlation_id', _text),
+        'node': ('node', _text),
+        'action': ('action', _text),
+        'step': ('step', _text),
+        'state': ('state', _text),
+        'created_after': ('created_at__gte', _date),
+        'created_before': ('created_at__lt', _date),
+    }
+    fields = ['id', 'correlation_id', 'dpn_object_id', 'node', 'action',
+              'step', 'state', 'note', 'protocol', 'location',
+              'bytes_transferred', 'transfer_elapsed', 'throughput',
+              'hash_elapsed', 'staging_method', 'created_at']
+
+    def as_dict(self, action):
+        data = dict((f, getattr(action, f)) for f in self.fields)
+        if action.created_at:
+            data['created_at'] = action.created_at.isoformat()
+        return data
+
+
+def page_size(params):
+    """
+    Returns the number of rows asked for, DPN_API_PAGE_SIZE by default and
+    never more than DPN_API_MAX_PAGE_SIZE.
+    """
+    default = getattr(settings, 'DPN_API_PAGE_SIZE', 100)
+    largest = getattr(settings, 'DPN_API_MAX_PAGE_SIZE', 1000)
+    try:
+        limit = int(params.get('limit') or default)
+    except ValueError:
+        raise DPNDataError("Invalid limit %s" % params.get('limit'))
+    if limit < 1:
+        raise DPNDataError("Invalid limit %s" % limit)
+    return min(limit, largest)
@@ -2,7 +2,10 @@
 Forms used for data updates and as a wrapper to validate or process data as
 """
 
+from datetime import datetime
+
 from django import forms
+from django.forms.utils import from_current_timezone
 
 from dpnode.exceptions import DPNDataError
 from dpnode.settings import DPN_DATE_FORMAT, DPN_NODE_LIST
@@ -97,4 +100,100 @@ class NodeEntryForm(BaseEntryForm, forms.ModelForm):
         model = NodeEntry
         exclude = [
             'state'
-        ]
\ No newline at end of file
+        ]
+
+def _clean_date(value):
+    # same timezone handling as forms.DateTimeField
+    return from_current_timezone(datetime.strptime(value, DPN_DATE_FORMAT))
+
+
+def _clean_string(max_length, required=True):
+    def clean(value):
+        if value in (None, 'null', ''):
+            if required:
+                raise ValueError("a value is required")
+            return None
+        value = str(value)
+        if len(value) > max_length:
+            raise ValueError("longer than %d characters" % max_length)
+        return value
+    return clean
+
+
+def _clean_positive_int(value):
+    number = int(value)
+    if isinstance(value, (bool, float)) or number < 0:
+        raise ValueError("%r is not a positive integer" % value)
+    return number
+
+
+def _clean_object_type(value):
+    code = _lookup_object_code(value)
+    if code is None:
+        raise ValueError("%r is not a valid object type" % value)
+    return code
+
+
+def _clean_id_list(value):
+    if value in (None, 'null'):
+        return []
+    if not isinstance(value, list):
+        raise ValueError("%r is not a list" % value)
+    return [str(v) for v in value]
+
+
+def _clean_node_names(value):
+    names = _clean_id_list(value)
+    for name in names:
+        if name not in DPN_NODE_LIST:
+            raise ValueError("%s is not a valid node name." % name)
+    return names
+
+
+# Lightweight validation of registry entries of DPN messages, used to
+# load entries in bulk instead of building a ModelForm per entry.
+# message key -> (model field, clean function)
+ENTRY_SCHEMA = {
+    'dpn_object_id': ('dpn_object_id', _clean_string(64)),
+    'local_id': ('local_id', _clean_string(100, required=False)),
+    'first_node_name': ('first_node_name', _clean_string(20)),
+    'version_number': ('version_number', _clean_positive_int),
+    'fixity_algorithm': ('fixity_algorithm', _clean_string(10)),
+    'fixity_value': ('fixity_value', _clean_string(128)),
+    'last_fixity_date': ('last_fixity_date', _clean_date),
+    'creation_date': ('creation_date', _clean_date),
+    'last_modified_date': ('last_modified_date', _clean_date),
+    'bag_size': ('bag_size', _clean_positive_int),
+    'object_type': ('object_type', _clean_object_type),
+    'previous_version_object_id': (
+        'previous_version', _clean_string(64, required=False)),
+    'forward_version_object_id': (
+        'forward_version', _clean_string(64, required=False)),
+    'first_version_object_id': (
+        'first_version', _clean_string(64, required=False)),
+}
+ENTRY_M2M_SCHEMA = {
+    'replicating_node_names': ('replicating_nodes', _clean_node_names),
+    'brightening_object_id': ('brightening_objects', _clean_id_list),
+    'rights_object_id': ('rights_objects', _clean_id_list),
+}
+
+
+def clean_entry_dict(data):
+    """
+    Validates a registry entry of a DPN message.
+
+    :param data: dict of the registry entry as sent in DPN messages
+    :return: tuple of (dict of model fields, dict of M2M field -> list of
+        node names or dpn object ids)
+    :raises DPNDataError: if the entry is not valid
+    """
+    fields, m2m = {}, {}
+    for schema, values in [(ENTRY_SCHEMA, fields), (ENTRY_M2M_SCHEMA, m2m)]:
+        for key, (name, clean) in schema.items():
+            try:
+                values[name] = clean(data.get(key))
+            except (ValueError, TypeError) as err:
+                raise DPNDataError("Invalid %s in entry %s: %s"
+                                   % (key, data.get('dpn_object_id'), err))
+    return fields, m2m
@@ -3,11 +3,13 @@ from uuid import uuid4
 from optparse import make_option
 from datetime import datetime
 from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
 
 from dpnode.settings import DPN_TTL, DPN_MSG_TTL
 from dpnode.settings import DPN_BROADCAST_KEY, DPN_DATE_FORMAT
 
 from dpn_workflows.tasks.registry import solve_registry_conflicts
+from dpn_registry.utils import incremental_sync_start
 
 from dpnmq.messages import RegistryDateRangeSync
 from dpnmq.utils import dpn_strptime, dpn_strftime
@@ -17,24 +19,36 @@ class Command(BaseCommand):
     
     option_list = BaseCommand.option_list + (
         make_option('--startdate',
-                    help='Starting datetime to sync registry',
-                    default=dpn_strftime(datetime.utcnow())),
+                    help='Starting datetime to sync registry'),
         make_option('--enddate', 
-                    help='End datetime to sync registry',
-                    default=dpn_strftime(datetime.utcnow()))
+                    help='End datetime to sync registry'),
+        make_option('--incremental',
+                    action='store_true',
+                    default=False,
+                    help='Sync the entries modified since the last '
+                         'reconciled sync of the nodes')
     )
 
     def validate_date(self, datestring):
         try:
             return dpn_strptime(datestring)
         except ValueError:
-            raise ValueError("Incorrect date format, should be '%s' (i.e. %s)" % DPN_DATE_FORMAT,
-                     dpn_strftime(datetime.utcnow()))
+            raise CommandError("Incorrect date format, should be '%s' (i.e. %s)" % (
+                DPN_DATE_FORMAT, dpn_strftime(datetime.utcnow())))
 
     def handle(self, *args, **options):
 
-        start_datetime = self.validate_date(options['startdate'])
-        end_datetime = self.validate_date(options['enddate'])
+        now = datetime.utcnow()
+
+        if options['incremental']:
+            if options['startdate']:
+                raise CommandError("--incremental can't be used with --startdate")
+            start_datetime = timezone.make_naive(incremental_sync_start(),
+                                                 timezone.utc)
+        else:
+            start_datetime = self.validate_date(
+                options['startdate'] or dpn_strftime(now))
+        end_datetime = self.validate_date(options['enddate'] or dpn_strftime(now))
 
         if start_datetime > end_datetime:
             raise CommandError("Start date must be prior to End Date")
@@ -52,4 +66,4 @@ class Command(BaseCommand):
         reg_sync.send(DPN_BROADCAST_KEY)
 
         delay = DPN_MSG_TTL.get("registry-daterange-sync-request", DPN_TTL)
-        solve_registry_conflicts.apply_async(countdown=delay)
\ No newline at end of file
+        solve_registry_conflicts.apply_async(countdown=delay)
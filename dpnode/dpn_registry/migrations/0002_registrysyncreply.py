@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dpn_registry', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RegistrySyncReply',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('correlation_id', models.CharField(max_length=100)),
+                ('parts', models.TextField(blank=True, default='', help_text='Comma separated parts received.')),
+                ('parts_total', models.PositiveIntegerField(blank=True, null=True, help_text='Number of parts, known once the last one arrives.')),
+                ('entries', models.PositiveIntegerField(default=0, help_text='Entries received.')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('node', models.ForeignKey(related_name='sync_replies', to='dpn_registry.Node')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='registrysyncreply',
+            unique_together=set([('correlation_id', 'node')]),
+        ),
+    ]
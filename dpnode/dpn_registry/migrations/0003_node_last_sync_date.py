@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dpn_registry', '0002_registrysyncreply'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='node',
+            name='last_sync_date',
+            field=models.DateTimeField(blank=True, null=True, help_text='Entries modified up to this date are reconciled.'),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='registrysyncreply',
+            name='reconciled',
+            field=models.BooleanField(default=False),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='registrysyncreply',
+            name='synced_until',
+            field=models.DateTimeField(blank=True, null=True, help_text='End of the date range of the list.'),
+            preserve_default=True,
+        ),
+    ]
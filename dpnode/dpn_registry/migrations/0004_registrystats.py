@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import Sum, Max, Count
+
+
+def compute_stats(apps, schema_editor):
+    # the signals only count the entries saved from now on
+    RegistryEntry = apps.get_model('dpn_registry', 'RegistryEntry')
+    Node = apps.get_model('dpn_registry', 'Node')
+    RegistryStats = apps.get_model('dpn_registry', 'RegistryStats')
+    entries = RegistryEntry.objects.all()
+    totals = entries.aggregate(Count('pk'), Sum('bag_size'), Max('bag_size'))
+    rows = [RegistryStats(scope='total', count=totals['pk__count'],
+                          total_size=totals['bag_size__sum'] or 0,
+                          max_size=totals['bag_size__max'] or 0)]
+    for node in entries.values('first_node_name').annotate(
+            Count('pk'), Sum('bag_size'), Max('bag_size')):
+        rows.append(RegistryStats(scope='first:%s' % node['first_node_name'],
+                                  count=node['pk__count'],
+                                  total_size=node['bag_size__sum'],
+                                  max_size=node['bag_size__max']))
+    for node in Node.objects.annotate(
+            Count('registryentry'), Sum('registryentry__bag_size'),
+            Max('registryentry__bag_size')):
+        rows.append(RegistryStats(
+            scope='node:%s' % node.name, count=node.registryentry__count,
+            total_size=node.registryentry__bag_size__sum or 0,
+            max_size=node.registryentry__bag_size__max or 0))
+    RegistryStats.objects.bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dpn_registry', '0003_node_last_sync_date'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RegistryStats',
+            fields=[
+                ('scope', models.CharField(primary_key=True, max_length=30, serialize=False, help_text="'total', 'first:<node>' or 'node:<node>'.")),
+                ('count', models.BigIntegerField(default=0)),
+                ('total_size', models.BigIntegerField(default=0)),
+                ('max_size', models.BigIntegerField(default=0, help_text='Only grows between recomputes.')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'registry stats',
+            },
+            bases=(models.Model,),
+        ),
+        migrations.RunPython(compute_stats),
+    ]
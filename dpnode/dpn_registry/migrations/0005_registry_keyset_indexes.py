@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dpn_registry', '0004_registrystats'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='nodeentry',
+            index_together=set([('last_modified_date', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='registryentry',
+            index_together=set([('last_modified_date', 'dpn_object_id')]),
+        ),
+    ]
@@ -5,7 +5,12 @@
 
 """
 
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import F
+from django.db.models.signals import (
+    pre_save, post_save, pre_delete, post_delete, m2m_changed
+)
+from django.dispatch import receiver
 
 from dpnmq.utils import serialize_dict_date
 from dpn_workflows.utils import ModelToDict
@@ -47,6 +52,8 @@ class Node(models.Model):
     Related model field to keep information about what is replicated where.
     """
     name = models.CharField(max_length=20, primary_key=True)
+    last_sync_date = models.DateTimeField(null=True, blank=True,
+        help_text="Entries modified up to this date are reconciled.")
 
     def __unicode__(self):
         return '%s' % self.name
@@ -128,6 +135,10 @@ class RegistryEntry(BaseRegistry):
     """
     dpn_object_id = models.CharField(max_length=64, primary_key=True)
 
+    class Meta(BaseRegistry.Meta):
+        # keyset pages of the JSON API and registry syncs by date range
+        index_together = [('last_modified_date', 'dpn_object_id')]
+
 
 class NodeEntry(BaseRegistry):
     """
@@ -141,9 +152,214 @@ class NodeEntry(BaseRegistry):
     class Meta:
         verbose_name_plural = "node entries"
         unique_together = ("node", "dpn_object_id")
+        index_together = [('last_modified_date', 'id')]
     
     def __unicode__(self):
         return '%s' % self.dpn_object_id
 
     def __str__(self):
         return '%s' % self.__unicode__()
+
+
+class RegistrySyncReply(models.Model):
+    """
+    Tracks the parts of a registry list received from a node during a
+    registry sync, long lists are sent in several messages.
+    """
+    correlation_id = models.CharField(max_length=100)
+    node = models.ForeignKey(Node, related_name='sync_replies')
+    parts = models.TextField(blank=True, default='',
+                             help_text="Comma separated parts received.")
+    parts_total = models.PositiveIntegerField(null=True, blank=True,
+        help_text="Number of parts, known once the last one arrives.")
+    entries = models.PositiveIntegerField(default=0,
+                                          help_text="Entries received.")
+    synced_until = models.DateTimeField(null=True, blank=True,
+        help_text="End of the date range of the list.")
+    reconciled = models.BooleanField(default=False)
+
+    # Timestamps
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("correlation_id", "node")
+
+    def __unicode__(self):
+        return '%s from %s' % (self.correlation_id, self.node_id)
+
+    def __str__(self):
+        return '%s' % self.__unicode__()
+
+    def received_parts(self):
+        return set(int(p) for p in self.parts.split(',') if p)
+
+    def add_part(self, part, last_part, entries):
+        """
+        Records a received part, parts delivered twice are not counted again.
+
+        :param part: Integer of the part number starting with 1
+        :param last_part: Boolean True if this is the last part of the list
+        :param entries: Integer of entries in the part
+        :return: Boolean False if the part was already received
+        """
+        received = self.received_parts()
+        if part in received:
+            return False
+        received.add(part)
+        self.parts = ','.join(str(p) for p in sorted(received))
+        self.entries += entries
+        if last_part:
+            self.parts_total = part
+        return True
+
+    def is_complete(self):
+        return self.parts_total is not None and \
+            self.received_parts() == set(range(1, self.parts_total + 1))
+
+
+# REGISTRY STATS SCOPES
+TOTAL_SCOPE = 'total'
+FIRST_NODE_SCOPE = 'first:%s'
+REPLICATING_NODE_SCOPE = 'node:%s'
+
+class RegistryStats(models.Model):
+    """
+    Counters of the registry entries shown in the dashboard, kept up to
+    date by the signals of RegistryEntry so they are never aggregated on
+    a page load. The rows are rebuilt by recompute_registry_stats.
+    """
+    scope = models.CharField(max_length=30, primary_key=True,
+        help_text="'total', 'first:<node>' or 'node:<node>'.")
+    count = models.BigIntegerField(default=0)
+    total_size = models.BigIntegerField(default=0)
+    max_size = models.BigIntegerField(default=0,
+        help_text="Only grows between recomputes.")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = "registry stats"
+
+    def __unicode__(self):
+        return '%s' % self.scope
+
+    def __str__(self):
+        return '%s' % self.__unicode__()
+
+    @property
+    def avg_size(self):
+        return self.total_size / float(self.count) if self.count else None
+
+    @classmethod
+    def add(cls, scope, count, size, max_size=None):
+        """
+        Adds to the counters of a scope with a single conditional update,
+        the row is created the first time.
+
+        :param scope: String of the scope
+        :param count: Integer of entries added, negative when removed
+        :param size: Integer of bytes added, negative when removed
+        :param max_size: Integer size of the largest entry added if any
+        """
+        def update():
+            updated = cls.objects.filter(scope=scope).update(
+                count=F('count') + count, total_size=F('total_size') + size)
+            if updated and max_size is not None:
+                cls.objects.filter(scope=scope, max_size__lt=max_size).update(
+                    max_size=max_size)
+            return updated
+
+        if update():
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(scope=scope, count=count, total_size=size,
+                                   max_size=max_size or 0)
+        except IntegrityError:
+            # created by another process in the meantime
+            update()
+
+
+def _replicating_names(entry_id):
+    through = RegistryEntry.replicating_nodes.through
+    return list(through.objects.filter(
+        registryentry_id=entry_id).values_list('node_id', flat=True))
+
+@receiver(pre_save, sender=RegistryEntry)
+def remember_registry_stats(sender, instance, **kwargs):
+    instance._stats_old = sender.objects.filter(
+        pk=instance.pk).values_list('first_node_name', 'bag_size').first()
+
+@receiver(post_save, sender=RegistryEntry)
+def update_registry_stats(sender, instance, **kwargs):
+    old = getattr(instance, '_stats_old', None)
+    node, size = instance.first_node_name, instance.bag_size
+    if old is None:
+        RegistryStats.add(TOTAL_SCOPE, 1, size, size)
+        RegistryStats.add(FIRST_NODE_SCOPE % node, 1, size, size)
+        return
+
+    old_node, old_size = old
+    if old_node == node and old_size == size:
+        return
+    RegistryStats.add(TOTAL_SCOPE, 0, size - old_size, size)
+    RegistryStats.add(FIRST_NODE_SCOPE % old_node, -1, -old_size)
+    RegistryStats.add(FIRST_NODE_SCOPE % node, 1, size, size)
+    if old_size != size:
+        for name in _replicating_names(instance.pk):
+            RegistryStats.add(REPLICATING_NODE_SCOPE % name, 0,
+                              size - old_size, size)
+
+@receiver(pre_delete, sender=RegistryEntry)
+def remember_replicating_nodes(sender, instance, **kwargs):
+    # the relations are gone by post_delete
+    instance._stats_nodes = _replicating_names(instance.pk)
+
+@receiver(post_delete, sender=RegistryEntry)
+def remove_registry_stats(sender, instance, **kwargs):
+    size = instance.bag_size
+    RegistryStats.add(TOTAL_SCOPE, -1, -size)
+    RegistryStats.add(FIRST_NODE_SCOPE % instance.first_node_name, -1, -size)
+    for name in getattr(instance, '_stats_nodes', []):
+        RegistryStats.add(REPLICATING_NODE_SCOPE % name, -1, -size)
+
+@receiver(m2m_changed, sender=RegistryEntry.replicating_nodes.through)
+def update_replication_stats(sender, instance, action, reverse, pk_set,
+                             **kwargs):
+    """
+    Counts the entries replicated at each node. Only the relations that
+    exist before a remove or clear are counted, post_add gets the new
+    relations only.
+    """
+    if action in ('pre_remove', 'pre_clear'):
+        pairs = sender.objects.filter(
+            **{'node_id' if reverse else 'registryentry_id': instance.pk})
+        if action == 'pre_remove':
+            pairs = pairs.filter(
+                **{'registryentry_id__in' if reverse else 'node_id__in':
+                   pk_set})
+        instance._stats_removed = list(pairs.values_list(
+            'registryentry_id', 'node_id'))
+        return
+
+    if action == 'post_add':
+        pairs = [(entry, instance.pk) if reverse else (instance.pk, entry)
+                 for entry in pk_set]
+        sign = 1
+    elif action in ('post_remove', 'post_clear'):
+        pairs = getattr(instance, '_stats_removed', [])
+        sign = -1
+    else:
+        return
+
+    sizes = dict(RegistryEntry.objects.filter(
+        pk__in=set(entry for entry, node in pairs)
+    ).values_list('pk', 'bag_size'))
+    totals = {}
+    for entry, node in pairs:
+        count, size, largest = totals.get(node, (0, 0, 0))
+        totals[node] = (count + 1, size + sizes.get(entry, 0),
+                        max(largest, sizes.get(entry, 0)))
+    for node, (count, size, largest) in totals.items():
+        RegistryStats.add(REPLICATING_NODE_SCOPE % node, sign * count,
+                          sign * size, largest if sign > 0 else None)
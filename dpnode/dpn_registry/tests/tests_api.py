@@ -0,0 +1,135 @@
+import json
+from datetime import datetime, timedelta
+
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from dpn_workflows.models import Workflow, RECEIVE, TRANSFER, SUCCESS
+from dpn_workflows.queryplans import explain, uses_index
+from ..api import RegistryEntryQuery
+from ..models import Node, RegistryEntry, NodeEntry
+
+START = datetime(2015, 1, 1, tzinfo=timezone.utc)
+
+
+def _entry(model, object_id, minutes, first_node='aptrust', **kwargs):
+    # entries two by two share the same last_modified_date
+    date = START + timedelta(minutes=minutes // 2)
+    return model.objects.create(
+        dpn_object_id=object_id, first_node_name=first_node,
+        version_number=1, fixity_algorithm='sha256', fixity_value='a' * 64,
+        last_fixity_date=date, creation_date=date, last_modified_date=date,
+        bag_size=100, **kwargs)
+
+
+class RegistryAPITest(TestCase):
+
+    def setUp(self):
+        User.objects.create_user('tooling', password='secret')
+        self.client.login(username='tooling', password='secret')
+        self.tdr = Node.objects.create(name='tdr')
+        for i in range(7):
+            entry = _entry(RegistryEntry, 'entry-%d' % i, i,
+                           first_node='tdr' if i % 3 == 0 else 'aptrust')
+            if i % 2:
+                entry.replicating_nodes.add(self.tdr)
+            _entry(NodeEntry, 'entry-%d' % i, i, node=self.tdr)
+
+    def _get(self, name, **params):
+        response = self.client.get(reverse('registry:%s' % name), params)
+        return response.status_code, json.loads(response.content.decode())
+
+    def _all_pages(self, name, **params):
+        ids, cursor = [], None
+        while True:
+            if cursor:
+                params['cursor'] = cursor
+            status, data = self._get(name, **params)
+            self.assertEqual(status, 200)
+            ids += [row['dpn_object_id'] for row in data['results']]
+            cursor = data['next']
+            if cursor is None:
+                return ids
+
+    def test_pages(self):
+        ids = self._all_pages('api-entries', limit=2)
+        self.assertEqual(ids, ['entry-%d' % i for i in range(7)])
+        self.assertEqual(self._all_pages('api-node-entries', limit=3), ids)
+
+    def test_filters(self):
+        self.assertEqual(
+            self._all_pages('api-entries', replicating_node='tdr', limit=1),
+            ['entry-1', 'entry-3', 'entry-5'])
+        self.assertEqual(
+            self._all_pages('api-entries', first_node_name='tdr'),
+            ['entry-0', 'entry-3', 'entry-6'])
+        self.assertEqual(
+            self._all_pages('api-entries',
+                            modified_after='2015-01-01T00:01:00Z',
+                            modified_before='2015-01-01T00:02:00Z'),
+            ['entry-2', 'entry-3'])
+        self.assertEqual(self._all_pages('api-node-entries', node='sdr'), [])
+
+    def test_same_queries_per_page(self):
+        first = RegistryEntryQuery({})
+        with CaptureQueriesContext(connection) as queries:
+            rows, cursor = first.page(2)
+        deep = RegistryEntryQuery({'cursor': cursor})
+        with CaptureQueriesContext(connection) as deep_queries:
+            deep.page(2)
+        self.assertEqual(len(queries), len(deep_queries))
+        self.assertEqual(rows[1]['replicating_node_names'], ['tdr'])
+
+    def test_keyset_indexed(self):
+        query = RegistryEntryQuery({})
+        rows, cursor = query.page(2)
+        plan = explain(query.after(query.decode_cursor(cursor)))
+        self.assertTrue(uses_index(plan, RegistryEntry._meta.db_table), plan)
+
+    def test_jsonl_export(self):
+        response = self.client.get(reverse('registry:api-entries'),
+                                   {'format': 'jsonl'})
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(l)['dpn_object_id'] for l in lines],
+                         ['entry-%d' % i for i in range(7)])
+
+    def test_invalid_params(self):
+        for params in ({'cursor': 'nonsense'}, {'limit': 'all'},
+                       {'modified_after': 'yesterday'}):
+            status, data = self._get('api-entries', **params)
+            self.assertEqual(status, 400)
+            self.assertIn('error', data)
+
+    def test_invalid_jsonl_params(self):
+        # checked before the stream starts, never a truncated 200
+        for params in ({'cursor': 'nonsense'},
+                       {'modified_after': 'yesterday'}):
+            params['format'] = 'jsonl'
+            status, data = self._get('api-entries', **params)
+            self.assertEqual(status, 400)
+            self.assertIn('error', data)
+
+    def test_workflows(self):
+        for i in range(5):
+            Workflow.objects.create(
+                correlation_id='corr-%d' % i, dpn_object_id='entry-%d' % i,
+                node='tdr' if i % 2 else 'sdr', action=RECEIVE,
+                step=TRANSFER, state=SUCCESS)
+        status, data = self._get('api-workflows', node='tdr', limit=1)
+        self.assertEqual(status, 200)
+        self.assertEqual([w['correlation_id'] for w in data['results']],
+                         ['corr-1'])
+        status, data = self._get('api-workflows', node='tdr',
+                                 cursor=data['next'])
+        self.assertEqual([w['correlation_id'] for w in data['results']],
+                         ['corr-3'])
+        self.assertIsNone(data['next'])
+
+    def test_login_required(self):
+        self.client.logout()
+        response = self.client.get(reverse('registry:api-entries'))
+        self.assertEqual(response.status_code, 302)
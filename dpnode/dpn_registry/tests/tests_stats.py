@@ -0,0 +1,105 @@
+from datetime import datetime
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+
+from ..models import Node, RegistryEntry, RegistryStats
+from ..utils import recompute_registry_stats, registry_stats
+
+
+def _entry(object_id, first_node='aptrust', size=100):
+    now = datetime(2015, 1, 1)
+    return RegistryEntry.objects.create(
+        dpn_object_id=object_id, first_node_name=first_node,
+        version_number=1, fixity_algorithm='sha256', fixity_value='a' * 64,
+        last_fixity_date=now, creation_date=now, last_modified_date=now,
+        bag_size=size)
+
+
+class RegistryStatsTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.tdr = Node.objects.create(name='tdr')
+        self.sdr = Node.objects.create(name='sdr')
+
+    def _stats(self):
+        return dict((row.scope, (row.count, row.total_size, row.max_size))
+                    for row in RegistryStats.objects.all())
+
+    def _recomputed(self):
+        current = self._stats()
+        recompute_registry_stats()
+        return current, self._stats()
+
+    def test_entries_counted(self):
+        _entry('one', size=100)
+        entry = _entry('two', first_node='tdr', size=300)
+        entry.bag_size = 200
+        entry.save()
+        stats = self._stats()
+        self.assertEqual(stats['total'], (2, 300, 300))
+        self.assertEqual(stats['first:aptrust'], (1, 100, 100))
+        self.assertEqual(stats['first:tdr'], (1, 200, 300))
+
+        # the largest bag is found again by the recompute
+        current, recomputed = self._recomputed()
+        self.assertEqual(recomputed['first:tdr'], (1, 200, 200))
+
+    def test_first_node_changed(self):
+        entry = _entry('one', size=100)
+        entry.first_node_name = 'tdr'
+        entry.save()
+        stats = self._stats()
+        self.assertEqual(stats['first:aptrust'][:2], (0, 0))
+        self.assertEqual(stats['first:tdr'], (1, 100, 100))
+
+    def test_replicating_nodes(self):
+        one = _entry('one', size=100)
+        two = _entry('two', size=50)
+        one.replicating_nodes.add(self.tdr, self.sdr)
+        one.replicating_nodes.add(self.tdr)  # already there
+        self.sdr.registryentry_set.add(two)
+        self.assertEqual(self._stats()['node:sdr'], (2, 150, 100))
+
+        one.bag_size = 120
+        one.save()
+        one.replicating_nodes.remove(self.sdr)
+        self.assertEqual(self._stats()['node:sdr'][:2], (1, 50))
+        self.assertEqual(self._stats()['node:tdr'][:2], (1, 120))
+
+        self.tdr.registryentry_set.clear()
+        two.delete()
+        stats = self._stats()
+        self.assertEqual(stats['node:tdr'][:2], (0, 0))
+        self.assertEqual(stats['node:sdr'][:2], (0, 0))
+        self.assertEqual(stats['total'][:2], (1, 120))
+
+        # the counters match the recompute, but for the largest bags
+        current, recomputed = self._recomputed()
+        self.assertEqual(
+            dict((scope, row[:2]) for scope, row in current.items()),
+            dict((scope, row[:2]) for scope, row in recomputed.items()))
+
+    def test_dashboard_cached(self):
+        _entry('one', size=100).replicating_nodes.add(self.tdr)
+        _entry('two', first_node='tdr', size=300)
+        stats = registry_stats()
+        self.assertEqual(stats['count'], 2)
+        self.assertEqual(stats['totals']['bag_size__avg'], 200)
+        self.assertEqual([n['first_node_name'] for n in stats['node_totals']],
+                         ['aptrust', 'tdr'])
+        self.assertEqual(stats['local_totals'], [
+            {'name': 'sdr', 'bag_count': 0, 'total_size': 0},
+            {'name': 'tdr', 'bag_count': 1, 'total_size': 100},
+        ])
+
+        _entry('three')
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(registry_stats()['count'], 2)
+        self.assertEqual(len(queries), 0)
+
+        recompute_registry_stats()
+        self.assertEqual(registry_stats()['count'], 3)
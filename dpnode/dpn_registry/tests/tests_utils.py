@@ -1,9 +1,19 @@
 import os
 import sys  
+import copy
+from datetime import datetime
 from mock import patch
+from django.db import connection
 from django.test import TestCase
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
 
-from ..utils import create_entry
+from dpnmq.tests import fixtures
+
+from ..utils import (
+    create_entry, bulk_save_node_entries, incremental_sync_start, SYNC_EPOCH
+)
+from ..models import Node, NodeEntry
 
 # NOTE: if you change the content attribute
 # the fixity string must be adjusted
@@ -59,3 +69,80 @@ class DPNRegistryUtilsTest(TestCase):
                 self.test_bag['object_id'],
                 'Object id and DPN Object ID should be the same'
             )
+
+
+class BulkSaveNodeEntriesTest(TestCase):
+
+    def setUp(self):
+        self.node = Node.objects.create(name='tdr')
+        self.entries = copy.deepcopy(fixtures.REG_SYNC_LIST)
+
+    def test_bulk_save(self):
+        saved, errors = bulk_save_node_entries(self.node, self.entries,
+                                               batch_size=3)
+        self.assertEqual(len(self.entries), saved)
+        self.assertEqual([], errors)
+
+        entry = NodeEntry.objects.get(
+            node=self.node, dpn_object_id=self.entries[1]['dpn_object_id'])
+        self.assertEqual(self.entries[1]['bag_size'], entry.bag_size)
+        self.assertEqual('D', entry.object_type)
+        self.assertEqual(
+            sorted(self.entries[1]['replicating_node_names']),
+            sorted(entry.replicating_nodes.values_list('name', flat=True)))
+
+    def test_bulk_save_upsert(self):
+        bulk_save_node_entries(self.node, self.entries)
+        self.entries[0]['bag_size'] = 1
+        self.entries[0]['replicating_node_names'] = ['tdr']
+        bulk_save_node_entries(self.node, self.entries[:1])
+
+        self.assertEqual(len(self.entries), NodeEntry.objects.count())
+        entry = NodeEntry.objects.get(
+            dpn_object_id=self.entries[0]['dpn_object_id'])
+        self.assertEqual(1, entry.bag_size)
+        self.assertEqual(['tdr'], list(
+            entry.replicating_nodes.values_list('name', flat=True)))
+
+    def test_bulk_save_invalid(self):
+        self.entries[0]['bag_size'] = "big"
+        self.entries[1]['replicating_node_names'] = ['unknown']
+        saved, errors = bulk_save_node_entries(self.node, self.entries)
+        self.assertEqual(len(self.entries) - 2, saved)
+        self.assertEqual(2, len(errors))
+
+    def test_bulk_save_queries(self):
+        # queries depend on the number of batches, not on the entries
+        many = []
+        for idx in range(50):
+            entry = copy.deepcopy(self.entries[idx % len(self.entries)])
+            entry['dpn_object_id'] = "object-%02d" % idx
+            many.append(entry)
+        bulk_save_node_entries(self.node, many)  # creates the nodes
+
+        def count_queries(entries, batch_size):
+            NodeEntry.objects.all().delete()
+            bulk_save_node_entries(self.node, entries[:1])
+            with CaptureQueriesContext(connection) as ctx:
+                bulk_save_node_entries(self.node, entries,
+                                       batch_size=batch_size)
+            return len(ctx.captured_queries)
+
+        self.assertEqual(count_queries(many[:10], 5),
+                         count_queries(many, 25))
+        self.assertEqual(len(many), NodeEntry.objects.count())
+
+
+class IncrementalSyncStartTest(TestCase):
+
+    def test_incremental_sync_start(self):
+        date = lambda day: datetime(2015, 1, day, tzinfo=timezone.utc)
+        Node.objects.create(name='tdr', last_sync_date=date(3))
+        Node.objects.create(name='sdr', last_sync_date=date(2))
+
+        with self.settings(DPN_NODE_NAME='aptrust'):
+            self.assertEqual(date(2), incremental_sync_start(
+                ['aptrust', 'tdr', 'sdr']))
+            # a node never synced needs its whole registry
+            self.assertEqual(SYNC_EPOCH, incremental_sync_start(
+                ['tdr', 'sdr', 'chron']))
@@ -2,4 +2,7 @@ from django.conf.urls import include, patterns, url
 
 urlpatterns = patterns('dpn_registry.views',
     url(r'^$', 'index', name="index"),
+    url(r'^api/entries/$', 'entries', name="api-entries"),
+    url(r'^api/node-entries/$', 'node_entries', name="api-node-entries"),
+    url(r'^api/workflows/$', 'workflows', name="api-workflows"),
 )
@@ -2,10 +2,26 @@
 
 import os
 from datetime import datetime
+from collections import OrderedDict
 
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Sum, Max, Count
+from django.utils import timezone
+
+from dpnode.exceptions import DPNDataError
 from dpn_workflows.utils import generate_fixity
-from .models import RegistryEntry
+from .forms import clean_entry_dict
+from .models import (
+    RegistryEntry, NodeEntry, Node, RegistryStats, TOTAL_SCOPE,
+    FIRST_NODE_SCOPE, REPLICATING_NODE_SCOPE
+)
+
+# start of the date range to request whole registries
+SYNC_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+REGISTRY_STATS_CACHE_KEY = 'dpn_registry_stats'
 
 def create_entry(object_id, bag_path):
     """
@@ -34,4 +50,223 @@ def create_entry(object_id, bag_path):
     return RegistryEntry.objects.create(
         dpn_object_id=object_id,
         **attributes
-    )
\ No newline at end of file
+    )
+
+def iter_chunks(queryset, size, prefetch=()):
+    """
+    Yields the objects of a queryset in lists of at most size objects.
+    Pages are selected by primary key instead of offset so every page is
+    an indexed query and memory stays bounded. Unlike iterator() this
+    supports prefetch_related, related objects are fetched once per page.
+
+    :param queryset: QuerySet to iterate
+    :param size: Integer max number of objects per list
+    :param prefetch: List of related fields to prefetch
+    """
+    queryset = queryset.order_by('pk').prefetch_related(*prefetch)
+    last_pk = None
+    while True:
+        page = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        chunk = list(page[:size])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1].pk
+
+
+def incremental_sync_start(peers=None):
+    """
+    Returns the date since which the registries of the peers are not
+    reconciled, the oldest of their last_sync_date. Registry sync requests
+    are broadcast, so one range must cover every peer. A peer never synced
+    before makes it the SYNC_EPOCH.
+
+    :param peers: List of node names, defaults to DPN_NODE_LIST
+    :return: aware datetime
+    """
+    peers = set(peers or settings.DPN_NODE_LIST)
+    peers.discard(settings.DPN_NODE_NAME)
+    marks = dict(Node.objects.filter(name__in=peers).values_list(
+        'name', 'last_sync_date'))
+    if not peers or any(marks.get(name) is None for name in peers):
+        return SYNC_EPOCH
+    return min(marks.values())
+
+
+def _link_node_entries(node, field_name, pairs):
+    """
+    Inserts the rows of a symmetrical M2M between entries of the same node.
+
+    :param node: Node instance the entries belong to
+    :param field_name: String name of the M2M field of NodeEntry
+    :param pairs: set of (dpn_object_id, related dpn_object_id)
+    """
+    object_ids = set(oid for pair in pairs for oid in pair)
+    pks = dict(NodeEntry.objects.filter(
+        node=node, dpn_object_id__in=object_ids
+    ).values_list('dpn_object_id', 'pk'))
+
+    rows = set()
+    for oid, related in pairs:
+        if oid in pks and related in pks:
+            rows.add((pks[oid], pks[related]))
+            rows.add((pks[related], pks[oid]))
+
+    field = NodeEntry._meta.get_field(field_name)
+    through = field.rel.through
+    src, dst = field.m2m_column_name(), field.m2m_reverse_name()
+    existing = set(through.objects.filter(
+        **{'%s__in' % src: [r[0] for r in rows]}).values_list(src, dst))
+    through.objects.bulk_create(
+        [through(**{src: a, dst: b}) for a, b in rows - existing])
+
+
+def bulk_save_node_entries(node, entry_list, batch_size=None):
+    """
+    Saves the registry entries sent by another node in bulk. Entries
+    already saved for the same node and dpn_object_id are replaced.
+
+    :param node: Node instance of the node that sent the entries
+    :param entry_list: List of registry entry dicts as sent in DPN messages
+    :param batch_size: Integer of entries per insert, defaults to
+        DPN_REGISTRY_BULK_BATCH
+    :return: tuple of (number of entries saved, list of error messages)
+    """
+    batch_size = batch_size or getattr(settings, 'DPN_REGISTRY_BULK_BATCH',
+                                       1000)
+    errors = []
+    cleaned = OrderedDict()  # the last entry of an object wins
+    for data in entry_list:
+        try:
+            fields, m2m = clean_entry_dict(data)
+        except DPNDataError as err:
+            errors.append("%s" % err)
+            continue
+        cleaned[fields['dpn_object_id']] = (fields, m2m)
+    cleaned = list(cleaned.values())
+
+    # every node named in the entries is created once
+    names = set(name for fields, m2m in cleaned
+                for name in m2m['replicating_nodes'])
+    missing = names - set(Node.objects.filter(
+        name__in=names).values_list('name', flat=True))
+    for name in missing:
+        Node.objects.get_or_create(name=name)
+
+    through = NodeEntry.replicating_nodes.through
+    related = dict(brightening_objects=set(), rights_objects=set())
+    with transaction.atomic():
+        for start in range(0, len(cleaned), batch_size):
+            batch = cleaned[start:start + batch_size]
+            object_ids = [fields['dpn_object_id'] for fields, m2m in batch]
+
+            # upsert on (node, dpn_object_id)
+            NodeEntry.objects.filter(
+                node=node, dpn_object_id__in=object_ids).delete()
+            NodeEntry.objects.bulk_create(
+                [NodeEntry(node=node, **fields) for fields, m2m in batch])
+
+            pks = dict(NodeEntry.objects.filter(
+                node=node, dpn_object_id__in=object_ids
+            ).values_list('dpn_object_id', 'pk'))
+            through.objects.bulk_create([
+                through(nodeentry_id=pks[fields['dpn_object_id']],
+                        node_id=name)
+                for fields, m2m in batch for name in m2m['replicating_nodes']
+            ])
+
+            for fields, m2m in batch:
+                for name, pairs in related.items():
+                    pairs.update((fields['dpn_object_id'], oid)
+                                 for oid in m2m[name])
+
+        # linked once every entry is in, they may be in different batches
+        for name, pairs in related.items():
+            if pairs:
+                _link_node_entries(node, name, pairs)
+
+    return len(cleaned), errors
+
+
+def recompute_registry_stats():
+    """
+    Rebuilds the RegistryStats rows from the registry entries. The signals
+    keep them up to date, but the bulk writes of a registry sync bypass
+    them and the largest bag of a scope is not known again after it is
+    deleted.
+
+    :return: Integer of RegistryStats rows written
+    """
+    entries = RegistryEntry.objects.all()
+    totals = entries.aggregate(Count('pk'), Sum('bag_size'),
+                               Max('bag_size'))
+    rows = [RegistryStats(scope=TOTAL_SCOPE, count=totals['pk__count'],
+                          total_size=totals['bag_size__sum'] or 0,
+                          max_size=totals['bag_size__max'] or 0)]
+    for node in entries.values('first_node_name').annotate(
+            Count('pk'), Sum('bag_size'), Max('bag_size')):
+        rows.append(RegistryStats(
+            scope=FIRST_NODE_SCOPE % node['first_node_name'],
+            count=node['pk__count'], total_size=node['bag_size__sum'],
+            max_size=node['bag_size__max']))
+    for node in Node.objects.annotate(
+            Count('registryentry'), Sum('registryentry__bag_size'),
+            Max('registryentry__bag_size')):
+        rows.append(RegistryStats(
+            scope=REPLICATING_NODE_SCOPE % node.name,
+            count=node.registryentry__count,
+            total_size=node.registryentry__bag_size__sum or 0,
+            max_size=node.registryentry__bag_size__max or 0))
+
+    with transaction.atomic():
+        RegistryStats.objects.all().delete()
+        RegistryStats.objects.bulk_create(rows)
+    cache.delete(REGISTRY_STATS_CACHE_KEY)
+    return len(rows)
+
+
+def registry_stats():
+    """
+    Returns the registry totals of the dashboard, read from the
+    RegistryStats rows and cached for DPN_REGISTRY_STATS_CACHE_TTL seconds.
+
+    :return: dict with the count, totals, node_totals and local_totals
+    """
+    stats = cache.get(REGISTRY_STATS_CACHE_KEY)
+    if stats is not None:
+        return stats
+
+    rows = dict((row.scope, row) for row in RegistryStats.objects.all())
+    total = rows.get(TOTAL_SCOPE, RegistryStats(scope=TOTAL_SCOPE))
+    first_prefix = FIRST_NODE_SCOPE % ''
+    stats = {
+        'count': total.count,
+        'totals': {
+            'bag_size__sum': total.total_size,
+            'bag_size__max': total.max_size,
+            'bag_size__avg': total.avg_size,
+        },
+        'node_totals': [
+            {
+                'first_node_name': scope[len(first_prefix):],
+                'bag_size__count': row.count,
+                'bag_size__sum': row.total_size,
+                'bag_size__max': row.max_size,
+                'bag_size__avg': row.avg_size,
+            }
+            for scope, row in sorted(rows.items())
+            if scope.startswith(first_prefix) and row.count > 0
+        ],
+        'local_totals': [],
+    }
+    for name in Node.objects.order_by('name').values_list('name', flat=True):
+        row = rows.get(REPLICATING_NODE_SCOPE % name)
+        stats['local_totals'].append({
+            'name': name,
+            'bag_count': row.count if row else 0,
+            'total_size': row.total_size if row else 0,
+        })
+
+    cache.set(REGISTRY_STATS_CACHE_KEY, stats,
+              getattr(settings, 'DPN_REGISTRY_STATS_CACHE_TTL', 30))
+    return stats
@@ -1,32 +1,78 @@
-from django.db.models import Sum, Max, Avg, Count
+import json
+
+from django.conf import settings
+from django.db.models import Sum, Min, Avg, Count
+from django.http import (
+    HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+)
 from django.shortcuts import render_to_response
 from django.contrib.auth.decorators import login_required
 from django.template import RequestContext
 
-from dpn_registry.models import RegistryEntry, Node
+from dpnode.exceptions import DPNDataError
+from dpn_registry.api import (
+    RegistryEntryQuery, NodeEntryQuery, WorkflowQuery, page_size
+)
+from dpn_registry.utils import registry_stats
+from dpn_workflows.models import Workflow, ACTION_CHOICES
 
 
 @login_required
 def index(request):
-    entries = RegistryEntry.objects.all()
-    totals = entries.aggregate(Sum('bag_size'), Max('bag_size'),
-                               Avg('bag_size'))
-
-    node_totals = entries.values('first_node_name').annotate(Sum('bag_size'),
-                                                             Max('bag_size'),
-                                                             Avg('bag_size'),
-                                                             Count("bag_size"))
-
-    local_totals = Node.objects.annotate(
-        bag_count=Count('registryentry__bag_size'),
-        total_size=Sum('registryentry__bag_size'))
-
-
-    return render_to_response("index.html", {
-        'count': entries.count(),
-        'totals': totals,
-        'local_totals': local_totals,
-        'node_totals': node_totals,
-    },
+    # maintained as entries change, never aggregated here
+    stats = registry_stats()
+
+    # transfers with and from each node, slow peers show a low throughput
+    transfer_totals = Workflow.objects.filter(
+        throughput__isnull=False
+    ).values('node', 'action').annotate(
+        Count('id'), Sum('bytes_transferred'), Avg('throughput'),
+        Min('throughput'), Avg('transfer_elapsed'), Avg('hash_elapsed')
+    ).order_by('node', 'action')
+    transfer_totals = [
+        dict(totals, action_name=dict(ACTION_CHOICES).get(totals['action']))
+        for totals in transfer_totals
+    ]
+
+    return render_to_response("index.html",
+                              dict(stats, transfer_totals=transfer_totals),
                               context_instance=RequestContext(request)
-    )
\ No newline at end of file
+    )
+
+
+def _json_api(query_class, request):
+    """
+    Returns a page of rows and the cursor of the next page as JSON, or
+    every row as JSON lines with format=jsonl.
+    """
+    try:
+        # the filters and the cursor are checked here, before a stream
+        # starts, once it did an error could only truncate it
+        query = query_class(request.GET)
+        if request.GET.get('format') == 'jsonl':
+            chunk_size = getattr(settings, 'DPN_API_STREAM_CHUNK', 1000)
+            lines = (json.dumps(row) + "\n"
+                     for row in query.stream(chunk_size))
+            return StreamingHttpResponse(
+                lines, content_type='application/x-ndjson')
+        rows, next_cursor = query.page(page_size(request.GET))
+    except DPNDataError as err:
+        return HttpResponseBadRequest(json.dumps({'error': "%s" % err}),
+                                      content_type='application/json')
+    return HttpResponse(json.dumps({'results': rows, 'next': next_cursor}),
+                        content_type='application/json')
+
+
+@login_required
+def entries(request):
+    return _json_api(RegistryEntryQuery, request)
+
+
+@login_required
+def node_entries(request):
+    return _json_api(NodeEntryQuery, request)
+
+
+@login_required
+def workflows(request):
+    return _json_api(WorkflowQuery, request)
@@ -1,7 +1,9 @@
 from django.contrib import admin
+from django.template.defaultfilters import filesizeformat
 
 from dpn_workflows.models import SendFileAction, ReceiveFileAction, NodeInfo, \
-    Workflow
+    Workflow, FixityCache, IngestQueue, StorageReservation
+from dpn_workflows.storage import active_reservations
 
 
 class SendFileActionAdmin(admin.ModelAdmin):
@@ -29,8 +31,67 @@ admin.site.register(NodeInfo, NodeInfoAdmin)
 
 
 class WorkflowAdmin(admin.ModelAdmin):
-    list_display = ('correlation_id', 'node', 'step', 'state', 'action')
-    list_filter = ('step', 'state', 'node', 'action')
+    list_display = ('correlation_id', 'node', 'step', 'state', 'action',
+                    'protocol', 'transferred', 'transfer_elapsed', 'rate',
+                    'hash_elapsed', 'reply_latency', 'staging_method',
+                    'created_at')
+    list_filter = ('step', 'state', 'node', 'action', 'protocol',
+                   'staging_method')
 
+    def transferred(self, obj):
+        return filesizeformat(obj.bytes_transferred)
+    transferred.admin_order_field = 'bytes_transferred'
 
-admin.site.register(Workflow, WorkflowAdmin)
\ No newline at end of file
+    def rate(self, obj):
+        if obj.throughput is None:
+            return None
+        return "%s/s" % filesizeformat(obj.throughput)
+    rate.admin_order_field = 'throughput'
+
+
+admin.site.register(Workflow, WorkflowAdmin)
+
+
+class FixityCacheAdmin(admin.ModelAdmin):
+    list_display = ('path', 'algorithm', 'fixity_value', 'size', 'updated_at')
+    list_filter = ('algorithm',)
+    search_fields = ('path',)
+
+
+admin.site.register(FixityCache, FixityCacheAdmin)
+
+
+class IngestQueueAdmin(admin.ModelAdmin):
+    list_display = ('dpn_object_id', 'state', 'size', 'queued_at',
+                    'admitted_at', 'estimated_completion', 'finished_at')
+    list_filter = ('state',)
+    search_fields = ('dpn_object_id', 'correlation_id')
+
+    def size(self, obj):
+        return filesizeformat(obj.bag_size)
+    size.admin_order_field = 'bag_size'
+
+
+admin.site.register(IngestQueue, IngestQueueAdmin)
+
+
+class StorageReservationAdmin(admin.ModelAdmin):
+    list_display = ('workflow', 'node', 'reserved', 'outstanding_size',
+                    'created_at', 'expires_at', 'transfer_started',
+                    'released_at')
+    list_filter = ('node',)
+    list_select_related = ('workflow',)
+
+    def get_queryset(self, request):
+        # outstanding reservations only, see dpn_workflows.storage
+        return active_reservations()
+
+    def reserved(self, obj):
+        return filesizeformat(obj.size)
+    reserved.admin_order_field = 'size'
+
+    def outstanding_size(self, obj):
+        return filesizeformat(obj.outstanding)
+
+
+admin.site.register(StorageReservation, StorageReservationAdmin)
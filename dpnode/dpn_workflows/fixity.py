@@ -0,0 +1,328 @@
+"""
+    Measure what is measurable, and make measurable what is not so.
+
+            - Galileo Galilei
+"""
+
+# Fixity engine used to calculate the checksums of DPN bags. All the
+# configured algorithms are calculated from one single pass over the file
+# and the reads are done in large blocks. hashlib releases the GIL while
+# hashing big buffers, so several bags can be hashed at once with threads.
+#
+# Calculated values are kept in the FixityCache table, with an in-process
+# LRU in front of it, keyed by the path and the inode, size and mtime of the
+# file so a bag is only hashed again after it changes on disk.
+
+import os
+import mmap
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from dpn_workflows.models import FixityCache
+
+DEFAULT_BLOCKSIZE = 8 * 1024 * 1024  # 8 MiB
+DEFAULT_WORKERS = 4
+DEFAULT_CACHE_SIZE = 1024
+
+
+def get_blocksize():
+    return getattr(settings, 'DPN_FIXITY_BLOCKSIZE', DEFAULT_BLOCKSIZE)
+
+
+def _use_mmap():
+    return getattr(settings, 'DPN_FIXITY_USE_MMAP', False)
+
+
+def _workers():
+    return getattr(settings, 'DPN_FIXITY_WORKERS', DEFAULT_WORKERS)
+
+
+def new_hasher(algorithm):
+    """
+    Returns a new hashlib object for a given DPN fixity algorithm
+
+    :param algorithm: String of the algorithm name e.g. sha256
+    """
+    if algorithm not in settings.DPN_FIXITY_CHOICES:
+        raise NotImplementedError(
+            "Fixity algorithm %s is not supported" % algorithm)
+
+    return hashlib.new(algorithm)
+
+
+class MultiHasher(object):
+    """
+    Feeds the same data to one hasher per algorithm so several digests
+    can be calculated from a single read of the file.
+    """
+
+    def __init__(self, algorithms=None):
+        """
+        :param algorithms: List of algorithms, defaults to DPN_FIXITY_CHOICES
+        """
+        algorithms = algorithms or settings.DPN_FIXITY_CHOICES
+        self.hashers = dict((algo, new_hasher(algo)) for algo in algorithms)
+
+    def update(self, buf):
+        for hasher in self.hashers.values():
+            hasher.update(buf)
+
+    def hexdigest(self, algorithm='sha256'):
+        return self.hashers[algorithm].hexdigest()
+
+    def hexdigests(self):
+        """
+        Returns a dict with the hexdigest of every algorithm
+        """
+        return dict(
+            (algo, hasher.hexdigest()) for algo, hasher in self.hashers.items()
+        )
+
+
+def _hash_read(path, hasher, blocksize):
+    with open(path, 'rb') as f:
+        buf = f.read(blocksize)
+        while len(buf) > 0:
+            hasher.update(buf)
+            buf = f.read(blocksize)
+
+
+def _hash_mmap(path, hasher, blocksize):
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return  # empty files cannot be mapped
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                for offset in range(0, size, blocksize):
+                    hasher.update(view[offset:offset + blocksize])
+            finally:
+                view.release()
+
+
+def generate_fixities(path, algorithms=None, blocksize=None, use_mmap=None):
+    """
+    Returns the fixity values of a file for several algorithms
+    reading the file only once.
+
+    :param path: String of the path of the file
+    :param algorithms: List of algorithms, defaults to DPN_FIXITY_CHOICES
+    :param blocksize: Integer of bytes per read, defaults to
+        DPN_FIXITY_BLOCKSIZE
+    :param use_mmap: Boolean to map the file in memory instead of reading it,
+        defaults to DPN_FIXITY_USE_MMAP
+    :return: dict of algorithm -> hexdigest
+    """
+    hasher = MultiHasher(algorithms)
+    blocksize = blocksize or get_blocksize()
+    use_mmap = _use_mmap() if use_mmap is None else use_mmap
+
+    if use_mmap:
+        _hash_mmap(path, hasher, blocksize)
+    else:
+        _hash_read(path, hasher, blocksize)
+
+    return hasher.hexdigests()
+
+
+def generate_fixities_many(paths, algorithms=None, workers=None, **kwargs):
+    """
+    Hashes several files at once on a thread pool.
+
+    :param paths: List of paths of the files to hash
+    :param algorithms: List of algorithms, defaults to DPN_FIXITY_CHOICES
+    :param workers: Integer of threads to use, defaults to DPN_FIXITY_WORKERS
+    :return: dict of path -> dict of algorithm -> hexdigest
+    """
+    workers = workers or _workers()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict(
+            (path, executor.submit(generate_fixities, path, algorithms,
+                                   **kwargs))
+            for path in paths
+        )
+        return dict((path, ftr.result()) for path, ftr in futures.items())
+
+
+def benchmark(paths, blocksize, algorithms=None, use_mmap=False, workers=1):
+    """
+    Hashes the given files and measures the throughput.
+
+    :param paths: List of paths of the files to hash
+    :param blocksize: Integer of bytes per read
+    :param algorithms: List of algorithms, defaults to DPN_FIXITY_CHOICES
+    :param use_mmap: Boolean to map the files in memory
+    :param workers: Integer of files hashed at the same time
+    :return: tuple of (total bytes, elapsed seconds, MB/s)
+    """
+    total = sum(os.path.getsize(path) for path in paths)
+    start = time.time()
+    generate_fixities_many(paths, algorithms, workers=workers,
+                           blocksize=blocksize, use_mmap=use_mmap)
+    elapsed = time.time() - start
+    rate = total / elapsed / 1000000 if elapsed else 0
+    return total, elapsed, rate
+
+
+# Fixity Cache
+# ------------
+
+class _LRUCache(object):
+    """
+    Minimal thread safe LRU mapping used in front of the FixityCache table.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return None
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_lru = _LRUCache(getattr(settings, 'DPN_FIXITY_CACHE_SIZE', DEFAULT_CACHE_SIZE))
+
+
+def file_stamp(path):
+    """
+    Returns the (inode, size, mtime) tuple identifying the current content
+    of a file or None if the file can not be stat'ed.
+
+    :param path: String of the path of the file
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def get_cached_fixity(path, algorithm, stamp):
+    """
+    Returns the cached fixity value of a file if it has not changed since
+    it was hashed, None otherwise.
+
+    :param path: String of the absolute path of the file
+    :param algorithm: String of the fixity algorithm
+    :param stamp: tuple of (inode, size, mtime) as returned by file_stamp
+    """
+    cached = _lru.get((path, algorithm))
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    try:
+        entry = FixityCache.objects.get(path=path, algorithm=algorithm)
+    except FixityCache.DoesNotExist:
+        return None
+
+    if (entry.inode, entry.size, entry.mtime) != stamp:
+        return None  # stale, it will be replaced by set_cached_fixity
+
+    _lru.set((path, algorithm), (stamp, entry.fixity_value))
+    return entry.fixity_value
+
+
+def set_cached_fixity(path, algorithm, stamp, fixity_value):
+    """
+    Stores the fixity value of a file for the given (inode, size, mtime).
+
+    :param path: String of the absolute path of the file
+    :param algorithm: String of the fixity algorithm
+    :param stamp: tuple of (inode, size, mtime) as returned by file_stamp
+    :param fixity_value: String of the hexdigest
+    """
+    inode, size, mtime = stamp
+    FixityCache.objects.update_or_create(
+        path=path,
+        algorithm=algorithm,
+        defaults=dict(inode=inode, size=size, mtime=mtime,
+                      fixity_value=fixity_value)
+    )
+    _lru.set((path, algorithm), (stamp, fixity_value))
+
+
+def remember_fixity(path, algorithm, fixity_value):
+    """
+    Caches a fixity value calculated elsewhere (e.g. while the file
+    was downloaded) for the current state of the file.
+
+    :param path: String of the path of the file
+    :param algorithm: String of the fixity algorithm
+    :param fixity_value: String of the hexdigest
+    """
+    path = os.path.abspath(path)
+    stamp = file_stamp(path)
+    if stamp:
+        set_cached_fixity(path, algorithm, stamp, fixity_value)
+
+
+def forget_fixity(path):
+    """
+    Removes every cached fixity value of a file.
+
+    :param path: String of the path of the file
+    """
+    path = os.path.abspath(path)
+    for algorithm in settings.DPN_FIXITY_CHOICES:
+        _lru.delete((path, algorithm))
+    FixityCache.objects.filter(path=path).delete()
+
+
+def cached_fixity(path, algorithm='sha256'):
+    """
+    Returns the fixity value of a file, hashing it only if there is no
+    cached value for its current inode, size and mtime. The file is hashed
+    with every algorithm of DPN_FIXITY_CHOICES in the same pass and all the
+    values are cached, a later check with another algorithm does not read
+    the file again.
+
+    :param path: String of the path of the file
+    :param algorithm: String of the fixity algorithm
+    :return: String of the hexdigest
+    """
+    path = os.path.abspath(path)
+    stamp = file_stamp(path)
+    if stamp:
+        fixity_value = get_cached_fixity(path, algorithm, stamp)
+        if fixity_value:
+            return fixity_value
+
+    algorithms = list(settings.DPN_FIXITY_CHOICES)
+    if algorithm not in algorithms:
+        algorithms.append(algorithm)  # refused by new_hasher
+    fixities = generate_fixities(path, algorithms)
+
+    # only cache the values if the file did not change while hashing it
+    if stamp and stamp == file_stamp(path):
+        for algo, fixity_value in fixities.items():
+            set_cached_fixity(path, algo, stamp, fixity_value)
+
+    return fixities[algorithm]
@@ -16,6 +16,8 @@ from .models import (
 
 from .utils import protocol_str2db
 
+from django.utils import timezone
+
 from dpnode.settings import DPN_NODE_NAME
 from dpnode.exceptions import DPNWorkflowError
 
@@ -122,6 +124,14 @@ def send_available_workflow(
         action.state = SUCCESS
         action.note = None
 
+        # kept to rank the node, see dpn_workflows.ranking
+        query_sent = Workflow.objects.filter(
+            correlation_id=id, node=DPN_NODE_NAME
+        ).values_list('created_at', flat=True)
+        if query_sent:
+            action.reply_latency = (
+                timezone.now() - query_sent[0]).total_seconds()
+
     elif confirm == 'nak':
         action.note = "Received a NAK reponse from node: %s" % node
 
@@ -0,0 +1,49 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from dpnmq.utils import human_to_bytes
+from dpn_workflows.fixity import benchmark
+
+
+class Command(BaseCommand):
+    help = 'Measures fixity throughput (MB/s) per block size. Needs one or more file paths as arguments.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--blocksizes',
+                    default='64K,1M,4M,8M,16M,32M',
+                    help='Comma separated list of human-readable block sizes.'),
+        make_option('--algorithms',
+                    default=','.join(settings.DPN_FIXITY_CHOICES),
+                    help='Comma separated list of fixity algorithms.'),
+        make_option('--workers',
+                    default=1,
+                    help='Number of files hashed at the same time.'),
+        make_option('--mmap',
+                    action='store_true',
+                    dest='mmap',
+                    default=False,
+                    help='Map files in memory instead of reading them.'),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError("At least one file path is required.")
+
+        blocksizes = [human_to_bytes(size.strip())
+                      for size in options['blocksizes'].split(',')]
+        algorithms = options['algorithms'].split(',')
+        workers = int(options['workers'])
+
+        print("Hashing %d file(s) with %s, %d worker(s), %s reads." % (
+            len(args), ", ".join(algorithms), workers,
+            "mmap" if options['mmap'] else "buffered"))
+        print("NOTE: files that fit in the page cache are only read from "
+              "disk in the first run.")
+
+        for blocksize in blocksizes:
+            total, elapsed, rate = benchmark(args, blocksize, algorithms,
+                                             options['mmap'], workers)
+            print("%10d bytes/block: %d bytes in %.2fs -> %.1f MB/s" % (
+                blocksize, total, elapsed, rate))
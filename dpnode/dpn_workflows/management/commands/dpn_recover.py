@@ -3,6 +3,7 @@ from uuid import uuid4
 from django.core.management.base import BaseCommand, CommandError
 
 from dpnmq.messages import RecoveryInitQuery
+from dpnmq.tasks import outbox_transaction
 from dpn_registry.models import Node, RegistryEntry
 from dpn_workflows.tasks import choose_node_and_recover
 from dpnode.settings import DPN_BROADCAST_KEY, DPN_NODE_NAME
@@ -44,22 +45,23 @@ class Command(BaseCommand):
                 step=INIT_QUERY
             )
 
-            # handle errors on sending message to network
+            # the action is saved with the query so the replies, that
+            # may come right away, find it
             try:
-                msg.send(DPN_BROADCAST_KEY)
-                action.state = SUCCESS
+                with outbox_transaction():
+                    msg.queue(DPN_BROADCAST_KEY)
+                    action.state = SUCCESS
+                    action.save()
             except Exception as err:
                 action.state = FAILED
                 action.note = err
+                action.save()
 
-            # save action in DB
-            action.save()
-
-            # now queue the task responsible to handle the recovery
-            ttl = DPN_MSG_TTL.get('recovery-init-query', DPN_TTL)
-            delay = ttl * 2
+            # the recovery starts with the first available reply, the task
+            # also runs once the query expires in case none arrives
+            delay = DPN_MSG_TTL.get('recovery-init-query', DPN_TTL)
             choose_node_and_recover.apply_async(
-                (correlation_id, dpn_obj_id, action),
+                (correlation_id, dpn_obj_id),
                 countdown=delay
             )
 
@@ -0,0 +1,96 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from kombu import Connection
+from kombu.serialization import prepare_accept_content
+from kombu.utils import uuid
+
+from dpnmq.messages import (
+    ReplicationLocationReply, ReplicationTransferReply, from_payload
+)
+from dpnmq.tests import fixtures
+from dpn_workflows.models import Workflow, RECEIVE, LOCATION_REPLY, SUCCESS
+
+
+def _task_body(task, args):
+    # the message celery 3.1 sends for apply_async
+    return {'task': task, 'id': uuid(), 'args': args, 'kwargs': {},
+            'retries': 0, 'eta': None, 'expires': None}
+
+
+def _fresh(payload, action_id=None):
+    # what the tasks do with their arguments before they start
+    req = from_payload(payload)
+    if action_id is not None:
+        Workflow.objects.get(pk=action_id)
+    return req
+
+
+class Command(BaseCommand):
+    help = 'Measures the size and the enqueue/dequeue time of the workflow task arguments: pickled messages and models against JSON payloads and primary keys.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--count',
+                    default=1000,
+                    help='Number of tasks sent for each case.'),
+        make_option('--broker',
+                    default='memory://',
+                    help='Broker URL to send the tasks through, in memory '
+                         'by default to leave the network out.'),
+    )
+
+    def handle(self, *args, **options):
+        count = int(options['count'])
+
+        # the workflow row only exists for the run
+        with transaction.atomic():
+            action = Workflow.objects.create(
+                correlation_id=uuid(), dpn_object_id=uuid(), node='tdr',
+                action=RECEIVE, step=LOCATION_REPLY, state=SUCCESS,
+                location=fixtures.REP_LOCATION_REPLY['location'])
+            location = ReplicationLocationReply(
+                fixtures.make_headers(), fixtures.REP_LOCATION_REPLY)
+            transfer = ReplicationTransferReply(
+                fixtures.make_headers(), fixtures.REP_TRANSFER_REPLY_ACK)
+
+            cases = [
+                ('transfer_content', 'pickle', (location, action), None),
+                ('transfer_content', 'json',
+                 (location.payload(), action.pk), _fresh),
+                ('verify_fixity_and_reply', 'pickle', (transfer,), None),
+                ('verify_fixity_and_reply', 'json',
+                 (transfer.payload(),), _fresh),
+            ]
+
+            print("Sending %d tasks per case through %s" % (
+                count, options['broker']))
+            with Connection(options['broker']) as conn:
+                for task, serializer, task_args, fetch in cases:
+                    size, elapsed = self._measure(conn, task, serializer,
+                                                  task_args, fetch, count)
+                    print("%-24s %-6s %6d bytes/task %8.3f ms/task" % (
+                        task, serializer, size, 1000.0 * elapsed / count))
+            transaction.set_rollback(True)
+
+    def _measure(self, conn, task, serializer, task_args, fetch, count):
+        queue = conn.SimpleQueue('dpn.benchmark.tasks.%s' % uuid(),
+                                 serializer=serializer)
+        # pickle is only accepted here, to measure it
+        queue.consumer.accept = prepare_accept_content([serializer])
+        try:
+            start = time.time()
+            size = 0
+            for _ in range(count):
+                queue.put(_task_body(task, task_args))
+                message = queue.get(timeout=10)
+                size = len(message.body)
+                received = message.payload['args']
+                if fetch:
+                    fetch(*received)
+                message.ack()
+            return size, time.time() - start
+        finally:
+            queue.queue.delete()
+            queue.close()
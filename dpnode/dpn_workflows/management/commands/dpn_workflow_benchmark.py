@@ -0,0 +1,115 @@
+import time
+from itertools import cycle
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from dpn_workflows.models import (
+    Workflow, INIT_QUERY, AVAILABLE_REPLY, LOCATION_REPLY, TRANSFER_REPLY,
+    VERIFY_REPLY, SUCCESS, FAILED, CANCELLED, COMPLETE, RECEIVE, REPLICATE
+)
+from dpn_workflows.queryplans import hot_queries, explain, uses_index, analyze
+
+NODES = ['tdr', 'sdr', 'chron', 'hathi']
+
+# steps and states the rows of the other nodes go through
+NODE_STEPS = [
+    (AVAILABLE_REPLY, SUCCESS),
+    (AVAILABLE_REPLY, CANCELLED),
+    (LOCATION_REPLY, SUCCESS),
+    (TRANSFER_REPLY, SUCCESS),
+    (VERIFY_REPLY, COMPLETE),
+    (AVAILABLE_REPLY, FAILED),
+]
+
+
+def synthetic_rows(transactions, own_node):
+    """
+    Yields the Workflow rows of the given number of replications, one row of
+    our node and one of each other node for every transaction.
+    """
+    steps = cycle(NODE_STEPS)
+    for number in range(transactions):
+        correlation_id = 'benchmark-%08d' % number
+        dpn_object_id = 'benchmark-bag-%08d' % number
+        yield Workflow(correlation_id=correlation_id,
+                       dpn_object_id=dpn_object_id, node=own_node,
+                       action=REPLICATE, step=INIT_QUERY, state=SUCCESS)
+        for node in NODES:
+            step, state = next(steps)
+            yield Workflow(correlation_id=correlation_id,
+                           dpn_object_id=dpn_object_id, node=node,
+                           action=RECEIVE, step=step, state=state)
+
+
+class Command(BaseCommand):
+    help = 'Measures the Workflow lookups of the message handlers over a synthetic table and checks each one is answered from an index.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--rows',
+                    default=1000000,
+                    help='Number of synthetic workflow rows to load.'),
+        make_option('--repeat',
+                    default=200,
+                    help='Number of times each lookup is run.'),
+        make_option('--batch',
+                    default=5000,
+                    help='Number of rows inserted at a time.'),
+    )
+
+    def handle(self, *args, **options):
+        rows = int(options['rows'])
+        repeat = int(options['repeat'])
+        batch = int(options['batch'])
+        own_node = settings.DPN_NODE_NAME
+        transactions = max(1, rows // (len(NODES) + 1))
+
+        # the rows are only there for the run, all of it is rolled back
+        with transaction.atomic():
+            self._load(transactions, own_node, batch)
+            missing = self._measure(transactions, own_node, repeat)
+            transaction.set_rollback(True)
+
+        if missing:
+            raise CommandError("Not backed by an index: %s"
+                               % ", ".join(missing))
+        print("Every lookup is backed by an index.")
+
+    def _load(self, transactions, own_node, batch):
+        print("Loading %d workflow rows (%s)..." % (
+            transactions * (len(NODES) + 1), connection.vendor))
+        start = time.time()
+        pending = []
+        for row in synthetic_rows(transactions, own_node):
+            pending.append(row)
+            if len(pending) == batch:
+                Workflow.objects.bulk_create(pending)
+                pending = []
+        Workflow.objects.bulk_create(pending)
+        analyze()
+        print("Loaded in %.1fs" % (time.time() - start))
+
+    def _measure(self, transactions, own_node, repeat):
+        # a transaction in the middle of the table
+        number = transactions // 2
+        queries = hot_queries('benchmark-%08d' % number,
+                              'benchmark-bag-%08d' % number,
+                              NODES[0], own_node)
+
+        missing = []
+        for name, queryset in queries:
+            indexed = uses_index(explain(queryset))
+            with CaptureQueriesContext(connection) as captured:
+                start = time.time()
+                for _ in range(repeat):
+                    list(queryset.all())
+                elapsed = time.time() - start
+            print("%-22s %8.3f ms/lookup %3d queries/lookup  %s" % (
+                name, 1000.0 * elapsed / repeat,
+                len(captured) // repeat, "index" if indexed else "SCAN"))
+            if not indexed:
+                missing.append(name)
+        return missing
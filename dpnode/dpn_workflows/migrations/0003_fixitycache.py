@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dpn_workflows', '0002_auto_20141002_1700'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FixityCache',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('path', models.CharField(max_length=255, help_text='Absolute path of the hashed file.')),
+                ('algorithm', models.CharField(max_length=10, help_text='Algorithm used to calculate the fixity value.')),
+                ('inode', models.BigIntegerField(help_text='Inode of the file when it was hashed.')),
+                ('size', models.BigIntegerField(help_text='Size in bytes of the file when it was hashed.')),
+                ('mtime', models.BigIntegerField(help_text='Modification time (ns) of the file when it was hashed.')),
+                ('fixity_value', models.CharField(max_length=128, help_text='Fixity value for the file being copied.')),
+                ('created_at', models.DateTimeField(help_text='Datetime record was created.', auto_now_add=True)),
+                ('updated_at', models.DateTimeField(help_text='Datetime record was last modified.', auto_now=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='fixitycache',
+            unique_together=set([('path', 'algorithm')]),
+        ),
+        migrations.AlterField(
+            model_name='workflow',
+            name='state',
+            field=models.CharField(max_length=10, choices=[('P', 'Pending'), ('S', 'Success'), ('F', 'Failed'), ('X', 'Canceled'), ('C', 'Complete')], help_text='State of the current operation.'),
+            preserve_default=True,
+        ),
+    ]
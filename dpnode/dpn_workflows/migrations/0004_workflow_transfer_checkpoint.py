@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dpn_workflows', '0003_fixitycache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='workflow',
+            name='transfer_checkpoint',
+            field=models.TextField(blank=True, null=True, help_text='Finished segments of an interrupted transfer (JSON).'),
+            preserve_default=True,
+        ),
+    ]
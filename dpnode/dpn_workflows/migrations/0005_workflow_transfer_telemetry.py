@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dpn_workflows', '0004_workflow_transfer_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='workflow',
+            name='bytes_transferred',
+            field=models.BigIntegerField(default=0, help_text='Bytes transferred so far.'),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='workflow',
+            name='hash_elapsed',
+            field=models.FloatField(blank=True, null=True, help_text='Seconds spent calculating the fixity value.'),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='workflow',
+            name='throughput',
+            field=models.FloatField(blank=True, null=True, help_text='Average transfer throughput in bytes per second.'),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='workflow',
+            name='transfer_elapsed',
+            field=models.FloatField(blank=True, null=True, help_text='Seconds the transfer took.'),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='workflow',
+            name='transfer_started',
+            field=models.DateTimeField(blank=True, null=True, help_text='Datetime the transfer started.'),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dpn_workflows', '0005_workflow_transfer_telemetry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='workflow',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, null=True, help_text='Datetime record was created.'),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='workflow',
+            name='reply_latency',
+            field=models.FloatField(blank=True, null=True, help_text='Seconds the node took to reply to our init query.'),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dpn_workflows', '0006_workflow_reply_latency'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestQueue',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('dpn_object_id', models.CharField(max_length=100, unique=True, help_text='UUID of the DPN object.')),
+                ('bag_path', models.TextField(help_text='Absolute path of the bag file.')),
+                ('bag_size', models.BigIntegerField(help_text='Size of the bag in bytes.')),
+                ('state', models.CharField(max_length=1, default='P', choices=[('P', 'Pending'), ('T', 'Started'), ('C', 'Complete')], help_text='State of the current operation.')),
+                ('correlation_id', models.CharField(max_length=100, blank=True, null=True, help_text='Operation Unique ID.')),
+                ('queued_at', models.DateTimeField(help_text='Datetime the bag was queued for ingest.', auto_now_add=True)),
+                ('admitted_at', models.DateTimeField(blank=True, null=True, help_text='Datetime the ingest was started.')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, help_text='Datetime the replications of the bag finished.')),
+                ('estimated_completion', models.DateTimeField(blank=True, null=True, help_text='Estimated datetime the replications of the bag finish.')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='ingestqueue',
+            index_together=set([('state', 'queued_at')]),
+        ),
+    ]
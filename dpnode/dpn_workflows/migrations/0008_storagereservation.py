@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dpn_workflows', '0007_ingestqueue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StorageReservation',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('node', models.CharField(max_length=25, help_text='Replicating node the operation is with.')),
+                ('size', models.BigIntegerField(help_text='Bytes of DPN_REPLICATION_ROOT promised to the node.')),
+                ('created_at', models.DateTimeField(help_text='Datetime record was created.', auto_now_add=True)),
+                ('expires_at', models.DateTimeField(blank=True, null=True, help_text='Datetime the reservation lapses if no transfer started.')),
+                ('transfer_started', models.DateTimeField(blank=True, null=True, help_text='Datetime the transfer of the bag started.')),
+                ('released_at', models.DateTimeField(blank=True, null=True, help_text='Datetime the reservation was released.')),
+                ('workflow', models.OneToOneField(related_name='reservation', to='dpn_workflows.Workflow')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='storagereservation',
+            index_together=set([('released_at', 'expires_at')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dpn_workflows', '0008_storagereservation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='workflow',
+            name='staging_method',
+            field=models.CharField(max_length=10, blank=True, null=True, help_text='How the bag was staged locally (hardlink, reflink, copy...).'),
+            preserve_default=True,
+        ),
+    ]
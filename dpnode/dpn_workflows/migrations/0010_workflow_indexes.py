@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dpn_workflows', '0009_workflow_staging_method'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='workflow',
+            index_together=set([('correlation_id', 'step', 'state'), ('correlation_id', 'node'), ('node', 'action')]),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def copy_last_sequences(apps, schema_editor):
+    # the old rows hold every sequence received, comma separated
+    OldSequenceInfo = apps.get_model('dpn_workflows', 'OldSequenceInfo')
+    SequenceInfo = apps.get_model('dpn_workflows', 'SequenceInfo')
+    sequences = []
+    for old in OldSequenceInfo.objects.all():
+        numbers = [int(n) for n in old.sequence.split(',') if n.strip()]
+        if numbers:
+            sequences.append(SequenceInfo(
+                correlation_id=old.correlation_id,
+                node=old.node,
+                last_sequence=max(numbers)
+            ))
+    SequenceInfo.objects.bulk_create(sequences)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dpn_workflows', '0010_workflow_indexes'),
+    ]
+
+    operations = [
+        migrations.RenameModel('SequenceInfo', 'OldSequenceInfo'),
+        migrations.CreateModel(
+            name='SequenceInfo',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('correlation_id', models.CharField(max_length=100, help_text='Operation Unique ID.')),
+                ('node', models.CharField(max_length=25, help_text='Replicating node the operation is with.')),
+                ('last_sequence', models.PositiveIntegerField(help_text='Highest sequence number received from the node.')),
+                ('updated_at', models.DateTimeField(help_text='Date the last sequence number was received.', auto_now=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='sequenceinfo',
+            unique_together=set([('correlation_id', 'node')]),
+        ),
+        migrations.RunPython(copy_last_sequences),
+        migrations.DeleteModel('OldSequenceInfo'),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dpn_workflows', '0011_sequenceinfo_last_sequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerLock',
+            fields=[
+                ('name', models.CharField(primary_key=True, max_length=30, serialize=False)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
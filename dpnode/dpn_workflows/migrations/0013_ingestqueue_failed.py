@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dpn_workflows', '0012_ledgerlock'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ingestqueue',
+            name='finished_at',
+            field=models.DateTimeField(blank=True, null=True, help_text='Datetime the replications of the bag finished or timed out.'),
+            preserve_default=True,
+        ),
+        migrations.AlterField(
+            model_name='ingestqueue',
+            name='state',
+            field=models.CharField(max_length=1, default='P', choices=[('P', 'Pending'), ('T', 'Started'), ('C', 'Complete'), ('F', 'Failed')], help_text='State of the current operation.'),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dpn_workflows', '0013_ingestqueue_failed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storagereservation',
+            name='preallocated',
+            field=models.BooleanField(default=False, help_text='The whole bag was allocated on disk when the transfer started.'),
+            preserve_default=True,
+        ),
+    ]
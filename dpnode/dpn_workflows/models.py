@@ -118,6 +118,14 @@ note_help = "Additional details."
 obid_help = "UUID of the DPN object."
 lbid_help = "Local bag ID"
 acti_help = "Corresponding action in the workflow"
+xckp_help = "Finished segments of an interrupted transfer (JSON)."
+xbyt_help = "Bytes transferred so far."
+xsta_help = "Datetime the transfer started."
+xela_help = "Seconds the transfer took."
+xthr_help = "Average transfer throughput in bytes per second."
+hela_help = "Seconds spent calculating the fixity value."
+rlat_help = "Seconds the node took to reply to our init query."
+stgm_help = "How the bag was staged locally (hardlink, reflink, copy...)."
 
 
 class IngestAction(models.Model):
@@ -253,6 +261,27 @@ class Workflow(models.Model):
     # Node reply_key
     reply_key = models.CharField(max_length=75, blank=True)
 
+    # Segmented transfers
+    transfer_checkpoint = models.TextField(null=True, blank=True,
+                                           help_text=xckp_help)
+
+    # Transfer telemetry
+    bytes_transferred = models.BigIntegerField(default=0, help_text=xbyt_help)
+    transfer_started = models.DateTimeField(null=True, blank=True,
+                                            help_text=xsta_help)
+    transfer_elapsed = models.FloatField(null=True, blank=True,
+                                         help_text=xela_help)
+    throughput = models.FloatField(null=True, blank=True, help_text=xthr_help)
+    hash_elapsed = models.FloatField(null=True, blank=True, help_text=hela_help)
+    reply_latency = models.FloatField(null=True, blank=True,
+                                      help_text=rlat_help)
+    staging_method = models.CharField(max_length=10, null=True, blank=True,
+                                      help_text=stgm_help)
+
+    # Timestamps, workflows saved before it was added have none
+    created_at = models.DateTimeField(auto_now_add=True, null=True,
+                                      help_text=created_help)
+
     def __unicode__(self):
         return 'CORR_ID: %(corr_id)s DPN_OBJECT: %(obj_id)s NODE: %(node)s' % {
             'corr_id': self.correlation_id,
@@ -263,8 +292,35 @@ class Workflow(models.Model):
     def __str__(self):
         return '%s' % self.__unicode__()
 
+    def record_transfer(self, nbytes, elapsed, hash_elapsed=None,
+                        resumed=False):
+        """
+        Sets the telemetry of a finished transfer, it does not save the
+        instance. A resumed transfer gets no throughput: only part of the
+        bag was fetched in the elapsed time, and the averages by node of
+        the dashboard and the ranking would be skewed by it.
+
+        :param nbytes: Integer of bytes transferred
+        :param elapsed: Float of seconds the transfer took
+        :param hash_elapsed: Float of seconds spent hashing the bag
+        :param resumed: Boolean, the transfer continued a previous attempt
+        """
+        self.bytes_transferred = nbytes
+        self.transfer_elapsed = elapsed
+        self.throughput = None
+        if elapsed and not resumed:
+            self.throughput = nbytes / elapsed
+        self.hash_elapsed = hash_elapsed
+
     class Meta:
+        # lookups by (correlation_id, dpn_object_id) use the unique index,
+        # see dpn_workflows.queryplans for the queries they back
         unique_together = [('correlation_id', 'dpn_object_id', 'node')]
+        index_together = [
+            ('correlation_id', 'node'),
+            ('correlation_id', 'step', 'state'),
+            ('node', 'action'),
+        ]
 
 
 class NodeInfo(models.Model):
@@ -288,11 +344,171 @@ class NodeInfo(models.Model):
         verbose_name_plural = "Node Info"
 
 
+# SequenceInfo Help Text
+lseq_help = "Highest sequence number received from the node."
+sequ_help = "Date the last sequence number was received."
+
+
 class SequenceInfo(models.Model):
     """
-    Tracks the overall sequential workflow related to DPN node file transfers.
+    Tracks the overall sequential workflow related to DPN node file transfers,
+    the last sequence number of each node in a transaction.
     """
-    correlation_id = models.CharField(max_length=100, primary_key=True,
+    correlation_id = models.CharField(max_length=100, help_text=cid_help)
+    node = models.CharField(max_length=25, help_text=node_help)
+    last_sequence = models.PositiveIntegerField(help_text=lseq_help)
+    updated_at = models.DateTimeField(auto_now=True, help_text=sequ_help)
+
+    def __unicode__(self):
+        return '%s %s: %d' % (self.correlation_id, self.node,
+                              self.last_sequence)
+
+    def __str__(self):
+        return '%s' % self.__unicode__()
+
+    class Meta:
+        unique_together = [('correlation_id', 'node')]
+
+
+# FixityCache Help Text
+path_help = "Absolute path of the hashed file."
+algo_help = "Algorithm used to calculate the fixity value."
+inod_help = "Inode of the file when it was hashed."
+size_help = "Size in bytes of the file when it was hashed."
+mtim_help = "Modification time (ns) of the file when it was hashed."
+
+
+class FixityCache(models.Model):
+    """
+    Keeps the fixity values already calculated for local files so the same
+    bag is not hashed again while it has not changed on disk.
+    """
+    path = models.CharField(max_length=255, help_text=path_help)
+    algorithm = models.CharField(max_length=10, help_text=algo_help)
+    inode = models.BigIntegerField(help_text=inod_help)
+    size = models.BigIntegerField(help_text=size_help)
+    mtime = models.BigIntegerField(help_text=mtim_help)
+    fixity_value = models.CharField(max_length=128, help_text=fxty_help)
+
+    # Timestamps
+    created_at = models.DateTimeField(auto_now_add=True, help_text=created_help)
+    updated_at = models.DateTimeField(auto_now=True, help_text=updated_help)
+
+    def __unicode__(self):
+        return '%s (%s)' % (self.path, self.algorithm)
+
+    def __str__(self):
+        return '%s' % self.__unicode__()
+
+    class Meta:
+        unique_together = [('path', 'algorithm')]
+
+
+# IngestQueue states
+INGEST_STATE_CHOICES = (
+    (PENDING, 'Pending'),
+    (STARTED, 'Started'),
+    (COMPLETE, 'Complete'),
+    (FAILED, 'Failed')
+)
+
+# IngestQueue Help Text
+bpth_help = "Absolute path of the bag file."
+bsiz_help = "Size of the bag in bytes."
+qued_help = "Datetime the bag was queued for ingest."
+admt_help = "Datetime the ingest was started."
+done_help = "Datetime the replications of the bag finished or timed out."
+eta_help = "Estimated datetime the replications of the bag finish."
+
+
+class IngestQueue(models.Model):
+    """
+    Bags waiting to be ingested. They are admitted in the order of
+    DPN_INGEST_ORDER while the outbound replications stay under the
+    configured limits.
+    """
+    dpn_object_id = models.CharField(max_length=100, unique=True,
+                                     help_text=obid_help)
+    bag_path = models.TextField(help_text=bpth_help)
+    bag_size = models.BigIntegerField(help_text=bsiz_help)
+    state = models.CharField(max_length=1, choices=INGEST_STATE_CHOICES,
+                             default=PENDING, help_text=stat_help)
+    correlation_id = models.CharField(max_length=100, null=True, blank=True,
                                       help_text=cid_help)
+    queued_at = models.DateTimeField(auto_now_add=True, help_text=qued_help)
+    admitted_at = models.DateTimeField(null=True, blank=True,
+                                       help_text=admt_help)
+    finished_at = models.DateTimeField(null=True, blank=True,
+                                       help_text=done_help)
+    estimated_completion = models.DateTimeField(null=True, blank=True,
+                                                help_text=eta_help)
+
+    def __unicode__(self):
+        return '%s' % self.dpn_object_id
+
+    def __str__(self):
+        return '%s' % self.__unicode__()
+
+    class Meta:
+        index_together = [('state', 'queued_at')]
+
+
+# StorageReservation Help Text
+rsiz_help = "Bytes of DPN_REPLICATION_ROOT promised to the node."
+rexp_help = "Datetime the reservation lapses if no transfer started."
+rxfr_help = "Datetime the transfer of the bag started."
+rrel_help = "Datetime the reservation was released."
+rpre_help = "The whole bag was allocated on disk when the transfer started."
+
+
+class StorageReservation(models.Model):
+    """
+    Space of the replication storage promised to a node when we acknowledge
+    its replication-init-query. It is held while the bag is transferred and
+    released once the transfer finishes or is cancelled, or when it lapses
+    because the node did not choose us.
+    """
+    workflow = models.OneToOneField(Workflow, related_name='reservation')
     node = models.CharField(max_length=25, help_text=node_help)
-    sequence = models.CharField(max_length=20)
+    size = models.BigIntegerField(help_text=rsiz_help)
+    created_at = models.DateTimeField(auto_now_add=True, help_text=created_help)
+    expires_at = models.DateTimeField(null=True, blank=True,
+                                      help_text=rexp_help)
+    transfer_started = models.DateTimeField(null=True, blank=True,
+                                            help_text=rxfr_help)
+    released_at = models.DateTimeField(null=True, blank=True,
+                                       help_text=rrel_help)
+    preallocated = models.BooleanField(default=False, help_text=rpre_help)
+
+    def __unicode__(self):
+        return '%s (%s)' % (self.workflow.correlation_id, self.node)
+
+    def __str__(self):
+        return '%s' % self.__unicode__()
+
+    @property
+    def outstanding(self):
+        """
+        Bytes promised that are not on disk yet. A preallocated bag already
+        took its whole size from the free space.
+        """
+        if self.preallocated:
+            return 0
+        return max(0, self.size - self.workflow.bytes_transferred)
+
+    class Meta:
+        index_together = [('released_at', 'expires_at')]
+
+
+class LedgerLock(models.Model):
+    """
+    Row locked with select_for_update by the workers changing the storage
+    ledger, so only one of them counts and saves reservations at a time.
+    """
+    name = models.CharField(max_length=30, primary_key=True)
+
+    def __unicode__(self):
+        return '%s' % self.name
+
+    def __str__(self):
+        return '%s' % self.__unicode__()
@@ -0,0 +1,118 @@
+"""
+    Premature optimization is the root of all evil, yet we should not pass
+    up our opportunities in that critical 3%.
+
+            - Donald Knuth
+"""
+
+# The Workflow lookups made for every DPN message handled, with the same
+# filters as the code that runs them, and the helpers to check that the
+# database answers each of them from an index. A lookup missing an index
+# scans the whole table, which grows by a few rows for every bag replicated.
+
+from django.db import connection
+
+from dpn_workflows.models import (
+    Workflow, AVAILABLE_REPLY, INIT_QUERY, LOCATION_REPLY, TRANSFER_REPLY,
+    VERIFY_REPLY, SUCCESS, COMPLETE, RECEIVE, REPLICATE
+)
+
+
+def hot_queries(correlation_id, dpn_object_id, node, own_node):
+    """
+    Returns the querysets of the message handling paths.
+
+    :param correlation_id: String of correlation_id of a transaction
+    :param dpn_object_id: String of the bag of the transaction
+    :param node: String of the name of another node
+    :param own_node: String of our node name
+    :return: list of (name, QuerySet)
+    """
+    workflows = Workflow.objects
+    return [
+        # reply handlers and send_available_workflow
+        ('action of a node', workflows.filter(
+            correlation_id=correlation_id, node=node)),
+        ('get_or_create action', workflows.filter(
+            correlation_id=correlation_id, dpn_object_id=dpn_object_id,
+            node=node)),
+        ('transfer reply', workflows.filter(correlation_id=correlation_id)),
+        # choose_and_send_location and _claim_selection
+        ('available nodes', workflows.filter(
+            correlation_id=correlation_id, step=AVAILABLE_REPLY,
+            state=SUCCESS)),
+        ('claim selection', workflows.filter(
+            correlation_id=correlation_id, node=own_node, step=INIT_QUERY)),
+        # choose_node_and_recover
+        ('recovery nodes', workflows.filter(
+            correlation_id=correlation_id, dpn_object_id=dpn_object_id,
+            step=AVAILABLE_REPLY, state=SUCCESS).exclude(node=own_node)),
+        # create_registry_entry
+        ('replicating nodes', workflows.filter(
+            correlation_id=correlation_id, step=VERIFY_REPLY,
+            action=RECEIVE, state=COMPLETE)),
+        # admit_ingests
+        ('own ingest actions', workflows.filter(
+            correlation_id__in=[correlation_id], node=own_node)),
+        ('ingests transferring', workflows.filter(
+            correlation_id__in=[correlation_id], action=REPLICATE,
+            step__in=[LOCATION_REPLY, TRANSFER_REPLY],
+            state=SUCCESS).exclude(node=own_node)),
+        # rank_nodes
+        ('node history', workflows.filter(
+            node__in=[node], action=REPLICATE)),
+    ]
+
+
+def explain(queryset):
+    """
+    Returns the lines of the plan the database chose for a queryset.
+    """
+    sql, params = queryset.query.sql_with_params()
+    prefix = {
+        'sqlite': 'EXPLAIN QUERY PLAN',
+    }.get(connection.vendor, 'EXPLAIN')
+
+    cursor = connection.cursor()
+    try:
+        cursor.execute("%s %s" % (prefix, sql), params)
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+def uses_index(plan, table=None):
+    """
+    Tells if a plan reads a table from an index instead of scanning it.
+
+    :param plan: list of the plan lines returned by explain
+    :param table: String of the table, Workflow by default
+    :return: Boolean
+    """
+    table = table or Workflow._meta.db_table
+    if connection.vendor == 'sqlite':
+        steps = [line['detail'] for line in plan if table in line['detail']]
+        return bool(steps) and all(
+            step.startswith('SEARCH') for step in steps)
+    if connection.vendor == 'mysql':
+        steps = [line for line in plan if line['table'] == table]
+        return bool(steps) and all(
+            line['type'] not in ('ALL', 'index') for line in steps)
+    # postgresql, one column of text
+    text = '\n'.join(str(list(line.values())[0]) for line in plan)
+    return 'Seq Scan on %s' % table not in text
+
+
+def analyze():
+    """
+    Refreshes the statistics the planner chooses indexes from.
+    """
+    statement = {
+        'mysql': 'ANALYZE TABLE %s',
+    }.get(connection.vendor, 'ANALYZE %s') % Workflow._meta.db_table
+    cursor = connection.cursor()
+    try:
+        cursor.execute(statement)
+    finally:
+        cursor.close()
@@ -0,0 +1,151 @@
+"""
+    It's not the size of the dog in the fight, it's the size of the fight in
+    the dog.
+
+            - Mark Twain
+"""
+
+# Ranks the nodes available for a transfer from the history kept in the
+# Workflow table: the throughput of past transfers with each node, how often
+# replications to it succeeded or failed the fixity check, how fast it
+# replies to our init queries and how many replications to it are running.
+# Nodes without history get the average of the others, so new peers are
+# still tried.
+
+import random
+
+from django.conf import settings
+from django.db.models import Avg, Count
+
+from dpn_workflows.models import (
+    SUCCESS, FAILED, REPLICATE, LOCATION_REPLY, TRANSFER_REPLY, VERIFY_REPLY,
+    Workflow
+)
+
+DEFAULT_WEIGHTS = {
+    'throughput': 0.5,
+    'latency': 0.2,
+    'load': 0.3,
+}
+
+
+class NodeStats(object):
+    """
+    History of the transfers with a node.
+    """
+
+    def __init__(self, node):
+        self.node = node
+        self.throughput = None
+        self.reply_latency = None
+        self.succeeded = 0
+        self.failed = 0
+        self.fixity_failed = 0
+        self.in_flight = 0
+
+    @property
+    def success_rate(self):
+        # smoothed so one result does not decide for a node
+        return (self.succeeded + 1.0) / (self.succeeded + self.failed + 2)
+
+    @property
+    def fixity_failure_rate(self):
+        return self.fixity_failed / (self.succeeded + self.fixity_failed + 1.0)
+
+    @property
+    def reliability(self):
+        return self.success_rate * (1 - self.fixity_failure_rate)
+
+    def __repr__(self):
+        return '<NodeStats %s>' % self.node
+
+
+def node_stats(node_list):
+    """
+    Collects the history of the given nodes in three queries.
+
+    :param node_list: List of node names
+    :return: dict of node name to NodeStats
+    """
+    stats = dict((node, NodeStats(node)) for node in node_list)
+    history = Workflow.objects.filter(node__in=stats.keys())
+
+    for row in history.values('node').annotate(
+            throughput=Avg('throughput'), latency=Avg('reply_latency')):
+        stats[row['node']].throughput = row['throughput']
+        stats[row['node']].reply_latency = row['latency']
+
+    replications = history.filter(action=REPLICATE)
+    for row in replications.values('node', 'step', 'state').annotate(
+            total=Count('pk')):
+        node_stat = stats[row['node']]
+        if row['state'] == FAILED:
+            node_stat.failed += row['total']
+            if row['step'] == VERIFY_REPLY:
+                node_stat.fixity_failed += row['total']
+        elif row['state'] == SUCCESS:
+            if row['step'] == VERIFY_REPLY:
+                node_stat.succeeded += row['total']
+            elif row['step'] in (LOCATION_REPLY, TRANSFER_REPLY):
+                node_stat.in_flight += row['total']
+
+    return stats
+
+
+def _relative(values, higher_is_better=True):
+    """
+    Scales values to (0, 1] against the best one. Missing values get the
+    average of the known ones.
+    """
+    known = [v for v in values.values() if v]
+    if not known:
+        return dict((key, 1.0) for key in values)
+
+    average = sum(known) / len(known)
+    best = max(known) if higher_is_better else min(known)
+    scaled = {}
+    for key, value in values.items():
+        value = value or average
+        scaled[key] = value / best if higher_is_better else best / value
+    return scaled
+
+
+def score_nodes(node_list):
+    """
+    Scores the nodes from their history, the higher the better.
+    Reliability multiplies the weighted sum of speed, reply latency and
+    load, configured with DPN_NODE_RANKING_WEIGHTS.
+
+    :param node_list: List of node names
+    :return: dict of node name to Float score
+    """
+    weights = getattr(settings, 'DPN_NODE_RANKING_WEIGHTS', DEFAULT_WEIGHTS)
+    stats = node_stats(node_list)
+
+    speed = _relative(dict((n, s.throughput) for n, s in stats.items()))
+    latency = _relative(dict((n, s.reply_latency) for n, s in stats.items()),
+                        higher_is_better=False)
+
+    scores = {}
+    for node, node_stat in stats.items():
+        load = 1.0 / (1 + node_stat.in_flight)
+        scores[node] = node_stat.reliability * (
+            weights.get('throughput', 0) * speed[node] +
+            weights.get('latency', 0) * latency[node] +
+            weights.get('load', 0) * load
+        )
+    return scores
+
+
+def rank_nodes(node_list):
+    """
+    Sorts the nodes from the best to the worst score, ties are broken at
+    random.
+
+    :param node_list: List of node names
+    :return: List of node names
+    """
+    scores = score_nodes(node_list)
+    ranked = list(set(node_list))
+    random.shuffle(ranked)
+    return sorted(ranked, key=lambda node: scores[node], reverse=True)
@@ -0,0 +1,156 @@
+"""
+    The cheapest, fastest, and most reliable components are those that
+    aren't there.
+
+            - Gordon Bell
+"""
+
+# Stages bags between the local storage directories without copying them
+# when the filesystems allow it. The methods are tried from the cheapest:
+#
+#   hardlink  same inode, only possible within one filesystem
+#   reflink   copy on write clone (FICLONE) on btrfs, xfs and the like
+#   symlink   served through the link, rsync -L and https follow it
+#   sendfile  in kernel copy, no round trip through user space
+#   copy      chunked copy, works everywhere
+#
+# Methods a pair of filesystems does not support are remembered so they are
+# not tried again for every bag, the ones refused for a single file are not.
+
+import os
+import errno
+import shutil
+import logging
+import threading
+
+from django.conf import settings
+
+logger = logging.getLogger('dpnmq.console')
+
+HARDLINK = 'hardlink'
+REFLINK = 'reflink'
+SYMLINK = 'symlink'
+SENDFILE = 'sendfile'
+COPY = 'copy'
+
+# a symlink is only safe when the source outlives the staged file
+DEFAULT_METHODS = (HARDLINK, REFLINK, SENDFILE, COPY)
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024  # 8 MiB
+
+FICLONE = 0x40049409  # _IOW(0x94, 9, int) from linux/fs.h
+
+# errors of a method the pair of filesystems does not support, remembered
+_UNSUPPORTED = set([
+    errno.EXDEV, errno.ENOSYS, errno.ENOTTY, errno.EOPNOTSUPP
+])
+# errors of a method refused for one file only, e.g. a hardlink refused by
+# fs.protected_hardlinks, the next method is tried but nothing is remembered.
+# Any other error is raised.
+_REFUSED = set([errno.EPERM, errno.EINVAL, errno.EBADF])
+
+_lock = threading.Lock()
+_unsupported = {}  # (src st_dev, dst st_dev) -> set of methods
+
+
+def _hardlink(src, dst):
+    os.link(src, dst)
+
+
+def _reflink(src, dst):
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(errno.ENOSYS, "ioctl is not available")
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+    shutil.copystat(src, dst)
+
+
+def _symlink(src, dst):
+    os.symlink(os.path.abspath(src), dst)
+
+
+def _sendfile(src, dst):
+    if not hasattr(os, 'sendfile'):
+        raise OSError(errno.ENOSYS, "sendfile is not available")
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        size = os.fstat(src_file.fileno()).st_size
+        offset = 0
+        while offset < size:
+            sent = os.sendfile(dst_file.fileno(), src_file.fileno(), offset,
+                               min(size - offset, 1024 * 1024 * 1024))
+            if sent == 0:
+                break
+            offset += sent
+    shutil.copystat(src, dst)
+
+
+def _copy(src, dst):
+    chunk_size = getattr(settings, 'DPN_STAGING_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        shutil.copyfileobj(src_file, dst_file, chunk_size)
+    shutil.copystat(src, dst)
+
+
+_METHODS = {
+    HARDLINK: _hardlink,
+    REFLINK: _reflink,
+    SYMLINK: _symlink,
+    SENDFILE: _sendfile,
+    COPY: _copy,
+}
+
+
+def _remove(path):
+    if os.path.lexists(path):
+        os.remove(path)
+
+
+def stage_file(src, dst_dir, methods=None):
+    """
+    Places a file in a directory with the cheapest method available, an
+    existing file with the same name is replaced.
+
+    :param src: String of the path of the file
+    :param dst_dir: String of the directory to stage it in
+    :param methods: List of the methods allowed in the order to try them,
+        defaults to DPN_STAGING_METHODS
+    :return: tuple of (path of the staged file, method used)
+    """
+    methods = methods or getattr(settings, 'DPN_STAGING_METHODS',
+                                 DEFAULT_METHODS)
+    dst = os.path.join(dst_dir, os.path.basename(src))
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        # staged before, or the same path
+        return dst, SYMLINK if os.path.islink(dst) else HARDLINK
+
+    key = (os.stat(src).st_dev, os.stat(dst_dir).st_dev)
+    with _lock:
+        skip = set(_unsupported.get(key, ()))
+
+    error = None
+    for method in methods:
+        if method in skip:
+            continue
+        _remove(dst)
+        try:
+            _METHODS[method](src, dst)
+        except OSError as err:
+            if err.errno in _UNSUPPORTED:
+                logger.info("Staging with %s not supported from %s to %s: %s"
+                            % (method, src, dst_dir, err))
+                with _lock:
+                    _unsupported.setdefault(key, set()).add(method)
+            elif err.errno in _REFUSED:
+                logger.info("Staging %s with %s refused: %s"
+                            % (src, method, err))
+            else:
+                _remove(dst)
+                raise
+            error = err
+            continue
+        return dst, method
+
+    _remove(dst)
+    raise OSError(errno.EOPNOTSUPP,
+                  "No staging method worked for %s: %s" % (src, error))
@@ -0,0 +1,172 @@
+"""
+    Don't count your chickens before they hatch.
+
+            - Aesop
+"""
+
+# Ledger of the replication storage promised to other nodes and the slots
+# of the inbound transfers. Many workers may act at once, each one locks
+# the LedgerLock row before it saves a reservation or slot and checks it
+# against the ones saved before it: the earlier always wins and the later
+# backs off. A slot is a lease renewed while the transfer progresses, the
+# slot of a worker that died lapses like an unused reservation.
+
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from dpn_workflows.models import StorageReservation, LedgerLock
+
+logger = logging.getLogger('dpnmq.console')
+
+
+def active_reservations(now=None):
+    """
+    Returns the reservations not released nor lapsed.
+    """
+    now = now or timezone.now()
+    return StorageReservation.objects.filter(
+        Q(expires_at__isnull=True) | Q(expires_at__gt=now),
+        released_at__isnull=True
+    )
+
+
+def reservation_ttl():
+    """
+    Seconds a reservation waits for the transfer to start, by default two
+    replication-init-query TTLs: ours to reply and the first node's to
+    choose.
+    """
+    default = 2 * settings.DPN_MSG_TTL.get('replication-init-query',
+                                           settings.DPN_TTL)
+    return getattr(settings, 'DPN_RESERVATION_TTL', None) or default
+
+
+def slot_ttl():
+    """
+    Seconds a transfer slot is held without progress.
+    """
+    return getattr(settings, 'DPN_XFER_SLOT_TTL', 15 * 60)
+
+
+def _lock_ledger():
+    # must be called inside a transaction, the lock is held until it ends
+    lock, _ = LedgerLock.objects.get_or_create(name='storage')
+    LedgerLock.objects.select_for_update().get(pk=lock.pk)
+
+
+def reserve_storage(action, size, available):
+    """
+    Reserves replication storage for a bag we are about to acknowledge.
+
+    :param action: Workflow instance of the replication
+    :param size: Integer of bytes of the bag
+    :param available: Integer of free bytes in DPN_REPLICATION_ROOT
+    :return: Boolean True if the space was reserved
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        _lock_ledger()
+        StorageReservation.objects.filter(workflow=action).delete()
+        reservation = StorageReservation.objects.create(
+            workflow=action,
+            node=action.node,
+            size=size,
+            expires_at=now + timedelta(seconds=reservation_ttl())
+        )
+
+        # the bytes already downloaded or preallocated are not free
+        # anymore, only the outstanding part of each reservation counts
+        earlier = active_reservations(now).filter(
+            pk__lte=reservation.pk).select_related('workflow')
+        reserved = sum(r.outstanding for r in earlier)
+        if reserved > available:
+            logger.info("%d bytes reserved of %d available, %s not reserved"
+                        % (reserved - size, available,
+                           action.correlation_id))
+            reservation.delete()
+            return False
+    return True
+
+
+def mark_preallocated(action):
+    """
+    Records that the bag of a replication was allocated on disk, the free
+    space already excludes it and its reservation holds no more bytes.
+
+    :param action: Workflow instance of the replication
+    """
+    StorageReservation.objects.filter(workflow=action).update(
+        preallocated=True)
+
+
+def release_storage(action):
+    """
+    Releases the reservation of a replication that finished or was
+    cancelled.
+
+    :param action: Workflow instance of the replication
+    """
+    StorageReservation.objects.filter(
+        workflow=action, released_at__isnull=True
+    ).update(released_at=timezone.now())
+
+
+def acquire_transfer_slot(action):
+    """
+    Takes a slot to transfer the bag of a replication, at most
+    DPN_XFER_MAX_ACTIVE transfers run at once and DPN_XFER_MAX_PER_NODE of
+    them from the same node. The slot is held until the transfer ends or
+    for DPN_XFER_SLOT_TTL seconds without progress, see renew_transfer_slot.
+
+    :param action: Workflow instance of the replication
+    :return: Boolean True if the transfer can start
+    """
+    max_active = getattr(settings, 'DPN_XFER_MAX_ACTIVE', 4)
+    max_per_node = getattr(settings, 'DPN_XFER_MAX_PER_NODE', 2)
+    now = timezone.now()
+
+    with transaction.atomic():
+        _lock_ledger()
+
+        # transfers we never acknowledged hold no space
+        reservation, _ = StorageReservation.objects.get_or_create(
+            workflow=action, defaults=dict(node=action.node, size=0)
+        )
+        if reservation.transfer_started is None or reservation.released_at:
+            reservation.transfer_started = now
+            reservation.released_at = None
+        reservation.expires_at = now + timedelta(seconds=slot_ttl())
+        reservation.save()
+
+        # transfers that started before this one, ties broken by pk
+        earlier = active_reservations(now).filter(
+            Q(transfer_started__lt=reservation.transfer_started) |
+            Q(transfer_started=reservation.transfer_started,
+              pk__lt=reservation.pk)
+        )
+        if (earlier.count() < max_active and
+                earlier.filter(node=action.node).count() < max_per_node):
+            return True
+
+        # the space stays reserved while waiting for a slot
+        reservation.transfer_started = None
+        reservation.expires_at = now + timedelta(seconds=reservation_ttl())
+        reservation.save()
+    return False
+
+
+def renew_transfer_slot(action):
+    """
+    Extends the lease of the slot of a transfer that is progressing.
+
+    :param action: Workflow instance of the replication
+    """
+    StorageReservation.objects.filter(
+        workflow=action, transfer_started__isnull=False,
+        released_at__isnull=True
+    ).update(expires_at=timezone.now() + timedelta(seconds=slot_ttl()))
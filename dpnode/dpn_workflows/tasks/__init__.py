@@ -2,5 +2,6 @@
 from .outbound import *
 from .inbound import *
 from .registry import *
+from .ingest import *
 
 __author__ = 'swt8w'
\ No newline at end of file
@@ -14,15 +14,19 @@ from django.core.exceptions import ValidationError
 from dpnode.celery import app
 from ..handlers import receive_available_workflow
 from ..utils import available_storage, store_sequence
-from ..utils import validate_sequence, protocol_str2db
-from ..utils import remove_bag, download_bag, generate_fixity
+from ..utils import protocol_str2db
+from ..utils import remove_bag, download_bag
+from ..storage import acquire_transfer_slot, release_storage
 from ..models import SUCCESS, FAILED, CANCELLED, TRANSFER_REPLY, REPLICATE
+from ..models import LOCATION_REPLY, VERIFY_REPLY
 from ..models import COMPLETE, TRANSFER, VERIFY
-from ..models import TRANSFER_STATUS, Workflow
+from ..models import TRANSFER_STATUS, PROTOCOL_DB_VALUES, Workflow
 from ..tasks.outbound import send_transfer_status
 from dpnode.exceptions import DPNWorkflowError
 from django.conf import settings
 from dpnmq.messages import ReplicationAvailableReply, RecoveryTransferStatus
+from dpnmq.messages import from_payload
+from dpnmq.tasks import outbox_transaction
 from dpnmq.utils import str_expire_on, dpn_strftime
 from dpn_registry.models import RegistryEntry
 
@@ -33,40 +37,55 @@ __author__ = 'swt8w'
 ALGORITHM = 'sha256'
 
 
-@app.task()
-def transfer_content(req, action):
+@app.task(bind=True)
+def transfer_content(self, payload, action_id):
     """
     Transfers a bag to the replication directory of the 
-    current node with the given protocol in LocationQuery
+    current node with the given protocol in LocationQuery.
+    A failed transfer is retried DPN_XFER_MAX_RETRIES times, https
+    transfers resume from the last checkpointed segment.
     
-    :param req: ReplicationLocationReply already validated
-    :param action: Current ReceiveFileAction registry
+    :param payload: dict of the ReplicationLocationReply already validated
+    :param action_id: Integer of the pk of the Workflow of the transfer
 
     """
 
+    req = from_payload(payload)
+    action = Workflow.objects.get(pk=action_id)
     correlation_id = req.headers['correlation_id']
     node = req.headers['from']
 
     protocol = req.body['protocol']
     location = req.body['location']
 
+    # downloads wait for a slot so they do not thrash the disk
+    if not acquire_transfer_slot(action):
+        print("Transfer with correlation_id %s waiting for a slot" % (
+        correlation_id))
+        transfer_content.apply_async(
+            (payload, action_id), task_id=self.request.id,
+            countdown=getattr(settings, 'DPN_XFER_SLOT_DELAY', 30))
+        return
+
+    action.protocol = PROTOCOL_DB_VALUES.get(protocol, action.protocol)
+
     print("Transferring the bag...")
     try:
-        filename = download_bag(node, location, protocol)
-
-        print("Download complete. Now calculating fixity value")
-        fixity_value = generate_fixity(filename, ALGORITHM)
+        # fixity is calculated on the fly while the bag is downloaded
+        filename, fixity_value = download_bag(node, location, protocol,
+                                              ALGORITHM, action)
+        print("Download complete.")
 
-        # store the fixity value in DB
-        action.fixity_value = fixity_value
         action.step = TRANSFER_REPLY
         action.action = REPLICATE
         action.state = SUCCESS
         
         action.save()
+        release_storage(action)
 
         # call the task responsible to send the transferring status
-        send_transfer_status.apply_async((req, action))
+        send_transfer_status.apply_async(
+            (payload,), dict(fixity_value=fixity_value))
 
         print('%s has been transferred successfully. Correlation_id: %s' % (
         filename, correlation_id))
@@ -74,28 +93,40 @@ def transfer_content(req, action):
         fixity_value, ALGORITHM))
 
     except OSError as err:
+        max_retries = getattr(settings, 'DPN_XFER_MAX_RETRIES', 3)
+        if self.request.retries < max_retries:
+            print('Transfer with correlation_id %s failed, retrying: %s' % (
+            correlation_id, err))
+            raise self.retry(exc=err, max_retries=max_retries,
+                             countdown=getattr(settings,
+                                               'DPN_XFER_RETRY_DELAY', 60))
+
         action.step = TRANSFER_REPLY
         action.action = REPLICATE
         action.state = FAILED
         action.note = "%s" % err
         action.save()
+        release_storage(action)
 
         # call celery task to send transfer status with the generated error
-        send_transfer_status.apply_async((req, action, False, err))
+        send_transfer_status.apply_async((payload, False, str(err)))
 
         print('ERROR, transfer with correlation_id %s has failed.' % (
         correlation_id))
 
 
 @app.task(bind=True)
-def delete_until_transferred(self, action):
+def delete_until_transferred(self, action_id):
     """
     Removes a bag already transfered when a Cancel Content Replication
     is received as direct message in the local queue
 
-    :param action: Workflow instance corresponding to canceling request
+    :param action_id: Integer of the pk of the Workflow being cancelled
+    :return: Integer of the pk of the Workflow cancelled
     """
 
+    action = Workflow.objects.get(pk=action_id)
+
     if action.step == LOCATION_REPLY:
         result = app.AsyncResult(action.correlation_id)
         if not result.ready():
@@ -115,19 +146,21 @@ def delete_until_transferred(self, action):
 
     action.clean_fields()
     action.save()
+    release_storage(action)
 
-    return action
+    return action.pk
 
 
 @app.task
-def recover_and_check_integrity(req):
+def recover_and_check_integrity(payload):
     """
     Recovers a bag to the replication directory of the 
     current node with the given protocol in RecoveryTransferReply
     
-    :param req: RecoveryTransferReply already validated
+    :param payload: dict of the RecoveryTransferReply already validated
     """
 
+    req = from_payload(payload)
     correlation_id = req.headers['correlation_id']
     node_from = req.headers['from']
     headers = dict(correlation_id=correlation_id)
@@ -164,11 +197,11 @@ def recover_and_check_integrity(req):
 
     try:
         print("Recovering the bag...")
-        filename = download_bag(node_from, req.body['location'],
-                                req.body['protocol'])
-
-        print("Download complete. Now calculating fixity value")
-        fixity_value = generate_fixity(filename, ALGORITHM)
+        filename, fixity_value = download_bag(node_from,
+                                              req.body['location'],
+                                              req.body['protocol'],
+                                              ALGORITHM, action)
+        print("Download complete.")
 
         # check if fixity value match with the stored in database
         if fixity_value == registry_entry.fixity_value:
@@ -194,9 +227,8 @@ def recover_and_check_integrity(req):
         rsp_body = body['nak']
         rsp_body['message_error'] = action.note
 
-    # save action
-    action.save()
-
-    # send transfer status
-    rsp = RecoveryTransferStatus(headers, rsp_body)
-    rsp.send(req.headers['reply_key'])
\ No newline at end of file
+    # save action and send transfer status
+    with outbox_transaction():
+        action.save()
+        rsp = RecoveryTransferStatus(headers, rsp_body)
+        rsp.queue(req.headers['reply_key'])
\ No newline at end of file
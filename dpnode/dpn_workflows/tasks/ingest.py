@@ -0,0 +1,237 @@
+"""
+    Slow and steady wins the race.
+
+            - Aesop
+"""
+
+# Schedules the ingest of the bags deposited in DPN_INGEST_DIR_OUT. Bags are
+# hashed and queued as soon as they are stable and admitted, in the order
+# of DPN_INGEST_ORDER, while the replications running stay under
+# DPN_INGEST_MAX_ACTIVE bags and DPN_INGEST_MAX_BYTES bytes to send. Every
+# bag gets an estimated completion from the bandwidth budget. An ingest
+# still running after DPN_INGEST_MAX_AGE seconds is failed, a node that
+# never replies does not block the queue.
+
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Avg
+from django.utils import timezone
+
+from dpnode.celery import app
+from dpnmq.tasks import outbox_transaction
+from dpn_registry.models import RegistryEntry
+from dpn_registry.utils import create_entry
+from dpn_workflows.models import (
+    PENDING, STARTED, COMPLETE, FAILED, SUCCESS, REPLICATE, INIT_QUERY,
+    LOCATION_REPLY, TRANSFER_REPLY, IngestQueue, Workflow
+)
+from dpn_workflows.tasks.outbound import (
+    initiate_ingest, choose_and_send_location
+)
+
+logger = logging.getLogger('dpnmq.console')
+
+INGEST_ORDERING = {
+    'oldest': ('queued_at', 'pk'),
+    'smallest': ('bag_size', 'queued_at', 'pk'),
+}
+
+
+@app.task
+def ingest_bag(dpn_object_id, bag_path):
+    """
+    Creates the registry entry of a new bag deposited in DPN_INGEST_DIR_OUT,
+    which hashes the whole bag, and queues its ingest.
+
+    :param dpn_object_id: UUID of the DPN object (the bag filename)
+    :param bag_path: String of the path of the bag file
+    :return: Integer of the pk of the IngestQueue created or None if the bag
+        was already ingested
+    """
+    if RegistryEntry.objects.filter(dpn_object_id=dpn_object_id).exists():
+        logger.info("Bag %s is already in the registry. Not ingested!"
+                    % dpn_object_id)
+        return None
+
+    entry = create_entry(dpn_object_id, bag_path)
+    queued = IngestQueue.objects.create(
+        dpn_object_id=dpn_object_id,
+        bag_path=bag_path,
+        bag_size=entry.bag_size
+    )
+
+    logger.info("Registry entry created. %s queued for ingestion."
+                % dpn_object_id)
+    admit_ingests.apply_async()
+    return queued.pk
+
+
+@app.task
+def admit_ingests():
+    """
+    Finishes the ingests whose replications are over, fails the ones
+    running for more than DPN_INGEST_MAX_AGE seconds and starts the pending
+    ones that fit in the limits. It runs when a bag is queued and
+    periodically from celery beat.
+
+    :return: List of the dpn_object_id started
+    """
+    max_active = getattr(settings, 'DPN_INGEST_MAX_ACTIVE', 2)
+    max_bytes = getattr(settings, 'DPN_INGEST_MAX_BYTES', None)
+    ordering = INGEST_ORDERING[getattr(settings, 'DPN_INGEST_ORDER',
+                                       'smallest')]
+    now = timezone.now()
+    started = []
+
+    with outbox_transaction():
+        # locked so concurrent runs do not go over the limits
+        queue = list(IngestQueue.objects.select_for_update().filter(
+            state__in=[PENDING, STARTED]).order_by(*ordering))
+        active = [ingest for ingest in queue if ingest.state == STARTED]
+        pending = [ingest for ingest in queue if ingest.state == PENDING]
+
+        finished = _finished(active, now)
+        IngestQueue.objects.filter(pk__in=finished).update(
+            state=COMPLETE, finished_at=now)
+        active = [ingest for ingest in active if ingest.pk not in finished]
+
+        timed_out = _timed_out(active, now)
+        active = [ingest for ingest in active if ingest not in timed_out]
+
+        in_flight = sum(_bytes_to_send(ingest) for ingest in active)
+        for ingest in list(pending):
+            if len(active) >= max_active:
+                break
+            size = _bytes_to_send(ingest)
+            # a bag over the limit still goes when nothing else runs
+            if max_bytes and active and in_flight + size > max_bytes:
+                break
+
+            _start(ingest, now)
+            active.append(ingest)
+            pending.remove(ingest)
+            in_flight += size
+            started.append(ingest.dpn_object_id)
+
+        _estimate_completion(active, pending, now)
+
+    return started
+
+
+def _bytes_to_send(ingest):
+    return ingest.bag_size * settings.DPN_NUM_XFERS
+
+
+def _start(ingest, now):
+    """
+    Sends the replication-init-query of a queued bag, the nodes are chosen
+    as their replies arrive or once the query expires.
+    """
+    ingest.correlation_id = initiate_ingest(ingest.dpn_object_id,
+                                            ingest.bag_size)
+    ingest.state = STARTED
+    ingest.admitted_at = now
+    ingest.save()
+
+    choose_and_send_location.apply_async(
+        (ingest.correlation_id,), countdown=_query_ttl())
+    logger.info("Started ingestion of %s" % ingest.dpn_object_id)
+
+
+def _query_ttl():
+    return settings.DPN_MSG_TTL.get('replication-init-query', settings.DPN_TTL)
+
+
+def _finished(active, now):
+    """
+    Returns the primary keys of the started ingests with no replication
+    left: their query failed or expired without enough nodes, or every
+    chosen node already replied to the transfer.
+    """
+    by_id = dict((ingest.correlation_id, ingest) for ingest in active)
+    own = dict((row['correlation_id'], row) for row in Workflow.objects.filter(
+        correlation_id__in=list(by_id), node=settings.DPN_NODE_NAME
+    ).values('correlation_id', 'step', 'state'))
+    transferring = set(Workflow.objects.filter(
+        correlation_id__in=list(by_id),
+        action=REPLICATE,
+        step__in=[LOCATION_REPLY, TRANSFER_REPLY],
+        state=SUCCESS
+    ).exclude(node=settings.DPN_NODE_NAME).values_list('correlation_id',
+                                                       flat=True))
+
+    expired = now - timedelta(seconds=_query_ttl())
+    finished = set()
+    for correlation_id, ingest in by_id.items():
+        action = own.get(correlation_id)
+        if action is None or action['state'] == FAILED:
+            finished.add(ingest.pk)
+        elif action['step'] == INIT_QUERY:
+            if ingest.admitted_at < expired:
+                finished.add(ingest.pk)
+        elif correlation_id not in transferring:
+            finished.add(ingest.pk)
+    return finished
+
+
+def _timed_out(active, now):
+    """
+    Fails the started ingests admitted more than DPN_INGEST_MAX_AGE seconds
+    ago together with their replications still in progress.
+
+    :return: List of the IngestQueue failed
+    """
+    max_age = getattr(settings, 'DPN_INGEST_MAX_AGE', 7 * 24 * 60 * 60)
+    limit = now - timedelta(seconds=max_age)
+    timed_out = [ingest for ingest in active if ingest.admitted_at < limit]
+    if not timed_out:
+        return []
+
+    for ingest in timed_out:
+        logger.info("Ingestion of %s timed out, started %s"
+                    % (ingest.dpn_object_id, ingest.admitted_at))
+    IngestQueue.objects.filter(pk__in=[i.pk for i in timed_out]).update(
+        state=FAILED, finished_at=now)
+    Workflow.objects.filter(
+        correlation_id__in=[i.correlation_id for i in timed_out]
+    ).exclude(state__in=[FAILED, COMPLETE]).update(
+        state=FAILED, note="Ingest timed out after %d seconds" % max_age)
+    return timed_out
+
+
+def _bandwidth():
+    """
+    Bytes per second of our uplink, DPN_INGEST_BANDWIDTH or else the average
+    throughput of our past replications.
+    """
+    bandwidth = getattr(settings, 'DPN_INGEST_BANDWIDTH', None)
+    if bandwidth:
+        return bandwidth
+    return Workflow.objects.filter(
+        action=REPLICATE, throughput__isnull=False
+    ).aggregate(Avg('throughput'))['throughput__avg']
+
+
+def _estimate_completion(active, pending, now):
+    """
+    Estimates when the replications of every bag finish if the bandwidth is
+    used by them in order: the running ones first and the pending ones
+    after them in the order they will be started.
+    """
+    bandwidth = _bandwidth()
+    if not bandwidth:
+        return
+
+    # the ones running since an earlier run keep their estimate
+    running = [ingest for ingest in active if ingest.admitted_at != now]
+    waiting = [ingest for ingest in active if ingest.admitted_at == now]
+    cursor = max([ingest.estimated_completion for ingest in running
+                  if ingest.estimated_completion] + [now])
+    for ingest in waiting + pending:
+        cursor += timedelta(seconds=_bytes_to_send(ingest) / bandwidth)
+        if ingest.estimated_completion != cursor:
+            ingest.estimated_completion = cursor
+            IngestQueue.objects.filter(pk=ingest.pk).update(
+                estimated_completion=cursor)
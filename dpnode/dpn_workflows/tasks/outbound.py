@@ -8,13 +8,13 @@
 # DPN Federation.
 
 import os
-import shutil
-import random
+import time
 import logging
 
 from uuid import uuid4
 from datetime import datetime
 from django.conf import settings
+from django.utils import timezone
 
 from dpn_workflows.models import (
     SUCCESS, FAILED, CANCELLED, COMPLETE, REPLICATE, LOCATION_REPLY, VERIFY, 
@@ -23,15 +23,21 @@ from dpn_workflows.models import (
 )
 from dpn_workflows.utils import (
     generate_fixity, choose_nodes, store_sequence, available_storage,
-    validate_sequence, protocol_str2db, update_workflow
+    delete_finished_sequences, protocol_str2db, update_workflow
 )
 from dpnmq.messages import (
     ReplicationVerificationReply, RegistryItemCreate, ReplicationTransferReply, 
     ReplicationInitQuery,ReplicationLocationReply, ReplicationAvailableReply, 
-    RecoveryAvailableReply, RecoveryTransferRequest, RecoveryTransferReply
+    RecoveryAvailableReply, RecoveryTransferRequest, RecoveryTransferReply,
+    from_payload
 )
 from dpnode.celery import app
+from dpnmq.tasks import outbox_transaction
 from dpn_workflows.handlers import receive_available_workflow
+from dpn_workflows.storage import reserve_storage
+from dpn_workflows.staging import (
+    stage_file, HARDLINK, REFLINK, SYMLINK, SENDFILE, COPY
+)
 from django.core.exceptions import ValidationError
 from dpnmq.utils import str_expire_on, dpn_strftime
 from dpn_registry.models import Node, RegistryEntry
@@ -40,6 +46,10 @@ from dpnode.exceptions import DPNOutboundError, DPNWorkflowError
 
 logger = logging.getLogger('dpnmq.console')
 
+# the bags in DPN_REPLICATION_ROOT outlive the recovery, so the outgoing
+# copy can be a symlink
+RECOVERY_STAGING_METHODS = (HARDLINK, REFLINK, SYMLINK, SENDFILE, COPY)
+
 @app.task
 def initiate_ingest(dpn_object_id, size):
     """
@@ -87,28 +97,30 @@ def initiate_ingest(dpn_object_id, size):
     _validate_sequence(correlation_id, node, sequence)
 
     try:
-        msg = ReplicationInitQuery(headers, body)
-        msg.send(settings.DPN_BROADCAST_KEY)
-        action.state = SUCCESS
+        with outbox_transaction():
+            msg = ReplicationInitQuery(headers, body)
+            msg.queue(settings.DPN_BROADCAST_KEY)
+            action.state = SUCCESS
+            action.save()
     except Exception as err:
         action.state = FAILED
         action.note = "%s" % err
         logger.error(err)
-
-    action.save()
+        action.save()
 
     return action.correlation_id
 
 
 @app.task()
-def respond_to_replication_query(init_request):
+def respond_to_replication_query(payload):
     """
     Verifies if current node is available and has enough storage 
     to replicate bags and sends a ReplicationAvailableReply.
 
-    :param init_request: ReplicationInitQuery already validated
+    :param payload: dict of the ReplicationInitQuery already validated
     """
     
+    init_request = from_payload(payload)
     correlation_id = init_request.headers['correlation_id']
     node = init_request.headers['from']
     dpn_object_id = init_request.body['dpn_object_id']
@@ -141,10 +153,15 @@ def respond_to_replication_query(init_request):
                 correlation_id=correlation_id,
                 dpn_object_id=dpn_object_id
             )
-            body = {
-                'message_att': 'ack',
-                'protocol': settings.DPN_DEFAULT_XFER_PROTOCOL
-            }
+            # the free space may already be promised to other nodes
+            if reserve_storage(action, bag_size, avail_storage):
+                body = {
+                    'message_att': 'ack',
+                    'protocol': settings.DPN_DEFAULT_XFER_PROTOCOL
+                }
+            else:
+                action.state = FAILED
+                action.note = "The storage is reserved for other transfers"
         except ValidationError as err:
             logger.info('ValidationError: %s' % err)
             pass  # Record not created nak sent
@@ -152,17 +169,22 @@ def respond_to_replication_query(init_request):
             logger.info('DPN Workflow Error: %s' % err)
             pass  # Record not created, nak sent
 
-    rsp = ReplicationAvailableReply(headers, body)
-    rsp.send(init_request.headers['reply_key'])
-    
-    # We update the action to show that the message has been sent
-    update_workflow(action, AVAILABLE_REPLY, REPLICATE)
+    with outbox_transaction():
+        rsp = ReplicationAvailableReply(headers, body)
+        rsp.queue(init_request.headers['reply_key'])
+
+        # We update the action to show that the message has been sent
+        update_workflow(action, AVAILABLE_REPLY, REPLICATE)
 
 @app.task
 def choose_and_send_location(correlation_id):
     """
     Chooses the appropiates nodes to replicate with and 
-    sends the ContentLocationQuery to these nodes
+    sends the ContentLocationQuery to these nodes.
+
+    It runs for every available reply acknowledged and once more when the
+    replication-init-query expires, the first run that finds enough nodes
+    makes the choice and the rest do nothing.
 
     :param correlation_id: UUID of the IngestAction
     """
@@ -181,53 +203,90 @@ def choose_and_send_location(correlation_id):
         step=AVAILABLE_REPLY, 
         state=SUCCESS
     )
-    
-    if file_actions.count() >= settings.DPN_NUM_XFERS:
-        selected_nodes = choose_nodes(
-            list(file_actions.values_list('node', flat=True)))
-
-        for action in file_actions:
-            if action.node in selected_nodes:
-                _validate_sequence(correlation_id, action.node, sequence)
-                protocol = action.get_protocol_display()
-                base_location = settings.DPN_BASE_LOCATION[protocol]
-                bag_id = action.dpn_object_id
+    available_nodes = list(file_actions.values_list('node', flat=True))
 
-                body = {
-                    'protocol': protocol,
-                    'location': '{0}{1}.{2}'.format(base_location, bag_id,
-                        settings.DPN_BAGS_FILE_EXT)
-                }
-                rsp = ReplicationLocationReply(headers, body)
-                rsp.send(action.reply_key)
+    if len(available_nodes) < settings.DPN_NUM_XFERS:
+        logger.info("%d of %d nodes available for %s, waiting for more"
+                    % (len(available_nodes), settings.DPN_NUM_XFERS,
+                       correlation_id))
+        return
 
-                # QUESTION: Doesn't matter that we are no longer marking a 
-                # node as chosen to transfer
-                # mark action as chosen to transfer
-                # @TODO Delete action.chosen_to_transfer = True
-                action.location = body['location']
+    with outbox_transaction():
+        if not _claim_selection(correlation_id, LOCATION_REPLY):
+            return
 
-                # mark file action as TRANSFER
-                update_workflow(action, LOCATION_REPLY, REPLICATE)
+        selected_nodes = choose_nodes(available_nodes)
+        for action in file_actions:
+            if action.node in selected_nodes:
+                _send_location(action, headers, sequence)
             else:
                 action.state = CANCELLED
                 action.note = "The node was not selected for transfer"
                 action.save()
+
+
+def _claim_selection(correlation_id, step):
+    """
+    Moves the action of our own node past the init query. Only one of the
+    concurrent callers gets the claim, the one that chooses the nodes.
+
+    :param correlation_id: String of correlation_id of transaction
+    :param step: String of the workflow step our action moves to
+    :return: Boolean True if the claim was taken
+    """
+    return Workflow.objects.filter(
+        correlation_id=correlation_id,
+        node=settings.DPN_NODE_NAME,
+        step=INIT_QUERY
+    ).update(step=step) == 1
+
+
+def _send_location(action, headers, sequence):
+    """
+    Queues the ReplicationLocationReply for a node selected to transfer.
+    """
+    _validate_sequence(action.correlation_id, action.node, sequence)
+    protocol = action.get_protocol_display()
+    base_location = settings.DPN_BASE_LOCATION[protocol]
+    bag_id = action.dpn_object_id
+
+    body = {
+        'protocol': protocol,
+        'location': '{0}{1}.{2}'.format(base_location, bag_id,
+            settings.DPN_BAGS_FILE_EXT)
+    }
+    rsp = ReplicationLocationReply(headers, body)
+    rsp.queue(action.reply_key)
+
+    # QUESTION: Doesn't matter that we are no longer marking a 
+    # node as chosen to transfer
+    # mark action as chosen to transfer
+    # @TODO Delete action.chosen_to_transfer = True
+    action.location = body['location']
+
+    # the transfer starts from our side once the node knows
+    # the location, it ends when its transfer reply arrives
+    action.transfer_started = timezone.now()
+
+    # mark file action as TRANSFER
+    update_workflow(action, LOCATION_REPLY, REPLICATE)
                 
 
 # transfer has finished, that means you boy are ready to notify
 # first node the bag has been already replicated
 @app.task
-def send_transfer_status(req, action, success=True, err=''):
+def send_transfer_status(payload, success=True, err='', fixity_value=None):
     """
     Sends ReplicationTransferReply to original node 
     upon completion or failure
     
-    :param req: Original ReplicationLocationReply already performed
-    :param action: Original ReceiveFileAction registry
+    :param payload: dict of the original ReplicationLocationReply
+    :param success: Boolean True if the bag was transferred
+    :param err: String of the error of a failed transfer
+    :param fixity_value: String of the fixity of the bag transferred
     """
+    req = from_payload(payload)
     correlation_id = req.headers['correlation_id']
-    fixity = action.fixity_value
 
     headers = {
         'correlation_id': correlation_id,
@@ -239,7 +298,7 @@ def send_transfer_status(req, action, success=True, err=''):
             'message_name': 'replication-transfer-reply',
             'message_att': 'ack',
             "fixity_algorithm": "sha256",
-            "fixity_value": fixity
+            "fixity_value": fixity_value
         }
     else:
         body = {
@@ -248,43 +307,49 @@ def send_transfer_status(req, action, success=True, err=''):
             'message_error': str(err)
         }
 
-    msg = ReplicationTransferReply(headers, body)
-    msg.send(req.headers['reply_key'])
+    with outbox_transaction():
+        msg = ReplicationTransferReply(headers, body)
+        msg.queue(req.headers['reply_key'])
 
 
 @app.task
-def broadcast_item_creation(entry=None):
+def broadcast_item_creation(dpn_object_id=None):
     """
     Sends a RegistryEntryCreation message to the DPN broadcast queue
     to other nodes update their local registries
 
-    :param entry: RegistryEntry instance or None
+    :param dpn_object_id: String of the dpn_object_id of the RegistryEntry
+        or None
     """
 
-    if not entry:
+    if not dpn_object_id:
         return None
 
+    entry = RegistryEntry.objects.get(dpn_object_id=dpn_object_id)
+
     headers = {
         'correlation_id': str(uuid4()),
         'sequence': 0,
     }
 
     body = entry.to_message_dict()
-    reg = RegistryItemCreate(headers, body)
-    reg.send(settings.DPN_BROADCAST_KEY)
+    with outbox_transaction():
+        reg = RegistryItemCreate(headers, body)
+        reg.queue(settings.DPN_BROADCAST_KEY)
 
 
 @app.task
-def verify_fixity_and_reply(req):
+def verify_fixity_and_reply(payload):
     """
     Generates fixity value for local bag and compare it 
     with fixity value of the transferred bag. Sends a Replication
     Verification Reply with ack or nak or retry according to 
     the fixities comparisons
 
-    :param req: ReplicationTransferReply already validated
+    :param payload: dict of the ReplicationTransferReply already validated
     """
 
+    req = from_payload(payload)
     correlation_id = req.headers['correlation_id']
     node = req.headers['from']
     
@@ -320,15 +385,21 @@ def verify_fixity_and_reply(req):
         settings.DPN_INGEST_DIR_OUT,
         os.path.basename(action.location)
     )
+    hash_start = time.time()
     local_fixity = generate_fixity(local_bag_path)
+    hash_elapsed = time.time() - hash_start
+
+    if action.transfer_started:
+        elapsed = (timezone.now() - action.transfer_started).total_seconds()
+        action.record_transfer(os.path.getsize(local_bag_path), elapsed,
+                               hash_elapsed)
 
     if local_fixity == req.body['fixity_value']:
         message_att = 'ack'
 
         # save SendFileAction as complete and success
         action.state = SUCCESS
-        update_workflow(action, TRANSFER_REPLY, RECEIVE)
-        
+
         print("Fixity value is correct. Correlation_id: %s" % correlation_id)
         print("Creating registry entry...")
 
@@ -340,25 +411,28 @@ def verify_fixity_and_reply(req):
         action.action = RECEIVE
         action.state = FAILED
         action.note = "Wrong fixity value of transferred bag. Sending nak verification reply"
-        action.save()
 
     # TODO: under which condition should we retry the transfer?
     # retry = {
     # 'message_att': 'retry',
     # }
 
-    body = dict(message_att=message_att)
-    rsp = ReplicationVerificationReply(headers, body)
-    rsp.send(req.headers['reply_key'])
-    
-    update_workflow(action, VERIFY_REPLY, REPLICATE)
+    # the action is saved with the reply
+    with outbox_transaction():
+        body = dict(message_att=message_att)
+        rsp = ReplicationVerificationReply(headers, body)
+        rsp.queue(req.headers['reply_key'])
+
+        update_workflow(action, VERIFY_REPLY, REPLICATE)
     
-    # make sure to copy the bag to the settings.DPN_REPLICATION_ROOT folder
+    # make sure to stage the bag in the settings.DPN_REPLICATION_ROOT folder
     # to have it accesible in case of recovery request
     ingested_bag = os.path.join(settings.DPN_REPLICATION_ROOT,
                                 os.path.basename(action.location))
     if not os.path.isfile(ingested_bag):
-        shutil.copy2(local_bag_path, settings.DPN_REPLICATION_ROOT)
+        ingested_bag, action.staging_method = stage_file(
+            local_bag_path, settings.DPN_REPLICATION_ROOT)
+        action.save(update_fields=['staging_method'])
 
     # This task will create or update a registry entry
     # for a given correlation_id. It is also linked with
@@ -371,14 +445,15 @@ def verify_fixity_and_reply(req):
 
 # Recovery Workflow Tasks
 @app.task
-def respond_to_recovery_query(init_request):
+def respond_to_recovery_query(payload):
     """
     Verifies if current node is a first node and the bag is in 
     the node and sends a RecoveryAvailableReply.
 
-    :param init_request: RecoveryInitQuery already validated
+    :param payload: dict of the RecoveryInitQuery already validated
     """
 
+    init_request = from_payload(payload)
     correlation_id = init_request.headers['correlation_id']
     node_from = init_request.headers['from']
     dpn_object_id = init_request.body['dpn_object_id']
@@ -439,22 +514,22 @@ def respond_to_recovery_query(init_request):
     action.note = note
     action.state = SUCCESS if body["message_att"] == "ack" else FAILED
 
-    # Sends the reply
-    rsp = RecoveryAvailableReply(headers, body)
-    rsp.send(reply_key)
-
-    # Save the action in DB
-    action.save()
+    # Sends the reply with the action saved in DB
+    with outbox_transaction():
+        rsp = RecoveryAvailableReply(headers, body)
+        rsp.queue(reply_key)
+        action.save()
 
 
 @app.task
-def respond_to_recovery_transfer(transfer_request):
+def respond_to_recovery_transfer(payload):
     """
     Moves the requested bag from the receive storage to the outgoing 
     storage and sends a RecoveryTransferReply.
 
-    :param init_request: RecoveryTransferRequest already validated
+    :param payload: dict of the RecoveryTransferRequest already validated
     """
+    transfer_request = from_payload(payload)
     correlation_id = transfer_request.headers['correlation_id']
     node_from = transfer_request.headers['from']
     protocol = transfer_request.body['protocol']
@@ -496,8 +571,12 @@ def respond_to_recovery_transfer(transfer_request):
 
             try:
 
-                # Copy the bag from the receiving storage to the outgoing storage
-                shutil.copy2(replicated_bag, settings.DPN_RECOVERY_DIR_OUT)
+                # Stage the bag from the receiving storage in the outgoing
+                # storage, the outgoing one may just link to it
+                staged, action.staging_method = stage_file(
+                    replicated_bag, settings.DPN_RECOVERY_DIR_OUT,
+                    getattr(settings, 'DPN_RECOVERY_STAGING_METHODS',
+                            RECOVERY_STAGING_METHODS))
 
                 # Fill the message's body
                 body = {
@@ -509,9 +588,12 @@ def respond_to_recovery_transfer(transfer_request):
                     )
                 }
 
-                # Sends the reply
-                rsp = RecoveryTransferReply(headers, body)
-                rsp.send(reply_key)
+                # Sends the reply with the action saved in DB
+                with outbox_transaction():
+                    rsp = RecoveryTransferReply(headers, body)
+                    rsp.queue(reply_key)
+                    action.state = SUCCESS
+                    action.save()
 
             except Exception as e:
                 action.note = e
@@ -529,68 +611,82 @@ def respond_to_recovery_transfer(transfer_request):
         action.state = FAILED
         action.save()
         raise DPNOutboundError(note)
-    else:
-        action.state = SUCCESS
-
-    # Save the action in DB
-    action.save()
 
 
 @app.task
-def choose_node_and_recover(correlation_id, dpn_obj_id, action):
+def choose_node_and_recover(correlation_id, dpn_obj_id):
     """
     Choose a node to replicate with and sends a Recovery Transfer Request
     to that node.
 
+    It runs for every recovery available reply and once more when the
+    recovery-init-query expires, only the first run makes the choice.
+
     :param correlation_id: String of correlation_id of transaction
     :param dpn_obj_id: String with dpn_object_id to be recovered
-    :param action: Workflow instance to be updated with right step and state
     """
 
     available_actions = Workflow.objects.filter(
         correlation_id=correlation_id,
-        dpn_object_id=dpn_obj_id
+        dpn_object_id=dpn_obj_id,
+        step=AVAILABLE_REPLY,
+        state=SUCCESS
     ).exclude(node=settings.DPN_NODE_NAME)
 
-    # update step in own node workflow action
-    action.step = TRANSFER_REQUEST
+    with outbox_transaction():
+        if not _claim_selection(correlation_id, TRANSFER_REQUEST):
+            return
+
+        # own node workflow action, already moved to TRANSFER_REQUEST
+        action = Workflow.objects.get(
+            correlation_id=correlation_id,
+            node=settings.DPN_NODE_NAME
+        )
 
-    if available_actions.count() > 0:
-        # choose a node randomly 
-        selected = random.choice(available_actions)
+        if available_actions.count() > 0:
+            # choose the best ranked node
+            nodes = list(available_actions.values_list('node', flat=True))
+            selected = available_actions.get(node=choose_nodes(nodes, 1)[0])
 
-        # update workflow action to all nodes but selected node
-        for node_action in available_actions.exclude(pk=selected.pk):
-            node_action.state = CANCELLED
-            node_action.note = "Node %s was chosen to recover" % selected.node
-            node_action.save()
+            # update workflow action to all nodes but selected node
+            for node_action in available_actions.exclude(pk=selected.pk):
+                node_action.state = CANCELLED
+                node_action.note = "Node %s was chosen to recover" % selected.node
+                node_action.save()
 
-        # sending Recovery Transfer Request to selected node
-        headers = dict(correlation_id=correlation_id)
-        body = {
-            "protocol": settings.DPN_DEFAULT_XFER_PROTOCOL,
-            "message_att": "ack"
-        }
+            # sending Recovery Transfer Request to selected node
+            headers = dict(correlation_id=correlation_id)
+            body = {
+                "protocol": settings.DPN_DEFAULT_XFER_PROTOCOL,
+                "message_att": "ack"
+            }
 
-        request = RecoveryTransferRequest(headers, body)
-        request.send(selected.reply_key)
+            request = RecoveryTransferRequest(headers, body)
+            request.queue(selected.reply_key)
 
-        # update own node action
-        action.state = SUCCESS
-    else:
-        action.state = FAILED
-        action.note = "There is no nodes to recover from"
+            # update own node action
+            action.state = SUCCESS
+        else:
+            action.state = FAILED
+            action.note = "There is no nodes to recover from"
 
-    # save own node workflow action
-    action.save()
+        # save own node workflow action
+        action.save()
 
 def _validate_sequence(correlation_id, node_from, sequence):
-    sequence_info = store_sequence(
-        correlation_id,
-        node_from,
-        sequence
-    )
-    validate_sequence(sequence_info)
+    store_sequence(correlation_id, node_from, sequence)
+
+
+@app.task
+def cleanup_sequences():
+    """
+    Deletes the sequence numbers of the finished transactions.
+
+    :return: Integer of sequences deleted
+    """
+    deleted = delete_finished_sequences()
+    logger.info("Deleted the sequences of %d finished transactions" % deleted)
+    return deleted
 
 def _get_headers(correlation_id, sequence):
     return {
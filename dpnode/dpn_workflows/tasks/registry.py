@@ -7,25 +7,39 @@
 """
 
 import os
+import time
 import logging
 from datetime import datetime
-from itertools import groupby
 
 from dpnode.celery import app
 from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q, Max
+from django.utils import timezone
 from dpn_workflows.models import (
     Workflow, SUCCESS, VERIFY_REPLY, RECEIVE, IngestAction, COMPLETE
 )
 from dpn_workflows.utils import generate_fixity
-from dpn_registry.forms import RegistryEntryForm
-from dpn_registry.models import RegistryEntry, Node, NodeEntry
+from dpn_registry.models import (
+    RegistryEntry, Node, NodeEntry, RegistrySyncReply
+)
+from dpn_registry.utils import (
+    iter_chunks, bulk_save_node_entries, recompute_registry_stats
+)
 from dpnmq.utils import dpn_strptime
-from dpnmq.messages import RegistryListDateRangeReply
-from dpnmq.forms import NodeEntryForm
+from dpnmq.messages import RegistryListDateRangeReply, from_payload
 
 
 logger = logging.getLogger('dpnmq.console')
 
+REGISTRY_PREFETCH = ['replicating_nodes', 'brightening_objects',
+                     'rights_objects']
+
+
+def _utc(date_string):
+    # dates in DPN messages are always UTC
+    return timezone.make_aware(dpn_strptime(date_string), timezone.utc)
+
 
 @app.task
 def create_registry_entry(correlation_id):
@@ -34,6 +48,7 @@ def create_registry_entry(correlation_id):
     process is completed
 
     :param correlation_id: String of the correlation_id used in IngestAction
+    :return: String of the dpn_object_id of the entry or None
 
     """
     
@@ -108,7 +123,7 @@ def create_registry_entry(correlation_id):
         logger.info(
             "Registry entry successfully %s for transaction with correlation_id: %s" %
             (_status, correlation_id))
-        return registry_entry
+        return registry_entry.dpn_object_id
     else:
         logger.info(
             "Registry entry not created. The bag was not transferred by any node.")
@@ -116,125 +131,297 @@ def create_registry_entry(correlation_id):
 
 
 @app.task
-def reply_with_item_list(req):
+def reply_with_item_list(payload):
     """
-    Generates an item list by date range and sends
-    it as reply to requesting node
+    Generates a list of the items modified in a date range and sends it
+    as reply to requesting node. Entries are read and sent in parts of
+    DPN_REGISTRY_SYNC_CHUNK entries so neither the list nor the
+    messages grow with the size of the registry.
 
-    :param req: RegistryDateRangeSync already validated
+    :param payload: dict of the RegistryDateRangeSync already validated
 
     """
-    unpack_date = lambda x: [dpn_strptime(i) for i in x]
+    req = from_payload(payload)
     entries = RegistryEntry.objects.filter(
-        creation_date__range=unpack_date(req.body['date_range'])
+        last_modified_date__range=[_utc(d) for d in req.body['date_range']]
     )
+    chunk_size = getattr(settings, 'DPN_REGISTRY_SYNC_CHUNK', 500)
 
     headers = {
         'correlation_id': req.headers['correlation_id'],
         'sequence': 1
     }
 
-    body = {
-        'date_range': req.body['date_range'],
-        'reg_sync_list': [e.to_message_dict() for e in entries]
-    }
+    def _send_part(chunk, part, last_part):
+        body = {
+            'date_range': req.body['date_range'],
+            'reg_sync_list': [e.to_message_dict() for e in chunk],
+            'part': part,
+            'last_part': last_part,
+        }
+        rsp = RegistryListDateRangeReply(headers, body)
+        rsp.send(req.headers['reply_key'])
+
+    # the next chunk is read before sending one to know which is the last
+    chunks = iter_chunks(entries, chunk_size, REGISTRY_PREFETCH)
+    chunk, part = next(chunks, []), 1
+    for next_chunk in chunks:
+        _send_part(chunk, part, False)
+        chunk, part = next_chunk, part + 1
+    _send_part(chunk, part, True)
 
-    rsp = RegistryListDateRangeReply(headers, body)
-    rsp.send(req.headers['reply_key'])
+    logger.info("Sent registry list with correlation_id %s in %d part(s)"
+                % (req.headers['correlation_id'], part))
 
 
 @app.task
-def save_registries_from(node, req):
+def save_registries_from(node, payload):
     """
-    Saves registry entries from other nodes to be compared
-    with local registries later
+    Saves registry entries from other nodes in bulk to be compared
+    with local registries later. Lists sent in several parts are
+    saved as each part arrives and tracked until all of them are in.
 
     :param node: String name of neighbor node
-    :param req: RegistryListDateRangeReply already validated
+    :param payload: dict of the RegistryListDateRangeReply already validated
+    :return: Boolean True once every part of the list is saved
 
     """
+    req = from_payload(payload)
 
     entry_list = req.body['reg_sync_list']
     node, created = Node.objects.get_or_create(name=node)
+    part = req.body.get('part') or 1
+    last_part = req.body.get('last_part', 'part' not in req.body)
+
+    with transaction.atomic():
+        sync, created = RegistrySyncReply.objects.select_for_update(
+        ).get_or_create(correlation_id=req.headers['correlation_id'],
+                        node=node)
+        if sync.synced_until is None:
+            sync.synced_until = _utc(req.body['date_range'][1])
+        if not sync.add_part(part, last_part, len(entry_list)):
+            logger.info("Part %d of registry list from %s already saved"
+                        % (part, node.name))
+            return sync.is_complete()
+        sync.save()
+
+        saved, errors = bulk_save_node_entries(node, entry_list)
+        for error in errors:
+            print("Unable to create node registry entry: %s" % error)
+
+    if sync.is_complete():
+        logger.info("Registry list from %s complete: %d entries in %d part(s)"
+                    % (node.name, sync.entries, sync.parts_total))
+    return sync.is_complete()
+
+
+def _registry_fields():
+    # fields synced from the first node, state is ours and dpn_object_id
+    # is the key of the comparison
+    return [f.attname for f in RegistryEntry._meta.fields
+            if f.name not in ('dpn_object_id', 'state')]
+
+
+def _m2m_values(model, object_ids, field_name, key='dpn_object_id'):
+    """
+    Returns a dict of object key -> set of related values of a M2M field
+    for a list of objects, reading the through table in one query.
+    Related entries are returned by dpn_object_id, nodes by name.
+    """
+    field = model._meta.get_field(field_name)
+    through = field.rel.through
+    src, dst = field.m2m_column_name(), field.m2m_reverse_name()
+    if field.rel.to == Node:
+        dst_value = dst
+    else:
+        dst_value = '%s__dpn_object_id' % dst[:-len('_id')]
 
-    for entry_dict in entry_list:
-        entry_dict.update({'node': node.pk})
-
-        # NOTE prepopulating now but this should be moved to validating node
-        # profiles once DPN approves that in the spec.
-        for name in entry_dict["replicating_node_names"]:
-            Node.objects.get_or_create(**{"name": name})
+    values = dict((oid, set()) for oid in object_ids)
+    rows = through.objects.filter(**{'%s__in' % src: object_ids})
+    for oid, value in rows.values_list(src, dst_value):
+        values[oid].add(value)
+    return values
 
-        node_entry = NodeEntryForm(data=entry_dict)
-        if node_entry.is_valid():
-            node_entry.save()
-        else:
-            print(
-                "Unable to create node registry entry: %s" % node_entry.errors)
 
+def _set_registry_m2m(field_name, values):
+    """
+    Replaces the related objects of the given registry entries.
 
-@app.task
-def solve_registry_conflicts():
+    :param field_name: String name of the M2M field of RegistryEntry
+    :param values: dict of dpn_object_id -> set of related keys
     """
-    Reads registry entries of other nodes stored in local 
-    to check and solves conflicts with own node registry entries
+    field = RegistryEntry._meta.get_field(field_name)
+    through = field.rel.through
+    src, dst = field.m2m_column_name(), field.m2m_reverse_name()
+    ids = list(values.keys())
+
+    through.objects.filter(**{'%s__in' % src: ids}).delete()
+    rows = set((oid, rel) for oid, related in values.items()
+               for rel in related)
+    if field.rel.to != Node:
+        # related entries must exist locally
+        existing = set(RegistryEntry.objects.filter(
+            pk__in=[rel for oid, rel in rows]).values_list('pk', flat=True))
+        rows = set((oid, rel) for oid, rel in rows if rel in existing)
+        if field.rel.symmetrical:
+            through.objects.filter(**{'%s__in' % dst: ids}).delete()
+            rows |= set((rel, oid) for oid, rel in rows)
+    through.objects.bulk_create(
+        [through(**{src: oid, dst: rel}) for oid, rel in rows])
+
+
+def _advance_sync_dates(syncs):
     """
+    Moves the last_sync_date of every node that sent its whole list up to
+    the end of the date range of the list. Nodes with parts missing keep
+    their date and their sync stays open until the rest arrives.
 
-    local_entries = RegistryEntry.objects.all()
+    :param syncs: List of the RegistrySyncReply not reconciled yet
+    :return: set of the names of the nodes whose lists are all complete
+    """
+    complete = [sync for sync in syncs if sync.is_complete()]
+    until = {}
+    for sync in complete:
+        if sync.synced_until:
+            until[sync.node_id] = max(sync.synced_until,
+                                      until.get(sync.node_id, sync.synced_until))
+    for name, date in until.items():
+        # never moved backwards by an older range
+        Node.objects.filter(pk=name).filter(
+            Q(last_sync_date__isnull=True) | Q(last_sync_date__lt=date)
+        ).update(last_sync_date=date)
+    RegistrySyncReply.objects.filter(
+        pk__in=[sync.pk for sync in complete]).update(reconciled=True)
+
+    incomplete = set(sync.node_id for sync in syncs if not sync.is_complete())
+    return set(sync.node_id for sync in complete) - incomplete
 
-    # get entries group by dpn_object_id and check if the entries are equal
-    entries_query = NodeEntry.objects.all().order_by('dpn_object_id')
-    grouped_entries = groupby(entries_query, lambda e: e.dpn_object_id)
 
-    def _first_node_entry(entries, node_name):
-        for entry in entries:
-            if entry.node.name == node_name:
-                return entry
-        return None
+@app.task
+def solve_registry_conflicts():
+    """
+    Reads registry entries of other nodes stored in local 
+    to check and solves conflicts with own node registry entries.
 
-    for dpn_obj_id, entries in grouped_entries:
-        entries_list = list(entries)
-        first_node_name = entries_list[0].first_node_name
-        first_node_entry = _first_node_entry(entries_list, first_node_name)
+    The entry sent by the first node of an object is always the right one.
+    First node entries are read in pages together with the matching local
+    entries and their relations, compared as plain values and applied in
+    bulk in one transaction per page. Afterwards the last_sync_date of
+    the nodes that sent their whole list is advanced, their entries are
+    removed and the registry stats are recomputed.
 
-        # if I'm the first node of the entry, do nothing
-        if first_node_name == settings.DPN_NODE_NAME:
-            # NOTE: should we verify if entry exist in local registry?
-            continue  # do nothing
+    :return: dict with the number of entries compared, updated, inserted
+        and skipped and the seconds it took
+    """
+    start = time.time()
+    fields = _registry_fields()
+    m2m_fields = [f.name for f in RegistryEntry._meta.many_to_many]
+    chunk_size = getattr(settings, 'DPN_REGISTRY_SYNC_CHUNK', 500)
+    stats = dict(compared=0, updated=0, inserted=0, skipped=0)
+
+    # the lists received up to now, parts arriving during the run are
+    # left for the next one
+    syncs = list(RegistrySyncReply.objects.filter(reconciled=False))
+    last_entry = NodeEntry.objects.aggregate(Max('pk'))['pk__max'] or 0
+    received = NodeEntry.objects.filter(pk__lte=last_entry)
+
+    # entries sent by their first node, unless we are the first node
+    first_node_entries = received.filter(
+        node__name=F('first_node_name')
+    ).exclude(first_node_name=settings.DPN_NODE_NAME)
+
+    last_pk = 0
+    while True:
+        page = list(first_node_entries.filter(pk__gt=last_pk).order_by(
+            'pk').values('pk', 'dpn_object_id', *fields)[:chunk_size])
+        if not page:
+            break
+        last_pk = page[-1]['pk']
+
+        remote_ids = [e['pk'] for e in page]
+        object_ids = [e['dpn_object_id'] for e in page]
+        remote_m2m = dict(
+            (name, _m2m_values(NodeEntry, remote_ids, name))
+            for name in m2m_fields)
+        local = dict(
+            (e['dpn_object_id'], e) for e in RegistryEntry.objects.filter(
+                pk__in=object_ids).values('dpn_object_id', *fields))
+        local_m2m = dict(
+            (name, _m2m_values(RegistryEntry, list(local.keys()), name))
+            for name in m2m_fields)
+
+        inserts = []
+        updates = {}
+        m2m_updates = dict((name, {}) for name in m2m_fields)
+        for entry in page:
+            oid = entry['dpn_object_id']
+            data = dict((f, entry[f]) for f in fields)
+            stats['compared'] += 1
+
+            if oid not in local:
+                inserts.append(RegistryEntry(dpn_object_id=oid, **data))
+                for name in m2m_fields:
+                    m2m_updates[name][oid] = remote_m2m[name][entry['pk']]
+                continue
+
+            changed = dict((f, v) for f, v in data.items()
+                           if local[oid][f] != v)
+            m2m_changed = False
+            for name in m2m_fields:
+                related = remote_m2m[name][entry['pk']]
+                if local_m2m[name][oid] != related:
+                    m2m_updates[name][oid] = related
+                    m2m_changed = True
+            if changed or m2m_changed:
+                updates[oid] = changed
+
+        with transaction.atomic():
+            RegistryEntry.objects.bulk_create(inserts)
+            # there is no bulk update in this Django version, only the
+            # changed columns of the changed rows are written
+            for oid, changed in updates.items():
+                if changed:
+                    RegistryEntry.objects.filter(pk=oid).update(**changed)
+            for name, values in m2m_updates.items():
+                if values:
+                    _set_registry_m2m(name, values)
+
+        stats['inserted'] += len(inserts)
+        stats['updated'] += len(updates)
+
+    # objects whose first node has not responded
+    stats['skipped'] = received.exclude(
+        first_node_name=settings.DPN_NODE_NAME
+    ).exclude(
+        dpn_object_id__in=first_node_entries.values('dpn_object_id')
+    ).values('dpn_object_id').distinct().count()
+
+    synced_nodes = _advance_sync_dates(syncs)
+
+    # the bulk writes above bypass the signals that keep the stats
+    if stats['inserted'] or stats['updated']:
+        recompute_registry_stats()
+
+    # the entries of incomplete lists are kept until the rest arrives
+    received.filter(node__in=synced_nodes).delete()
+
+    stats['elapsed'] = time.time() - start
+    logger.info(
+        "Registry conflicts solved in %(elapsed).2fs. Compared: %(compared)d "
+        "Updated: %(updated)d Inserted: %(inserted)d Skipped (first node did "
+        "not respond): %(skipped)d" % stats)
+    return stats
 
-        if not first_node_entry:
-            logger.info(
-                "First node has not responded. Skipping entry with dpn_object_id %s" % dpn_obj_id)
-            continue
-        else:
-            entry_one_data = first_node_entry.to_message_dict()
 
-        try:
-            local_entry = local_entries.get(dpn_object_id=dpn_obj_id)
-            if local_entry.to_message_dict() != entry_one_data:
-                # if entries are not equal, update our local with the first
-                # node entry, because first node entry is always the right one
-                entry_form = RegistryEntryForm(instance=local_entry,
-                                               data=entry_one_data)
-                if entry_form.is_valid():
-                    entry_form.save()
-                else:
-                    # NOTE: should we mark it as flagged?
-                    logger.info(
-                        "Unable to update entry. Data -> %s is not valid. Error message -> %s"
-                        % (entry_one_data, entry_form.errors))
-            # else? do nothing, just continue
-            continue
+@app.task
+def reconcile_registry_stats():
+    """
+    Recomputes the registry stats of the dashboard from the entries, fixes
+    any drift of the counters maintained by the signals.
 
-        except RegistryEntry.DoesNotExist as err:
-            # local entry does not exists in our local registry, so registering it
-            local_entry = RegistryEntryForm(data=entry_one_data)
-            if local_entry.is_valid:
-                local_entry.save()
-            else:
-                logger.info(
-                    "Unable to save entry. Data -> %s is not valid. Error message -> %s"
-                    % (entry_one_data, local_entry.errors))
-
-    # remove all entries in temporal table
-    entries_query.delete()
+    :return: Integer of stats rows written
+    """
+    start = time.time()
+    rows = recompute_registry_stats()
+    logger.info("Registry stats recomputed in %.2fs" % (time.time() - start))
+    return rows
@@ -0,0 +1,125 @@
+import os
+import mock
+import hashlib
+import tempfile
+
+from django.test import TestCase
+
+from dpn_workflows import fixity
+from dpn_workflows.fixity import (
+    MultiHasher, generate_fixities, generate_fixities_many, new_hasher,
+    cached_fixity, forget_fixity
+)
+from dpn_workflows.models import FixityCache
+
+# ####################################################
+# tests for dpn_workflows/fixity.py
+
+class DPNFixityTest(TestCase):
+
+    def setUp(self):
+        self.data = os.urandom(300000)
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.data)
+        self.expected = {
+            'sha256': hashlib.sha256(self.data).hexdigest(),
+            'md5': hashlib.md5(self.data).hexdigest(),
+        }
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_new_hasher(self):
+        with self.settings(DPN_FIXITY_CHOICES=['sha256']):
+            self.assertRaises(NotImplementedError, new_hasher, 'md5')
+            self.assertEqual(new_hasher('sha256').name, 'sha256')
+
+    def test_generate_fixities(self):
+        with self.settings(DPN_FIXITY_CHOICES=['sha256', 'md5']):
+            # odd block sizes make sure the last partial block is hashed
+            for use_mmap in [False, True]:
+                fixities = generate_fixities(self.path, blocksize=7777,
+                                             use_mmap=use_mmap)
+                self.assertEqual(self.expected, fixities,
+                    "Fixities differ from expected (mmap: %s)" % use_mmap)
+
+    def test_generate_fixities_empty_file(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            for use_mmap in [False, True]:
+                self.assertEqual(
+                    hashlib.sha256(b'').hexdigest(),
+                    generate_fixities(path, ['sha256'],
+                                      use_mmap=use_mmap)['sha256'])
+        finally:
+            os.remove(path)
+
+    def test_generate_fixities_many(self):
+        results = generate_fixities_many([self.path] * 3, ['sha256'],
+                                         workers=2)
+        self.assertEqual({'sha256': self.expected['sha256']},
+                         results[self.path])
+
+    def test_multi_hasher(self):
+        with self.settings(DPN_FIXITY_CHOICES=['sha256', 'md5']):
+            hasher = MultiHasher()
+            hasher.update(self.data)
+            self.assertEqual(self.expected, hasher.hexdigests())
+            self.assertEqual(self.expected['md5'], hasher.hexdigest('md5'))
+
+
+class DPNFixityCacheTest(TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b'test data')
+        self.fixity = (
+            "916f0027a575074ce72a331777c3478d6513f786a591bd892da1a577bf2335f9")
+        fixity._lru.clear()
+
+    def tearDown(self):
+        os.remove(self.path)
+        fixity._lru.clear()
+
+    def test_cached_fixity(self):
+        self.assertEqual(self.fixity, cached_fixity(self.path))
+        self.assertEqual(1, FixityCache.objects.filter(path=self.path).count())
+
+        # a second call must not read the file again, neither from the
+        # in-process cache nor from the database
+        with mock.patch.object(fixity, 'generate_fixities') as gen:
+            self.assertEqual(self.fixity, cached_fixity(self.path))
+            fixity._lru.clear()
+            self.assertEqual(self.fixity, cached_fixity(self.path))
+            self.assertFalse(gen.called, "Unchanged file was hashed again")
+
+    def test_cached_fixity_all_algorithms(self):
+        with self.settings(DPN_FIXITY_CHOICES=['sha256', 'md5']):
+            self.assertEqual(self.fixity, cached_fixity(self.path))
+            self.assertEqual(2, FixityCache.objects.filter(
+                path=self.path).count())
+
+            # hashed in the same pass as sha256
+            with mock.patch.object(fixity, 'generate_fixities') as gen:
+                self.assertEqual(hashlib.md5(b'test data').hexdigest(),
+                                 cached_fixity(self.path, 'md5'))
+                self.assertFalse(gen.called, "File was hashed again")
+
+    def test_cached_fixity_invalidation(self):
+        cached_fixity(self.path)
+        with open(self.path, 'ab') as f:
+            f.write(b' changed')
+
+        expected = hashlib.sha256(b'test data changed').hexdigest()
+        self.assertEqual(expected, cached_fixity(self.path))
+        self.assertEqual(
+            expected, FixityCache.objects.get(path=self.path).fixity_value)
+
+    def test_forget_fixity(self):
+        cached_fixity(self.path)
+        forget_fixity(self.path)
+        self.assertFalse(FixityCache.objects.filter(path=self.path).exists())
+
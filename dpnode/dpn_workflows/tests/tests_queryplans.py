@@ -0,0 +1,27 @@
+from django.test import TestCase
+
+from dpn_workflows.management.commands.dpn_workflow_benchmark import (
+    synthetic_rows
+)
+from dpn_workflows.models import Workflow
+from dpn_workflows.queryplans import hot_queries, explain, uses_index, analyze
+
+# ####################################################
+# tests for dpn_workflows/queryplans.py
+
+class HotQueriesTest(TestCase):
+
+    def setUp(self):
+        Workflow.objects.bulk_create(synthetic_rows(200, "aptrust"))
+        analyze()
+
+    def test_index_backed(self):
+        queries = hot_queries("benchmark-00000100", "benchmark-bag-00000100",
+                              "tdr", "aptrust")
+        for name, queryset in queries:
+            plan = explain(queryset)
+            self.assertTrue(uses_index(plan), "%s: %s" % (name, plan))
+
+    def test_scan_detected(self):
+        plan = explain(Workflow.objects.filter(note="not indexed"))
+        self.assertFalse(uses_index(plan))
@@ -0,0 +1,74 @@
+from itertools import count
+
+from django.test import TestCase
+
+from dpn_workflows.ranking import node_stats, score_nodes, rank_nodes
+from dpn_workflows.models import (
+    Workflow, SUCCESS, FAILED, REPLICATE, RECEIVE, LOCATION_REPLY,
+    VERIFY_REPLY, AVAILABLE_REPLY
+)
+
+# ####################################################
+# tests for dpn_workflows/ranking.py
+
+class RankingTest(TestCase):
+
+    def setUp(self):
+        self.ids = count()
+
+    def _history(self, node, step, state, action=REPLICATE, **fields):
+        return Workflow.objects.create(
+            correlation_id="corr-%d" % next(self.ids),
+            dpn_object_id="object",
+            node=node,
+            action=action,
+            step=step,
+            state=state,
+            **fields
+        )
+
+    def test_node_stats(self):
+        self._history("tdr", VERIFY_REPLY, SUCCESS, throughput=100.0)
+        self._history("tdr", VERIFY_REPLY, FAILED, throughput=300.0)
+        self._history("tdr", LOCATION_REPLY, SUCCESS)
+        self._history("tdr", AVAILABLE_REPLY, SUCCESS, reply_latency=2.0)
+        self._history("tdr", LOCATION_REPLY, SUCCESS, action=RECEIVE)
+
+        with self.assertNumQueries(2):
+            stats = node_stats(["tdr", "sdr"])
+
+        tdr = stats["tdr"]
+        self.assertEqual(200.0, tdr.throughput)
+        self.assertEqual(2.0, tdr.reply_latency)
+        self.assertEqual((1, 1, 1, 1), (tdr.succeeded, tdr.failed,
+                                        tdr.fixity_failed, tdr.in_flight))
+        self.assertEqual(0.5, tdr.success_rate)
+
+        sdr = stats["sdr"]
+        self.assertIsNone(sdr.throughput)
+        self.assertEqual(0.5, sdr.reliability)
+
+    def test_rank_fast_reliable_nodes_first(self):
+        for _ in range(3):
+            self._history("tdr", VERIFY_REPLY, SUCCESS, throughput=1000.0)
+            self._history("sdr", VERIFY_REPLY, SUCCESS, throughput=10.0)
+            self._history("chron", VERIFY_REPLY, FAILED, throughput=1000.0)
+
+        self.assertEqual(["tdr", "sdr", "chron"],
+                         rank_nodes(["chron", "sdr", "tdr"]))
+
+    def test_rank_least_loaded_first(self):
+        self._history("tdr", LOCATION_REPLY, SUCCESS)
+        self._history("tdr", LOCATION_REPLY, SUCCESS)
+
+        self.assertEqual(["sdr", "tdr"], rank_nodes(["tdr", "sdr"]))
+
+    def test_weights(self):
+        self._history("tdr", AVAILABLE_REPLY, SUCCESS, reply_latency=1.0)
+        self._history("sdr", AVAILABLE_REPLY, SUCCESS, reply_latency=4.0)
+
+        with self.settings(DPN_NODE_RANKING_WEIGHTS={'latency': 1}):
+            scores = score_nodes(["tdr", "sdr"])
+
+        self.assertEqual(0.5, scores["tdr"])
+        self.assertEqual(0.125, scores["sdr"])
@@ -0,0 +1,102 @@
+import os
+import errno
+import shutil
+import tempfile
+
+from django.test import TestCase
+from mock import patch, Mock
+
+from dpn_workflows import staging
+from dpn_workflows.staging import (
+    stage_file, HARDLINK, REFLINK, SYMLINK, SENDFILE, COPY
+)
+
+# ####################################################
+# tests for dpn_workflows/staging.py
+
+class StageFileTest(TestCase):
+
+    def setUp(self):
+        staging._unsupported.clear()
+        self.tmp = tempfile.mkdtemp()
+        self.dst_dir = os.path.join(self.tmp, "staged")
+        os.mkdir(self.dst_dir)
+        self.src = os.path.join(self.tmp, "bag.tar")
+        with open(self.src, 'wb') as bag:
+            bag.write(b"dpn bag contents" * 1024)
+
+    def tearDown(self):
+        staging._unsupported.clear()
+        shutil.rmtree(self.tmp)
+
+    def _contents(self, path):
+        with open(path, 'rb') as bag:
+            return bag.read()
+
+    def test_hardlink(self):
+        dst, method = stage_file(self.src, self.dst_dir)
+        self.assertEqual((os.path.join(self.dst_dir, "bag.tar"), HARDLINK),
+                         (dst, method))
+        self.assertTrue(os.path.samefile(self.src, dst))
+
+        # staging it again does nothing
+        self.assertEqual((dst, HARDLINK), stage_file(self.src, self.dst_dir))
+
+    @patch("os.link")
+    def test_other_filesystem(self, link):
+        link.side_effect = OSError(errno.EXDEV, "cross-device link")
+        reflink = Mock(side_effect=OSError(errno.EOPNOTSUPP, "not supported"))
+        patcher = patch.dict(staging._METHODS, {REFLINK: reflink})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        dst, method = stage_file(self.src, self.dst_dir)
+        self.assertIn(method, (SENDFILE, COPY))
+        self.assertFalse(os.path.samefile(self.src, dst))
+        self.assertEqual(self._contents(self.src), self._contents(dst))
+
+        # the methods that failed are not tried again
+        os.remove(dst)
+        stage_file(self.src, self.dst_dir)
+        self.assertEqual(1, link.call_count)
+        self.assertEqual(1, reflink.call_count)
+
+    @patch("os.link")
+    def test_symlink(self, link):
+        link.side_effect = OSError(errno.EXDEV, "cross-device link")
+
+        dst, method = stage_file(self.src, self.dst_dir, [HARDLINK, SYMLINK])
+        self.assertEqual(SYMLINK, method)
+        self.assertEqual(self.src, os.readlink(dst))
+        self.assertEqual((dst, SYMLINK), stage_file(self.src, self.dst_dir))
+
+    @patch("os.link")
+    def test_refused_not_remembered(self, link):
+        # fs.protected_hardlinks refuses to link a file of another user
+        link.side_effect = OSError(errno.EPERM, "operation not permitted")
+
+        dst, method = stage_file(self.src, self.dst_dir, [HARDLINK, COPY])
+        self.assertEqual(COPY, method)
+        self.assertEqual({}, staging._unsupported)
+
+        link.side_effect = None
+        os.remove(dst)
+        self.assertEqual(HARDLINK, stage_file(self.src, self.dst_dir,
+                                              [HARDLINK, COPY])[1])
+
+    def test_error_raised(self):
+        copy = Mock(side_effect=OSError(errno.ENOSPC, "no space left"))
+
+        with patch.dict(staging._METHODS, {COPY: copy}):
+            with self.assertRaises(OSError):
+                stage_file(self.src, self.dst_dir, [COPY])
+        self.assertFalse(os.path.lexists(
+            os.path.join(self.dst_dir, "bag.tar")))
+        self.assertEqual({}, staging._unsupported)
+
+    def test_replaces_stale_file(self):
+        with open(os.path.join(self.dst_dir, "bag.tar"), 'wb') as stale:
+            stale.write(b"partial")
+
+        dst, method = stage_file(self.src, self.dst_dir, [COPY])
+        self.assertEqual(self._contents(self.src), self._contents(dst))
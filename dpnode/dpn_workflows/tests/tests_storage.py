@@ -0,0 +1,111 @@
+from datetime import timedelta
+from itertools import count
+
+from django.test import TestCase
+from django.utils import timezone
+
+from dpn_workflows.storage import (
+    reserve_storage, release_storage, acquire_transfer_slot,
+    renew_transfer_slot, active_reservations, mark_preallocated
+)
+from dpn_workflows.models import (
+    Workflow, StorageReservation, RECEIVE, INIT_QUERY, SUCCESS
+)
+
+# ####################################################
+# tests for dpn_workflows/storage.py
+
+class StorageReservationTest(TestCase):
+
+    def setUp(self):
+        self.ids = count()
+
+    def _action(self, node="tdr"):
+        return Workflow.objects.create(
+            correlation_id="corr-%d" % next(self.ids),
+            dpn_object_id="object",
+            node=node,
+            action=RECEIVE,
+            step=INIT_QUERY,
+            state=SUCCESS
+        )
+
+    def test_reserve_storage(self):
+        first, second, third = [self._action() for _ in range(3)]
+
+        # every query sees the same free space
+        self.assertTrue(reserve_storage(first, 600, 1000))
+        self.assertFalse(reserve_storage(second, 600, 1000))
+        self.assertTrue(reserve_storage(third, 400, 1000))
+        self.assertEqual([first.pk, third.pk], sorted(
+            active_reservations().values_list('workflow', flat=True)))
+
+    def test_downloaded_bytes_not_reserved(self):
+        first, second = self._action(), self._action()
+        self.assertTrue(reserve_storage(first, 600, 1000))
+
+        # half of it is already on disk, the free space went down
+        first.bytes_transferred = 300
+        first.save()
+        self.assertTrue(reserve_storage(second, 400, 700))
+
+    def test_preallocated_not_reserved(self):
+        first, second = self._action(), self._action()
+        self.assertTrue(reserve_storage(first, 600, 1000))
+
+        # the whole bag was allocated, the free space went down by 600
+        mark_preallocated(first)
+        self.assertTrue(reserve_storage(second, 400, 400))
+
+    def test_release_and_lapse(self):
+        first, second, third = [self._action() for _ in range(3)]
+        reserve_storage(first, 1000, 1000)
+        reserve_storage(second, 1000, 2000)
+
+        release_storage(first)
+        StorageReservation.objects.filter(workflow=second).update(
+            expires_at=timezone.now() - timedelta(seconds=1))
+
+        self.assertTrue(reserve_storage(third, 1000, 1000))
+        self.assertEqual(1, active_reservations().count())
+
+    def test_transfer_slots(self):
+        tdr = [self._action("tdr") for _ in range(3)]
+        sdr = [self._action("sdr") for _ in range(2)]
+        for action in tdr + sdr:
+            reserve_storage(action, 10, 1000)
+
+        with self.settings(DPN_XFER_MAX_ACTIVE=3, DPN_XFER_MAX_PER_NODE=2):
+            self.assertTrue(acquire_transfer_slot(tdr[0]))
+            self.assertTrue(acquire_transfer_slot(tdr[1]))
+            self.assertFalse(acquire_transfer_slot(tdr[2]))
+            self.assertTrue(acquire_transfer_slot(sdr[0]))
+            self.assertFalse(acquire_transfer_slot(sdr[1]))
+
+            # asking again keeps the slot
+            self.assertTrue(acquire_transfer_slot(tdr[0]))
+
+            release_storage(tdr[0])
+            self.assertTrue(acquire_transfer_slot(tdr[2]))
+
+        # a waiting transfer keeps its space reserved
+        waiting = StorageReservation.objects.get(workflow=sdr[1])
+        self.assertIsNone(waiting.transfer_started)
+        self.assertIsNotNone(waiting.expires_at)
+        self.assertGreater(StorageReservation.objects.get(
+            workflow=tdr[1]).expires_at, waiting.expires_at)
+
+    def test_transfer_slot_lease(self):
+        dead, renewed, waiting = [self._action() for _ in range(3)]
+        with self.settings(DPN_XFER_MAX_ACTIVE=2, DPN_XFER_SLOT_TTL=60):
+            self.assertTrue(acquire_transfer_slot(dead))
+            self.assertTrue(acquire_transfer_slot(renewed))
+            self.assertFalse(acquire_transfer_slot(waiting))
+
+            # the worker of the first transfer died, no progress renews it
+            past = timezone.now() - timedelta(seconds=1)
+            StorageReservation.objects.update(expires_at=past)
+            renew_transfer_slot(renewed)
+            self.assertTrue(acquire_transfer_slot(waiting))
+            self.assertEqual([renewed.pk, waiting.pk], sorted(
+                active_reservations().values_list('workflow', flat=True)))
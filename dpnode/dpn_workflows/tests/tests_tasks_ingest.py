@@ -0,0 +1,182 @@
+from datetime import timedelta
+from itertools import count
+
+from django.test import TestCase
+from django.utils import timezone
+from mock import patch
+
+from dpn_registry.models import RegistryEntry
+from dpn_workflows.tasks import ingest
+from dpn_workflows.models import (
+    IngestQueue, Workflow, PENDING, COMPLETE, FAILED, SUCCESS,
+    REPLICATE, INIT_QUERY, LOCATION_REPLY, VERIFY_REPLY
+)
+
+# ####################################################
+# tests for dpn_workflows/tasks/ingest.py
+
+class IngestBagTest(TestCase):
+
+    def setUp(self):
+        self.entry = RegistryEntry(dpn_object_id="new-bag", bag_size=1024)
+
+    @patch("dpn_workflows.tasks.ingest.admit_ingests")
+    @patch("dpn_workflows.tasks.ingest.create_entry")
+    def test_ingest_bag(self, create_entry, admit_ingests):
+        create_entry.return_value = self.entry
+
+        queued = IngestQueue.objects.get(
+            pk=ingest.ingest_bag("new-bag", "bag.tar"))
+
+        create_entry.assert_called_once_with("new-bag", "bag.tar")
+        self.assertEqual((PENDING, 1024), (queued.state, queued.bag_size))
+        self.assertTrue(admit_ingests.apply_async.called)
+
+    @patch("dpn_workflows.tasks.ingest.admit_ingests")
+    @patch("dpn_workflows.tasks.ingest.create_entry")
+    def test_already_ingested(self, create_entry, admit_ingests):
+        RegistryEntry.objects.create(
+            dpn_object_id="new-bag",
+            first_node_name="aptrust",
+            version_number=1,
+            fixity_algorithm="sha256",
+            fixity_value="0" * 64,
+            last_fixity_date="2014-01-01T00:00:00Z",
+            creation_date="2014-01-01T00:00:00Z",
+            last_modified_date="2014-01-01T00:00:00Z",
+            bag_size=1024,
+        )
+
+        self.assertIsNone(ingest.ingest_bag("new-bag", "bag.tar"))
+        self.assertFalse(create_entry.called)
+        self.assertFalse(IngestQueue.objects.exists())
+
+
+@patch("dpn_workflows.tasks.ingest.choose_and_send_location")
+@patch("dpn_workflows.tasks.ingest.initiate_ingest")
+class AdmitIngestsTest(TestCase):
+
+    def setUp(self):
+        self.ids = count()
+        for name, size in [("large", 3000), ("small", 1000),
+                           ("medium", 2000)]:
+            IngestQueue.objects.create(dpn_object_id=name, bag_path=name,
+                                       bag_size=size)
+
+    def _initiate_ingest(self, dpn_object_id, size):
+        # our own action, as initiate_ingest saves it
+        correlation_id = "corr-%d" % next(self.ids)
+        Workflow.objects.create(
+            correlation_id=correlation_id,
+            dpn_object_id=dpn_object_id,
+            node="aptrust",
+            action=REPLICATE,
+            step=INIT_QUERY,
+            state=SUCCESS
+        )
+        return correlation_id
+
+    def _admit(self, **limits):
+        limits.setdefault('DPN_INGEST_MAX_ACTIVE', 2)
+        limits.setdefault('DPN_INGEST_MAX_BYTES', None)
+        with self.settings(DPN_NODE_NAME="aptrust", DPN_NUM_XFERS=1,
+                           DPN_INGEST_ORDER="smallest", **limits):
+            return ingest.admit_ingests()
+
+    def test_max_active(self, initiate_ingest, choose_and_send_location):
+        initiate_ingest.side_effect = self._initiate_ingest
+
+        self.assertEqual(["small", "medium"], self._admit())
+        self.assertEqual([], self._admit())
+        self.assertEqual(2, choose_and_send_location.apply_async.call_count)
+        self.assertEqual(PENDING, IngestQueue.objects.get(
+            dpn_object_id="large").state)
+
+    def test_max_bytes(self, initiate_ingest, choose_and_send_location):
+        initiate_ingest.side_effect = self._initiate_ingest
+
+        self.assertEqual(["small"], self._admit(DPN_INGEST_MAX_BYTES=2500))
+
+        # a bag over the limit goes alone
+        IngestQueue.objects.filter(dpn_object_id="small").update(
+            state=COMPLETE)
+        self.assertEqual(["medium"], self._admit(DPN_INGEST_MAX_BYTES=1500))
+
+    def test_oldest_first(self, initiate_ingest, choose_and_send_location):
+        initiate_ingest.side_effect = self._initiate_ingest
+
+        with self.settings(DPN_INGEST_ORDER="oldest"):
+            started = ingest.admit_ingests()
+        self.assertEqual(["large", "small"], started)
+
+    def test_finished_ingests(self, initiate_ingest, choose_and_send_location):
+        initiate_ingest.side_effect = self._initiate_ingest
+        self._admit(DPN_INGEST_MAX_ACTIVE=1)
+        small = IngestQueue.objects.get(dpn_object_id="small")
+
+        # the node chosen is still transferring
+        Workflow.objects.filter(correlation_id=small.correlation_id).update(
+            step=LOCATION_REPLY)
+        node = Workflow.objects.create(
+            correlation_id=small.correlation_id,
+            dpn_object_id="small",
+            node="tdr",
+            action=REPLICATE,
+            step=LOCATION_REPLY,
+            state=SUCCESS
+        )
+        self.assertEqual([], self._admit(DPN_INGEST_MAX_ACTIVE=1))
+
+        node.step = VERIFY_REPLY
+        node.save()
+        self.assertEqual(["medium"], self._admit(DPN_INGEST_MAX_ACTIVE=1))
+        small = IngestQueue.objects.get(pk=small.pk)
+        self.assertEqual(COMPLETE, small.state)
+        self.assertIsNotNone(small.finished_at)
+
+    def test_expired_query(self, initiate_ingest, choose_and_send_location):
+        initiate_ingest.side_effect = self._initiate_ingest
+        self._admit(DPN_INGEST_MAX_ACTIVE=1)
+
+        # nobody replied before the query expired
+        IngestQueue.objects.filter(dpn_object_id="small").update(
+            admitted_at=timezone.now() - timedelta(days=1))
+        self.assertEqual(["medium"], self._admit(DPN_INGEST_MAX_ACTIVE=1))
+
+    def test_ingest_timeout(self, initiate_ingest, choose_and_send_location):
+        initiate_ingest.side_effect = self._initiate_ingest
+        self._admit(DPN_INGEST_MAX_ACTIVE=1)
+        small = IngestQueue.objects.get(dpn_object_id="small")
+
+        # the node chosen never replies to the transfer
+        Workflow.objects.filter(correlation_id=small.correlation_id).update(
+            step=LOCATION_REPLY)
+        Workflow.objects.create(correlation_id=small.correlation_id,
+                                dpn_object_id="small", node="tdr",
+                                action=REPLICATE, step=LOCATION_REPLY,
+                                state=SUCCESS)
+        self.assertEqual([], self._admit(DPN_INGEST_MAX_ACTIVE=1))
+
+        IngestQueue.objects.filter(pk=small.pk).update(
+            admitted_at=timezone.now() - timedelta(days=2))
+        self.assertEqual(["medium"], self._admit(DPN_INGEST_MAX_ACTIVE=1,
+                                                 DPN_INGEST_MAX_AGE=86400))
+        self.assertEqual(FAILED, IngestQueue.objects.get(pk=small.pk).state)
+        self.assertEqual(set([FAILED]), set(Workflow.objects.filter(
+            correlation_id=small.correlation_id
+        ).values_list('state', flat=True)))
+
+    def test_estimated_completion(self, initiate_ingest,
+                                  choose_and_send_location):
+        initiate_ingest.side_effect = self._initiate_ingest
+        self._admit(DPN_INGEST_MAX_ACTIVE=1, DPN_INGEST_BANDWIDTH=100)
+
+        queue = dict((ingest.dpn_object_id, ingest)
+                     for ingest in IngestQueue.objects.all())
+        start = queue["small"].admitted_at
+        self.assertEqual(start + timedelta(seconds=10),
+                         queue["small"].estimated_completion)
+        self.assertEqual(start + timedelta(seconds=30),
+                         queue["medium"].estimated_completion)
+        self.assertEqual(start + timedelta(seconds=60),
+                         queue["large"].estimated_completion)
@@ -3,17 +3,15 @@ from unittest import skip
 from django.test import TestCase
 from mock import patch
 
-from kombu.message import Message
-from kombu.tests.case import Mock as KombuMock
-
 from dpnmq.tests import fixtures
 
 from dpn_workflows.tasks import outbound
 
-from dpn_workflows.models import IngestAction, SendFileAction, Workflow
+from dpn_workflows.models import IngestAction, Workflow
 from dpn_workflows.models import (
     VERIFY, STARTED, SUCCESS, FAILED, CANCELLED, TRANSFER, COMPLETE, RECOVERY, 
-    AVAILABLE_REPLY, TRANSFER_REPLY, LOCATION_REPLY, VERIFY_REPLY
+    AVAILABLE_REPLY, TRANSFER_REPLY, LOCATION_REPLY, VERIFY_REPLY, INIT_QUERY,
+    REPLICATE, TRANSFER_REQUEST
 )
 
 from dpn_registry.models import RegistryEntry
@@ -33,14 +31,27 @@ class ChooseAndSendLocationTest(TestCase):
             'rsync': 'dpn@dpn.aptrust.org:/outbound/',
         }
         self.file_extension = "tar"
+        # our own action, waiting for the available replies
+        Workflow.objects.create(
+            correlation_id=self.correlation_id,
+            dpn_object_id=self.object_id,
+            node="aptrust",
+            action=REPLICATE,
+            step=INIT_QUERY,
+            state=SUCCESS
+        )
+
+    def _choose_and_send_location(self):
+        with self.settings(
+            DPN_BASE_LOCATION=self.base_location,
+            DPN_BAGS_FILE_EXT=self.file_extension,
+            DPN_NODE_NAME="aptrust"
+        ):
+            outbound.choose_and_send_location(self.correlation_id)
         
     def test_choose_and_send_location(self):
         try:
-            with self.settings(
-                DPN_BASE_LOCATION=self.base_location,
-                DPN_BAGS_FILE_EXT=self.file_extension
-            ):
-                 outbound.choose_and_send_location(self.correlation_id)
+            self._choose_and_send_location()
         except Exception as e:
             self.fail("Raised error for correct flow")
         
@@ -62,21 +73,37 @@ class ChooseAndSendLocationTest(TestCase):
             LOCATION_REPLY,
             "Action step differs from expected"
         )
+
+    @patch("dpn_workflows.tasks.outbound._send_location")
+    def test_choose_once(self, send_location):
+        # every reply and the expired query run the selection
+        self._choose_and_send_location()
+        self._choose_and_send_location()
+
+        self.assertEqual(1, send_location.call_count)
+        self.assertEqual(LOCATION_REPLY, Workflow.objects.get(
+            correlation_id=self.correlation_id, node="aptrust").step)
+
+    @patch("dpn_workflows.tasks.outbound._send_location")
+    def test_wait_for_enough_nodes(self, send_location):
+        with self.settings(DPN_NUM_XFERS=2):
+            self._choose_and_send_location()
+
+        self.assertFalse(send_location.called)
+        self.assertEqual(INIT_QUERY, Workflow.objects.get(
+            correlation_id=self.correlation_id, node="aptrust").step)
         
 class SendTransferStatusTest(TestCase):
-    fixtures = ["test_send_file_action.yaml"]
     
     def setUp(self):
-        self.req = Message(
-            KombuMock(), 
-            fixtures.REP_LOCATION_REPLY.copy(),
-            headers=fixtures.make_headers()
+        self.req = dict(
+            headers=fixtures.make_headers(),
+            body=fixtures.REP_LOCATION_REPLY.copy()
         )
-        self.action = SendFileAction.objects.all()[0]
         
     def test_send_transfer_status(self):
         try:
-            outbound.send_transfer_status(self.req, self.action)
+            outbound.send_transfer_status(self.req, fixity_value="0" * 64)
         except:
             self.fail("Raised error for correct flow")
      
@@ -88,7 +115,7 @@ class BroadcastItemCreationTest(TestCase):
         
     def test_broadcast_item_creation(self):
         try:
-            outbound.broadcast_item_creation(self.entry)
+            outbound.broadcast_item_creation(self.entry.dpn_object_id)
         except:
             self.fail("Raised error for correct flow")
 
@@ -99,7 +126,7 @@ class VerifyFixityAndReplyTest(TestCase):
         headers = fixtures.make_headers()
         headers["correlation_id"] = "testid3"
         body = fixtures.REP_TRANSFER_REPLY_ACK.copy() 
-        self.req = Message(KombuMock(), body, headers=headers)
+        self.req = dict(headers=headers, body=body)
         self.fixity_value = (
             "2cf24dba5fb0a30e26e83b2ac5b9e29e1b161e5c1fa7425e73043362938b9824"
         )
@@ -218,7 +245,7 @@ class RespondToRecoveryQuery(TestCase):
     ):
         headers = self.headers.copy()
         headers[header_field_name] = header_field_value
-        bad_req = Message(KombuMock(), self.body, headers = headers)
+        bad_req = dict(headers=headers, body=self.body)
         
         dif_actions = self._test_respond_to_recovery_query(bad_req, FAILED)
            
@@ -242,7 +269,7 @@ class RespondToRecoveryQuery(TestCase):
     ):
         body = self.body.copy()
         body[body_field_name] = body_field_value
-        bad_req = Message(KombuMock(), body, headers = self.headers)
+        bad_req = dict(headers=self.headers, body=body)
         
         dif_actions = self._test_respond_to_recovery_query(bad_req, FAILED)
            
@@ -257,7 +284,7 @@ class RespondToRecoveryQuery(TestCase):
         )
          
     def test_respond_to_recovery_query_good(self):
-        good_req = Message(KombuMock(), self.body, headers = self.headers)
+        good_req = dict(headers=self.headers, body=self.body)
         dif_actions = self._test_respond_to_recovery_query(good_req, SUCCESS)
            
         self.assertFalse(dif_actions, "Field Validation Failed")
@@ -291,7 +318,7 @@ class RespondToRecoveryTransfer(TestCase):
         self.node = self.headers["from"]
         self.reply_key = self.headers["reply_key"]
     
-    @patch("shutil.copy2")
+    @patch("dpn_workflows.tasks.outbound.stage_file")
     @patch("os.path.join")
     @patch("os.path.isfile")
     @patch("dpn_workflows.tasks.outbound._validate_sequence")
@@ -302,10 +329,11 @@ class RespondToRecoveryTransfer(TestCase):
         validate, 
         is_file,
         os_path_join,
-        shutil
+        stage_file
     ):
         is_file.return_value = True
         os_path_join.return_value = "test/directory"
+        stage_file.return_value = ("test/directory", "hardlink")
         with self.settings(
             DPN_XFER_OPTIONS = ['https', 'rsync'],
             DPN_BAGS_FILE_EXT = "tar",
@@ -335,7 +363,7 @@ class RespondToRecoveryTransfer(TestCase):
     def test_respond_to_recovery_transfer_bad_protocol(self):
         body = self.body.copy()
         body["protocol"] = "ftp"
-        bad_req = Message(KombuMock(), body, headers = self.headers)
+        bad_req = dict(headers=self.headers, body=body)
         
         self.assertRaises(
             DPNOutboundError, 
@@ -345,7 +373,7 @@ class RespondToRecoveryTransfer(TestCase):
         )
           
     def test_respond_to_recovery_transfer_good(self):
-        good_req = Message(KombuMock(), self.body, headers = self.headers)
+        good_req = dict(headers=self.headers, body=self.body)
         dif = False
         try:
             dif = self._test_respond_to_recovery_transfer(good_req, SUCCESS)
@@ -359,7 +387,7 @@ class ChooseNodeAndRecover(TestCase):
     #     Workflow
     #
     # Mock:
-    #     random.choice
+    #     choose_nodes
     #
     # Settings:
     #     DPN_DEFAULT_XFER_PROTOCOL
@@ -369,26 +397,43 @@ class ChooseNodeAndRecover(TestCase):
     def setUp(self):
         self.correlation_id = "testid"
         self.dpn_object_id = "some-uuid-that-actually-looks-like-a-uuid"
-        
-    
-    @patch("random.choice")
-    def test_choose_node_and_recover(self, random_choice):
-        send_action = Workflow.objects.get(pk=1)
-        selected_action = Workflow.objects.get(pk=2)
-        random_choice.return_value = selected_action
-        
+        # our own action waits for replies, both nodes have the bag
+        Workflow.objects.filter(pk=1).update(step=INIT_QUERY)
+        Workflow.objects.filter(pk__in=[2, 3]).update(state=SUCCESS)
+
+    def _choose_node_and_recover(self):
         with self.settings(
             DPN_DEFAULT_XFER_PROTOCOL = 'https',
             DPN_NODE_NAME = "testfrom",
         ):
-            try:
-                outbound.choose_node_and_recover(
-                    self.correlation_id,
-                    self.dpn_object_id,
-                    send_action
-                )
-            except:
-                self.fail("Raised error for correct flow")
+            outbound.choose_node_and_recover(
+                self.correlation_id,
+                self.dpn_object_id
+            )
+    
+    @patch("dpn_workflows.tasks.outbound.choose_nodes")
+    def test_choose_node_and_recover(self, choose_nodes):
+        choose_nodes.return_value = ["node1"]
+        
+        try:
+            self._choose_node_and_recover()
+        except:
+            self.fail("Raised error for correct flow")
+
+        send_action = Workflow.objects.get(pk=1)
+        self.assertEqual(TRANSFER_REQUEST, send_action.step)
+        self.assertEqual(SUCCESS, send_action.state)
+        self.assertEqual(CANCELLED, Workflow.objects.get(pk=3).state)
+
+    @patch("dpn_workflows.tasks.outbound.choose_nodes")
+    def test_choose_node_once(self, choose_nodes):
+        choose_nodes.return_value = ["node1"]
+
+        # every reply and the expired query run the selection
+        self._choose_node_and_recover()
+        self._choose_node_and_recover()
+
+        self.assertEqual(1, choose_nodes.call_count)
     
     
            
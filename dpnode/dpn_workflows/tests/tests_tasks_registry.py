@@ -0,0 +1,197 @@
+import copy
+from uuid import uuid4
+from datetime import datetime
+
+from django.test import TestCase
+from django.utils import timezone
+from mock import patch
+
+from dpnmq.tests import fixtures
+from dpnmq.messages import RegistryDateRangeSync, RegistryListDateRangeReply
+
+from dpn_workflows.tasks import registry
+
+from dpn_registry.models import (
+    RegistryEntry, Node, NodeEntry, RegistrySyncReply
+)
+
+
+class ReplyWithItemListTest(TestCase):
+
+    def setUp(self):
+        nodes = [Node.objects.create(name=n) for n in ['aptrust', 'tdr']]
+        for idx in range(7):
+            entry = RegistryEntry.objects.create(
+                dpn_object_id="object-%02d" % idx,
+                first_node_name="aptrust",
+                version_number=1,
+                fixity_algorithm="sha256",
+                fixity_value="%064d" % idx,
+                last_fixity_date=datetime(2014, 1, 1),
+                creation_date=datetime(2014, 1, 1),
+                last_modified_date=datetime(2014, 1, 1),
+                bag_size=1024,
+            )
+            entry.replicating_nodes.add(*nodes)
+
+        self.req = RegistryDateRangeSync(fixtures.make_headers(), {
+            'date_range': ["2013-12-31T00:00:00Z", "2014-01-02T00:00:00Z"]
+        })
+
+    def test_reply_in_parts(self):
+        sent = []
+
+        def _send(msg, rt_key):
+            sent.append(copy.deepcopy(msg.body))
+
+        with patch.object(RegistryListDateRangeReply, 'send', _send), \
+                self.settings(DPN_REGISTRY_SYNC_CHUNK=3):
+            # 3 pages + 3 prefetch queries per page + the last empty page
+            with self.assertNumQueries(13):
+                registry.reply_with_item_list(self.req.payload())
+
+        self.assertEqual([1, 2, 3], [body['part'] for body in sent])
+        self.assertEqual([False, False, True],
+                         [body['last_part'] for body in sent])
+        self.assertEqual([3, 3, 1],
+                         [len(body['reg_sync_list']) for body in sent])
+        self.assertEqual(['aptrust', 'tdr'], sorted(
+            sent[0]['reg_sync_list'][0]['replicating_node_names']))
+
+    def test_reply_filters_modified_date(self):
+        sent = []
+        RegistryEntry.objects.filter(pk="object-00").update(
+            last_modified_date=datetime(2015, 1, 1))
+        self.req.body['date_range'] = ["2014-12-31T00:00:00Z",
+                                       "2015-01-02T00:00:00Z"]
+        with patch.object(RegistryListDateRangeReply, 'send',
+                          lambda msg, key: sent.append(msg.body)):
+            registry.reply_with_item_list(self.req.payload())
+
+        self.assertEqual(["object-00"], [e['dpn_object_id']
+                                         for e in sent[0]['reg_sync_list']])
+
+    def test_reply_empty_list(self):
+        sent = []
+        self.req.body['date_range'] = ["2015-01-01T00:00:00Z",
+                                       "2015-01-02T00:00:00Z"]
+        with patch.object(RegistryListDateRangeReply, 'send',
+                          lambda msg, key: sent.append(msg.body)):
+            registry.reply_with_item_list(self.req.payload())
+
+        self.assertEqual(1, len(sent))
+        self.assertEqual([], sent[0]['reg_sync_list'])
+        self.assertTrue(sent[0]['last_part'])
+
+
+class SaveRegistriesFromTest(TestCase):
+
+    def _reply(self, entries, **kwargs):
+        body = dict(fixtures.REGISTRY_LIST_DATERANGE,
+                    reg_sync_list=copy.deepcopy(entries), **kwargs)
+        return RegistryListDateRangeReply(fixtures.make_headers(), body)
+
+    def test_save_parts(self):
+        entries = fixtures.REG_SYNC_LIST
+
+        # parts may arrive in any order and more than once
+        replies = [
+            self._reply(entries[1:], part=2, last_part=True),
+            self._reply(entries[:1], part=1, last_part=False),
+            self._reply(entries[:1], part=1, last_part=False),
+        ]
+        results = [registry.save_registries_from('tdr', req.payload())
+                   for req in replies]
+
+        self.assertEqual([False, True, True], results)
+        sync = RegistrySyncReply.objects.get(node='tdr')
+        self.assertEqual(2, sync.parts_total)
+        self.assertEqual(len(entries), sync.entries)
+        self.assertEqual(len(entries), NodeEntry.objects.count())
+
+    def test_save_single_part(self):
+        complete = registry.save_registries_from(
+            'tdr', self._reply(fixtures.REG_SYNC_LIST).payload())
+        self.assertTrue(complete)
+        self.assertEqual(1, RegistrySyncReply.objects.get(
+            node='tdr').parts_total)
+
+
+class SolveRegistryConflictsTest(TestCase):
+
+    def _save_lists(self):
+        headers = dict(fixtures.make_headers(), correlation_id=str(uuid4()))
+        for node in ['tdr', 'sdr']:
+            req = RegistryListDateRangeReply(headers, dict(
+                fixtures.REGISTRY_LIST_DATERANGE,
+                reg_sync_list=copy.deepcopy(fixtures.REG_SYNC_LIST)))
+            registry.save_registries_from(node, req.payload())
+
+    def test_solve_registry_conflicts(self):
+        # a local entry that differs from the one of its first node
+        local = RegistryEntry.objects.create(
+            dpn_object_id="dedff031-9946-4fff-a268-9fd9f8396f15",
+            first_node_name="sdr",
+            version_number=1,
+            fixity_algorithm="sha256",
+            fixity_value="0" * 64,
+            last_fixity_date=datetime(2014, 1, 1),
+            creation_date=datetime(2014, 1, 1),
+            last_modified_date=datetime(2014, 1, 1),
+            bag_size=1024,
+        )
+        local.replicating_nodes.add(Node.objects.create(name='aptrust'))
+
+        self._save_lists()
+        stats = registry.solve_registry_conflicts()
+
+        # chron never sent its list, so its entry is skipped
+        self.assertEqual(3, stats['compared'])
+        self.assertEqual(1, stats['updated'])
+        self.assertEqual(2, stats['inserted'])
+        self.assertEqual(1, stats['skipped'])
+        self.assertEqual(0, NodeEntry.objects.count())
+
+        expected = fixtures.REG_SYNC_LIST[1]
+        local = RegistryEntry.objects.get(pk=local.pk)
+        self.assertEqual(expected['fixity_value'], local.fixity_value)
+        self.assertEqual(expected['bag_size'], local.bag_size)
+        self.assertEqual(sorted(expected['replicating_node_names']),
+                         sorted(local.replicating_nodes.values_list(
+                             'name', flat=True)))
+        self.assertTrue(RegistryEntry.objects.filter(
+            pk="45dc38c3-6fc1-479a-98b4-855f3fe0304d").exists())
+
+        # nodes that sent their whole list are synced up to its end date
+        synced = datetime(2013, 9, 22, 18, 8, 55, tzinfo=timezone.utc)
+        self.assertEqual(synced, Node.objects.get(name='tdr').last_sync_date)
+        self.assertIsNone(Node.objects.get(name='aptrust').last_sync_date)
+        self.assertFalse(RegistrySyncReply.objects.filter(
+            reconciled=False).exists())
+
+        # once in sync nothing changes
+        self._save_lists()
+        stats = registry.solve_registry_conflicts()
+        self.assertEqual(3, stats['compared'])
+        self.assertEqual(0, stats['updated'])
+        self.assertEqual(0, stats['inserted'])
+
+    def test_incomplete_list_kept(self):
+        headers = dict(fixtures.make_headers(), correlation_id=str(uuid4()))
+        lists = [('sdr', dict(part=1, last_part=True)),
+                 ('tdr', dict(part=1, last_part=False))]
+        for node, part in lists:
+            req = RegistryListDateRangeReply(headers, dict(
+                fixtures.REGISTRY_LIST_DATERANGE,
+                reg_sync_list=copy.deepcopy(fixtures.REG_SYNC_LIST), **part))
+            registry.save_registries_from(node, req.payload())
+
+        registry.solve_registry_conflicts()
+
+        # tdr still has parts to send, its entries wait for them
+        self.assertFalse(NodeEntry.objects.filter(node='sdr').exists())
+        self.assertEqual(len(fixtures.REG_SYNC_LIST),
+                         NodeEntry.objects.filter(node='tdr').count())
+        self.assertFalse(RegistrySyncReply.objects.get(node='tdr').reconciled)
+        self.assertTrue(RegistrySyncReply.objects.get(node='sdr').reconciled)
+        self.assertIsNone(Node.objects.get(name='tdr').last_sync_date)
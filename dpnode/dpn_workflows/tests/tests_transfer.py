@@ -0,0 +1,202 @@
+import os
+import json
+import mock
+import hashlib
+import tempfile
+
+from django.test import TestCase
+
+from dpn_workflows.transfer import (
+    SegmentedDownload, TransferProgress, https_download
+)
+from dpn_workflows.models import (
+    Workflow, StorageReservation, TRANSFER, REPLICATE, STARTED
+)
+
+# ####################################################
+# tests for dpn_workflows/transfer.py
+
+class FakeRangeSession(object):
+    """
+    Serves byte ranges of some data the way a web server would.
+    """
+
+    def __init__(self, data, fail_ranges=()):
+        self.data = data
+        self.fail_ranges = fail_ranges
+        self.requested = []
+
+    def head(self, location, **kwargs):
+        return mock.MagicMock(status_code=200, headers={
+            'content-length': str(len(self.data)), 'accept-ranges': 'bytes'
+        })
+
+    def get(self, location, headers=None, **kwargs):
+        start, end = [int(i) for i in
+                      headers['Range'].split('=')[1].split('-')]
+        self.requested.append(start)
+        body = self.data[start:end + 1]
+        if start in self.fail_ranges:
+            body = body[:len(body) // 2]  # connection dropped
+        response = mock.MagicMock(status_code=206)
+        response.iter_content.side_effect = lambda chunk_size: [
+            body[i:i + chunk_size] for i in range(0, len(body), chunk_size)
+        ]
+        return response
+
+    def mount(self, prefix, adapter):
+        pass
+
+    def close(self):
+        pass
+
+
+class DPNTransferTest(TestCase):
+
+    def setUp(self):
+        self.data = os.urandom(1000000)
+        self.expected = hashlib.sha256(self.data).hexdigest()
+        fd, self.dst = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(self.dst)
+        self.action = Workflow.objects.create(
+            correlation_id='some-correlation-id',
+            dpn_object_id='some-object-id',
+            node='tdr',
+            action=REPLICATE,
+            step=TRANSFER,
+            state=STARTED,
+        )
+
+    def tearDown(self):
+        if os.path.exists(self.dst):
+            os.remove(self.dst)
+
+    def _download(self, session):
+        return SegmentedDownload(session, 'https://127.0.0.1/test.tar',
+                                 self.dst, len(self.data), 'sha256',
+                                 self.action)
+
+    def test_segmented_download(self):
+        session = FakeRangeSession(self.data)
+        with self.settings(DPN_XFER_SEGMENT_SIZE=300000,
+                           DPN_XFER_CHUNK_SIZE=7000,
+                           DPN_XFER_BUFFER_SIZE=50000):
+            fixity = self._download(session).run()
+
+        self.assertEqual(self.expected, fixity)
+        with open(self.dst, 'rb') as f:
+            self.assertEqual(self.data, f.read())
+        self.assertEqual([0, 300000, 600000, 900000],
+                         sorted(session.requested))
+
+        # a finished transfer leaves no checkpoint behind
+        action = Workflow.objects.get(pk=self.action.pk)
+        self.assertIsNone(action.transfer_checkpoint)
+
+    def test_preallocation_recorded(self):
+        reservation = StorageReservation.objects.create(
+            workflow=self.action, node='tdr', size=len(self.data))
+        with self.settings(DPN_XFER_SEGMENT_SIZE=300000):
+            self._download(FakeRangeSession(self.data)).run()
+
+        reservation = StorageReservation.objects.get(pk=reservation.pk)
+        self.assertTrue(reservation.preallocated)
+        self.assertEqual(0, reservation.outstanding)
+
+    def test_transfer_progress(self):
+        session = FakeRangeSession(self.data)
+        with self.settings(DPN_XFER_SEGMENT_SIZE=300000,
+                           DPN_XFER_PROGRESS_INTERVAL=0):
+            progress = TransferProgress(self.action)
+            SegmentedDownload(session, 'https://127.0.0.1/test.tar',
+                              self.dst, len(self.data), 'sha256',
+                              self.action, progress).run()
+            progress.finish()
+
+        action = Workflow.objects.get(pk=self.action.pk)
+        self.assertEqual(len(self.data), action.bytes_transferred)
+        self.assertIsNotNone(action.transfer_started)
+        self.assertGreater(action.throughput, 0)
+        self.assertIsNotNone(action.hash_elapsed)
+
+        # the instance is kept in sync so saving it keeps the values
+        self.action.save()
+        action = Workflow.objects.get(pk=self.action.pk)
+        self.assertEqual(len(self.data), action.bytes_transferred)
+
+    def test_resume_segmented_download(self):
+        with self.settings(DPN_XFER_SEGMENT_SIZE=300000,
+                           DPN_XFER_CHUNK_SIZE=7000):
+            session = FakeRangeSession(self.data, fail_ranges=[600000])
+            self.assertRaises(OSError, self._download(session).run)
+
+            checkpoint = json.loads(Workflow.objects.get(
+                pk=self.action.pk).transfer_checkpoint)
+            self.assertNotIn(2, checkpoint['done'])
+            self.assertEqual(len(self.data), os.path.getsize(self.dst))
+
+            # a retry only fetches the segments not checkpointed
+            session = FakeRangeSession(self.data)
+            fixity = self._download(session).run()
+
+        self.assertEqual(self.expected, fixity)
+        self.assertIn(600000, session.requested)
+        self.assertNotIn(0, session.requested)
+        with open(self.dst, 'rb') as f:
+            self.assertEqual(self.data, f.read())
+
+    def test_resumed_progress(self):
+        with self.settings(DPN_XFER_SEGMENT_SIZE=300000):
+            session = FakeRangeSession(self.data, fail_ranges=[600000])
+            self.assertRaises(OSError, self._download(session).run)
+            done = json.loads(Workflow.objects.get(
+                pk=self.action.pk).transfer_checkpoint)['done']
+
+            # the segments on disk are counted before fetching the others
+            progress = TransferProgress(self.action)
+            download = SegmentedDownload(
+                FakeRangeSession(self.data), 'https://127.0.0.1/test.tar',
+                self.dst, len(self.data), 'sha256', self.action, progress)
+            with mock.patch.object(download, '_fetch',
+                                   side_effect=OSError("dropped")):
+                self.assertRaises(OSError, download.run)
+
+        on_disk = sum(min(300000, len(self.data) - idx * 300000)
+                      for idx in done)
+        self.assertGreater(on_disk, 0)
+        self.assertEqual(on_disk, progress.bytes)
+
+    def test_resumed_throughput(self):
+        with self.settings(DPN_XFER_SEGMENT_SIZE=300000):
+            session = FakeRangeSession(self.data, fail_ranges=[600000])
+            self.assertRaises(OSError, self._download(session).run)
+
+            progress = TransferProgress(self.action)
+            SegmentedDownload(FakeRangeSession(self.data),
+                              'https://127.0.0.1/test.tar', self.dst,
+                              len(self.data), 'sha256', self.action,
+                              progress).run()
+            progress.finish()
+
+        # only part of the bag was fetched in the time of the retry
+        action = Workflow.objects.get(pk=self.action.pk)
+        self.assertEqual(len(self.data), action.bytes_transferred)
+        self.assertIsNotNone(action.transfer_elapsed)
+        self.assertIsNone(action.throughput)
+
+    def test_https_download_without_ranges(self):
+        session = FakeRangeSession(self.data)
+        session.head = lambda location, **kw: mock.MagicMock(
+            status_code=200, headers={'content-length': str(len(self.data))})
+        response = mock.MagicMock(status_code=200)
+        response.iter_content.return_value = [self.data[:10], self.data[10:]]
+        session.get = mock.MagicMock(return_value=response)
+
+        with mock.patch('requests.Session', return_value=session), \
+                self.settings(DPN_XFER_SEGMENT_SIZE=300000):
+            fixity = https_download('https://127.0.0.1/test.tar', self.dst)
+
+        self.assertEqual(self.expected, fixity)
+        session.get.assert_called_once_with('https://127.0.0.1/test.tar',
+                                            stream=True)
@@ -6,17 +6,29 @@
 """
 import os
 import sys
+import contextlib
 import mock
 import platform
+from datetime import timedelta
 
+from django.conf import settings
+from django.db import IntegrityError
 from django.test import TestCase
+from django.utils import timezone
 
+from dpn_workflows import utils
 from dpn_workflows.utils import (
     available_storage, choose_nodes, store_sequence,
-    validate_sequence, download_bag, generate_fixity,
-    protocol_str2db, remove_bag
+    delete_finished_sequences, download_bag, generate_fixity,
+    protocol_str2db, remove_bag, _follow_rsync_progress,
+    _rsync_progress_option
 )
-from dpn_workflows.models import SequenceInfo, PROTOCOL_DB_VALUES
+from dpn_workflows.models import (
+    SequenceInfo, Workflow, PROTOCOL_DB_VALUES, COMPLETE, SUCCESS, REPLICATE,
+    RECOVERY, TRANSFER_REPLY, TRANSFER_STATUS, AVAILABLE_REPLY,
+    LOCATION_REPLY
+)
+from dpnode.exceptions import DPNWorkflowError
 
 # ####################################################
 # tests for dpn-dpn_workflows/utils.py
@@ -43,14 +55,6 @@ class DPNWorkflowUtilsTest(TestCase):
         """
         sys.stdout = open(os.devnull, 'w')
     
-    def _test_sequence(self, sequence_num, sequence):
-        self.assertEqual(self.id, sequence.correlation_id, 
-            "The correlation id is different than the expected")
-        self.assertEqual(self.node, sequence.node, 
-            "The node name is different than the expected")
-        self.assertEqual(sequence_num, sequence.sequence, 
-            "The sequence number is different than the expected")
-    
     def test_available_storage_unix(self):
         result = 2048
         
@@ -65,44 +69,90 @@ class DPNWorkflowUtilsTest(TestCase):
                     "The available storage returns an invalid result")
         
     def test_choose_node(self):
-        node_list = [1, 2, 3, 4]
+        node_list = ["aptrust", "chron", "hathi", "sdr"]
         for i in range(len(node_list)):
             with self.settings(DPN_NUM_XFERS=i):
                 nodes_selected = choose_nodes(node_list)
             self.failUnlessEqual(i, len(nodes_selected))
     
     def test_store_sequence(self):
-        id = "some uuid correlation id"
-        node = "test node"
-        sequence_num = 1
-        
-        # We test when tere is no sequence in the database
-        sequence = store_sequence(self.id, self.node, sequence_num)
-        self._test_sequence(str(sequence_num), sequence)
-        
-        # We test when there is a sequence in the database
-        sequence_num = 2
-        sequence = store_sequence(self.id, self.node, sequence_num)
-        sequence_num = "1,2"
-        self._test_sequence(sequence_num, sequence)
-        
-    def test_validate_sequence(self):
-        good_sequence_info = SequenceInfo(self.id, self.node, "1,2")
-        bad_sequence_info = SequenceInfo(self.id, self.node, "3,2")
-        
-        self.assertTrue(validate_sequence(good_sequence_info), 
-            "Correct sequence failed validation")
-        
-        failed = False
-        try:
-            validate_sequence(bad_sequence_info)
-            failed = True
-        except:
-            self.assertTrue(True) 
-            
-        if failed:
-            self.fail("Incorrect sequence passed validation")
+        store_sequence(self.id, self.node, 0)
+        store_sequence(self.id, self.node, 2)
+        # the other node of the transaction has its own sequence
+        store_sequence(self.id, "other node", 1)
+
+        sequence = SequenceInfo.objects.get(correlation_id=self.id,
+                                            node=self.node)
+        self.assertEqual(2, sequence.last_sequence)
+
+        for out_of_order in [2, 1]:
+            self.assertRaises(DPNWorkflowError, store_sequence, self.id,
+                              self.node, out_of_order)
+        self.assertEqual(2, SequenceInfo.objects.get(pk=sequence.pk
+                                                     ).last_sequence)
+
+    def test_store_sequence_first_race(self):
+        # another worker saves the first sequence between our update and
+        # our create, which then fails on the unique constraint. There is
+        # no savepoint so the row of the other worker stays.
+        def other_first(**kwargs):
+            SequenceInfo.objects.bulk_create([SequenceInfo(
+                correlation_id=self.id, node=self.node, last_sequence=1)])
+            raise IntegrityError("UNIQUE constraint failed")
+
+        @contextlib.contextmanager
+        def atomic():
+            yield
+        no_savepoint = mock.Mock(atomic=atomic)
+
+        for sequence, accepted in [(3, True), (1, False)]:
+            SequenceInfo.objects.all().delete()
+            with mock.patch('dpn_workflows.utils.transaction', no_savepoint), \
+                    mock.patch.object(SequenceInfo.objects, 'create',
+                                      side_effect=other_first):
+                if accepted:
+                    store_sequence(self.id, self.node, sequence)
+                else:
+                    self.assertRaises(DPNWorkflowError, store_sequence,
+                                      self.id, self.node, sequence)
+            self.assertEqual(sequence if accepted else 1,
+                             SequenceInfo.objects.get().last_sequence)
+
+    def test_delete_finished_sequences(self):
+        for cid, state in [("finished", COMPLETE), ("running", SUCCESS)]:
+            Workflow.objects.create(correlation_id=cid, dpn_object_id=cid,
+                                    node=self.node, action=REPLICATE,
+                                    step=TRANSFER_REPLY, state=state)
+            store_sequence(cid, self.node, 4)
+        later = timezone.now() + timedelta(days=1)
+
+        self.assertEqual(0, delete_finished_sequences())
+        self.assertEqual(1, delete_finished_sequences(later))
+        self.assertEqual(["running"], list(
+            SequenceInfo.objects.values_list('correlation_id', flat=True)))
+
+        # a transaction in progress for too long is forgotten too
+        with self.settings(DPN_SEQUENCE_MAX_AGE=60):
+            self.assertEqual(1, delete_finished_sequences(later))
     
+    def test_delete_finished_recoveries(self):
+        for cid, node, action, step in [
+                ("served", self.node, RECOVERY, TRANSFER_REPLY),
+                ("recovered", self.node, RECOVERY, TRANSFER_STATUS),
+                ("offered", self.node, RECOVERY, AVAILABLE_REPLY),
+                ("replicated", settings.DPN_NODE_NAME, REPLICATE,
+                 LOCATION_REPLY)]:
+            Workflow.objects.create(correlation_id=cid, dpn_object_id=cid,
+                                    node=node, action=action, step=step,
+                                    state=SUCCESS)
+            store_sequence(cid, self.node, 2)
+        later = timezone.now() + timedelta(days=1)
+
+        # only the recovery waiting for a transfer request is left
+        self.assertEqual(3, delete_finished_sequences(later))
+        self.assertEqual(["offered"], list(
+            SequenceInfo.objects.values_list('correlation_id', flat=True)))
+
     def test_protocol_str2db(self):        
         for protocol in PROTOCOL_DB_VALUES:
             self.assertEquals(PROTOCOL_DB_VALUES[protocol],
@@ -140,6 +190,62 @@ class DPNWorkflowUtilsTest(TestCase):
         self.assertRaises(Exception,
             download_bag, self.node, rsync_location, rsync)
         
+    def test_download_bag_https_fixity(self):
+        result = "916f0027a575074ce72a331777c3478d6513f786a591bd892da1a577bf2335f9"
+        response = mock.MagicMock(status_code=200)
+        response.iter_content.return_value = [b'test ', b'', b'data']
+        session = mock.MagicMock()
+        session.head.return_value = mock.MagicMock(status_code=200, headers={})
+        session.get.return_value = response
+
+        self._stdout2null()
+
+        with mock.patch("requests.Session", return_value=session), \
+            mock.patch("builtins.open", mock.mock_open()) as open_mock:
+            with self.settings(DPN_REPLICATION_ROOT="/tmp"):
+                path, fixity = download_bag(
+                    self.node, "https://127.0.0.1/outbound/test.tar", "https")
+
+        self.assertEqual("/tmp/test.tar", path,
+            "The local bag path differs from the expected")
+        self.assertEqual(result, fixity,
+            "The fixity calculated while downloading differs from expected")
+        open_mock.assert_called_once_with("/tmp/test.tar", "wb",
+                                          buffering=mock.ANY)
+
+    def test_follow_rsync_progress(self):
+        r, w = os.pipe()
+        os.write(w, b"test.tar\n"
+                    b"      32,768   0%    0.00kB/s    0:00:00\r"
+                    b"   1,048,576 100%   12.34MB/s    0:00:00 (xfr#1)\n"
+                    b"total size is 1,048,576")
+        os.close(w)
+        progress = mock.MagicMock()
+        with os.fdopen(r, 'rb') as stream:
+            output = _follow_rsync_progress(stream, progress)
+
+        self.assertEqual([mock.call(32768), mock.call(1048576)],
+                         progress.set.call_args_list)
+        self.assertEqual("test.tar\ntotal size is 1,048,576", output)
+
+    @mock.patch("dpn_workflows.utils._rsync_option", None)
+    @mock.patch("subprocess.check_output")
+    def test_rsync_progress_option(self, check_output):
+        check_output.return_value = (
+            b"rsync  version 3.0.9  protocol version 30\n")
+        self.assertEqual("--progress", _rsync_progress_option())
+        # read once per process
+        check_output.return_value = (
+            b"rsync  version 3.1.2  protocol version 31\n")
+        self.assertEqual("--progress", _rsync_progress_option())
+
+        utils._rsync_option = None
+        self.assertEqual("--info=progress2", _rsync_progress_option())
+
+        utils._rsync_option = None
+        check_output.side_effect = OSError(2, "No such file or directory")
+        self.assertEqual("--progress", _rsync_progress_option())
+
     def test_remove_bag(self):
         test_mock = mock.MagicMock()
         with mock.patch("os.remove", test_mock):
@@ -0,0 +1,416 @@
+"""
+    If you want to go fast, go alone. If you want to go far, go together.
+
+            - African proverb
+"""
+
+# HTTPS transfers of DPN bags. Large bags are split in byte ranges that are
+# fetched concurrently over a pooled session and written in place into a
+# preallocated file. Finished segments are checkpointed in the Workflow row
+# so a retried task only fetches what is missing.
+#
+# The progress of every transfer is recorded in its Workflow row as well.
+
+import os
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from django.conf import settings
+from django.utils import timezone
+
+from dpn_workflows.models import Workflow
+from dpn_workflows.fixity import new_hasher, get_blocksize
+from dpn_workflows.storage import renew_transfer_slot, mark_preallocated
+
+logger = logging.getLogger('dpnmq.console')
+
+DEFAULT_SEGMENT_SIZE = 256 * 1024 * 1024  # 256 MiB
+DEFAULT_SEGMENT_WORKERS = 4
+DEFAULT_CHUNK_SIZE = 1024 * 1024  # 1 MiB
+DEFAULT_BUFFER_SIZE = 8 * 1024 * 1024  # 8 MiB
+DEFAULT_PROGRESS_INTERVAL = 5  # seconds
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class TransferProgress(object):
+    """
+    Counts the bytes of a transfer and the time spent hashing them, and
+    saves the progress in the Workflow row of the transfer at most once
+    every DPN_XFER_PROGRESS_INTERVAL seconds, renewing its transfer slot.
+
+    Bytes can be added from any thread but the row is only written from
+    the thread calling flush or finish.
+    """
+
+    def __init__(self, action=None):
+        """
+        :param action: Workflow instance of the transfer or None
+        """
+        self.action = action
+        self.interval = _setting('DPN_XFER_PROGRESS_INTERVAL',
+                                 DEFAULT_PROGRESS_INTERVAL)
+        self.bytes = 0
+        self.resumed = False
+        self.hash_elapsed = 0.0
+        self.started = time.time()
+        self._flushed = self.started
+        self._lock = threading.Lock()
+
+        if self._saveable():
+            self._update(transfer_started=timezone.now(), bytes_transferred=0,
+                         transfer_elapsed=None, throughput=None,
+                         hash_elapsed=None)
+
+    def _saveable(self):
+        return self.action is not None and self.action.pk is not None
+
+    def _update(self, **fields):
+        # the instance is kept in sync so a later save() does not
+        # overwrite the values with stale ones
+        for name, value in fields.items():
+            setattr(self.action, name, value)
+        Workflow.objects.filter(pk=self.action.pk).update(**fields)
+
+    def add(self, nbytes):
+        with self._lock:
+            self.bytes += nbytes
+
+    def set(self, nbytes):
+        with self._lock:
+            self.bytes = nbytes
+
+    def resume(self, nbytes):
+        """
+        Starts the count from the bytes a previous attempt left on disk.
+        """
+        with self._lock:
+            self.bytes = nbytes
+            self.resumed = True
+
+    def hash(self, hasher, buf):
+        """
+        Updates hasher with buf accounting the time it takes.
+        """
+        start = time.time()
+        hasher.update(buf)
+        with self._lock:
+            self.hash_elapsed += time.time() - start
+
+    def add_hash_time(self, seconds):
+        with self._lock:
+            self.hash_elapsed += seconds
+
+    def flush(self, force=False):
+        """
+        Saves the bytes transferred so far and renews the transfer slot if
+        the interval has passed.
+        """
+        now = time.time()
+        if not self._saveable() or \
+                (not force and now - self._flushed < self.interval):
+            return
+        self._flushed = now
+        self._update(bytes_transferred=self.bytes)
+        renew_transfer_slot(self.action)
+
+    def finish(self):
+        """
+        Saves the elapsed time, throughput and hash time of the transfer.
+        """
+        elapsed = time.time() - self.started
+        if self.action is None:
+            return
+        self.action.record_transfer(self.bytes, elapsed, self.hash_elapsed,
+                                    self.resumed)
+        if self._saveable():
+            self._update(bytes_transferred=self.action.bytes_transferred,
+                         transfer_elapsed=self.action.transfer_elapsed,
+                         throughput=self.action.throughput,
+                         hash_elapsed=self.action.hash_elapsed)
+
+
+def _new_session(workers):
+    """
+    Returns a requests session able to keep a connection per worker.
+
+    :param workers: Integer of concurrent connections to the same host
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def _pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def _preallocate(fd, size):
+    """
+    Reserves the space for the whole file, falling back to a sparse file
+    when the filesystem does not support fallocate.
+
+    :return: Boolean True if the space was allocated
+    """
+    try:
+        os.posix_fallocate(fd, 0, size)
+        return True
+    except (AttributeError, OSError):
+        os.ftruncate(fd, size)
+        return False
+
+
+class SegmentedDownload(object):
+    """
+    Downloads a file as concurrent byte range requests.
+    """
+
+    def __init__(self, session, location, dst, size, algorithm='sha256',
+                 action=None, progress=None):
+        """
+        :param session: requests.Session used for every segment
+        :param location: String url of the file
+        :param dst: String of the local path to write to
+        :param size: Integer of the size of the remote file
+        :param algorithm: String of the fixity algorithm
+        :param action: Workflow instance to checkpoint finished segments
+        :param progress: TransferProgress of the transfer
+        """
+        self.session = session
+        self.location = location
+        self.dst = dst
+        self.size = size
+        self.algorithm = algorithm
+        self.action = action
+        self.progress = progress or TransferProgress()
+        self.segment_size = _setting('DPN_XFER_SEGMENT_SIZE',
+                                     DEFAULT_SEGMENT_SIZE)
+        self.workers = _setting('DPN_XFER_SEGMENT_WORKERS',
+                                DEFAULT_SEGMENT_WORKERS)
+        self.chunk_size = _setting('DPN_XFER_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+        self.buffer_size = _setting('DPN_XFER_BUFFER_SIZE',
+                                    DEFAULT_BUFFER_SIZE)
+        self.segments = [
+            (start, min(start + self.segment_size, size) - 1)
+            for start in range(0, size, self.segment_size)
+        ]
+        self.done = set()
+
+    # Checkpoints
+    # -----------
+    def _checkpoint_key(self):
+        return {
+            'location': self.location,
+            'size': self.size,
+            'segment_size': self.segment_size,
+        }
+
+    def load_checkpoint(self):
+        """
+        Restores the finished segments of a previous attempt. The checkpoint
+        is read from the database because the task arguments are stale.
+        """
+        if not self.action or not self.action.pk:
+            return
+        raw = Workflow.objects.filter(pk=self.action.pk).values_list(
+            'transfer_checkpoint', flat=True).first()
+        if not raw or not os.path.isfile(self.dst) or \
+                os.path.getsize(self.dst) != self.size:
+            return
+        checkpoint = json.loads(raw)
+        if dict((k, checkpoint.get(k)) for k in self._checkpoint_key()) \
+                == self._checkpoint_key():
+            self.done = set(checkpoint.get('done', []))
+            logger.info("Resuming %s, %d of %d segments already transferred"
+                        % (self.location, len(self.done), len(self.segments)))
+
+    def save_checkpoint(self, clear=False):
+        if not self.action or not self.action.pk:
+            return
+        checkpoint = None
+        if not clear:
+            checkpoint = self._checkpoint_key()
+            checkpoint['done'] = sorted(self.done)
+            checkpoint = json.dumps(checkpoint)
+        self.action.transfer_checkpoint = checkpoint
+        Workflow.objects.filter(pk=self.action.pk).update(
+            transfer_checkpoint=checkpoint)
+
+    # Transfer
+    # --------
+    def _fetch(self, fd, idx):
+        start, end = self.segments[idx]
+        headers = {'Range': 'bytes=%d-%d' % (start, end)}
+        r = self.session.get(self.location, headers=headers, stream=True)
+        try:
+            if r.status_code != 206:
+                raise OSError("Range request for %s returned HTTP %s"
+                              % (self.location, r.status_code))
+
+            offset = start
+            buf = bytearray()
+            for chunk in r.iter_content(chunk_size=self.chunk_size):
+                buf.extend(chunk)
+                self.progress.add(len(chunk))
+                if len(buf) >= self.buffer_size:
+                    _pwrite_all(fd, buf, offset)
+                    offset += len(buf)
+                    buf = bytearray()
+            if buf:
+                _pwrite_all(fd, buf, offset)
+                offset += len(buf)
+        finally:
+            r.close()
+
+        if offset != end + 1:
+            raise OSError("Segment %d of %s is incomplete (%d of %d bytes)"
+                          % (idx, self.location, offset - start,
+                             end + 1 - start))
+        return idx
+
+    def _hash_segment(self, fd, hasher, idx):
+        # the segment was just written, so this is served by the page cache
+        start, end = self.segments[idx]
+        blocksize = get_blocksize()
+        offset = start
+        while offset <= end:
+            buf = os.pread(fd, min(blocksize, end + 1 - offset), offset)
+            if not buf:
+                raise OSError("Unexpected end of file hashing %s" % self.dst)
+            self.progress.hash(hasher, buf)
+            offset += len(buf)
+
+    def run(self):
+        """
+        Transfers the missing segments and returns the fixity of the file.
+        """
+        self.load_checkpoint()
+        if self.done:
+            self.progress.resume(sum(self.segments[idx][1] + 1 -
+                                     self.segments[idx][0]
+                                     for idx in self.done))
+        hasher = new_hasher(self.algorithm)
+        next_hash = 0
+        error = None
+
+        fd = os.open(self.dst, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if not self.done and _preallocate(fd, self.size) and \
+                    self.action is not None:
+                mark_preallocated(self.action)
+
+            pending = [idx for idx in range(len(self.segments))
+                       if idx not in self.done]
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = [executor.submit(self._fetch, fd, idx)
+                           for idx in pending]
+                for future in as_completed(futures):
+                    try:
+                        self.done.add(future.result())
+                    except Exception as err:
+                        # let the running segments finish so they are
+                        # checkpointed, skip the ones not started yet
+                        error = error or err
+                        for ftr in futures:
+                            ftr.cancel()
+                        continue
+                    self.save_checkpoint()
+                    self.progress.flush()
+
+                    # hash the contiguous segments available so far
+                    while error is None and next_hash in self.done:
+                        self._hash_segment(fd, hasher, next_hash)
+                        next_hash += 1
+
+            if error is not None:
+                raise OSError("Transfer of %s failed: %s"
+                              % (self.location, error))
+
+            while next_hash < len(self.segments):
+                self._hash_segment(fd, hasher, next_hash)
+                next_hash += 1
+        finally:
+            os.close(fd)
+
+        self.save_checkpoint(clear=True)
+        return hasher.hexdigest()
+
+
+def stream_download(session, location, dst, algorithm='sha256',
+                    progress=None):
+    """
+    Downloads a file as a single stream hashing the bytes as they arrive.
+
+    :param session: requests.Session to use
+    :param location: String url of the file
+    :param dst: String of the local path to write to
+    :param algorithm: String of the fixity algorithm
+    :param progress: TransferProgress of the transfer
+    :return: String of the fixity value
+    """
+    progress = progress or TransferProgress()
+    hasher = new_hasher(algorithm)
+    chunk_size = _setting('DPN_XFER_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+    buffer_size = _setting('DPN_XFER_BUFFER_SIZE', DEFAULT_BUFFER_SIZE)
+
+    r = session.get(location, stream=True)
+    try:
+        if r.status_code != 200:
+            raise OSError("Request for %s returned HTTP %s"
+                          % (location, r.status_code))
+        with open(dst, 'wb', buffering=buffer_size) as f:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                if chunk:
+                    f.write(chunk)
+                    progress.add(len(chunk))
+                    progress.hash(hasher, chunk)
+                    progress.flush()
+    finally:
+        r.close()
+
+    return hasher.hexdigest()
+
+
+def https_download(location, dst, algorithm='sha256', action=None,
+                   progress=None):
+    """
+    Downloads a bag over https. Bags bigger than one segment are fetched
+    as concurrent byte ranges when the server supports them.
+
+    :param location: String url of the bag
+    :param dst: String of the local path to write to
+    :param algorithm: String of the fixity algorithm
+    :param action: Workflow instance used to checkpoint the transfer
+    :param progress: TransferProgress of the transfer
+    :return: String of the fixity value
+    """
+    workers = _setting('DPN_XFER_SEGMENT_WORKERS', DEFAULT_SEGMENT_WORKERS)
+    segment_size = _setting('DPN_XFER_SEGMENT_SIZE', DEFAULT_SEGMENT_SIZE)
+    session = _new_session(workers)
+
+    try:
+        head = session.head(location, allow_redirects=True)
+        size = int(head.headers.get('content-length') or 0)
+        ranges = head.headers.get('accept-ranges', '').lower() == 'bytes'
+
+        if head.status_code == 200 and ranges and size > segment_size:
+            download = SegmentedDownload(session, location, dst, size,
+                                         algorithm, action, progress)
+            return download.run()
+
+        return stream_download(session, location, dst, algorithm, progress)
+    finally:
+        session.close()
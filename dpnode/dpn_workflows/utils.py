@@ -1,17 +1,30 @@
 import os
+import re
 import copy
+import time
 import ctypes
-import random
-import hashlib
 import logging
 import platform
+import threading
 import subprocess
-import requests
+
+from datetime import timedelta
 
 from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import Q
+from django.utils import timezone
 from dpn_workflows.models import (
-    PROTOCOL_DB_VALUES, SequenceInfo
+    PROTOCOL_DB_VALUES, SequenceInfo, Workflow, VERIFY_REPLY, FAILED,
+    CANCELLED, COMPLETE, SUCCESS, RECOVERY, TRANSFER_REPLY, TRANSFER_STATUS,
+    LOCATION_REPLY, TRANSFER_REQUEST
+)
+from dpnode.exceptions import DPNWorkflowError
+from dpn_workflows.fixity import (
+    new_hasher, get_blocksize, cached_fixity, remember_fixity, forget_fixity
 )
+from dpn_workflows.transfer import https_download, TransferProgress
+from dpn_workflows.ranking import rank_nodes
 
 logger = logging.getLogger('dpnmq.console')
 
@@ -40,55 +53,108 @@ def available_storage(path):
     return free_bytes
 
 
-def choose_nodes(node_list):
+def choose_nodes(node_list, count=None):
     """
-    Chooses the nodes to replicate with 
-    based on some kind of match score 
+    Chooses the nodes to replicate with, the best ranked from their
+    transfer history.
 
     :param node_list: A list of acknowledge or available nodes 
-    :returns: two appropiate nodes to replicate with.
+    :param count: Integer of nodes to choose, defaults to DPN_NUM_XFERS
+    :returns: list of the appropiate nodes to replicate with.
     """
-
-    # TODO: define a way or ranking to choose nodes
-    # Doing random for now
-
-    return random.sample(node_list, settings.DPN_NUM_XFERS)
-    # TODO: change number to 2, now is 1 for testing purposes
+    if count is None:
+        count = settings.DPN_NUM_XFERS
+    return rank_nodes(node_list)[:count]
 
 
 def store_sequence(id, node_name, sequence_num):
-    try:
-        sequence = SequenceInfo.objects.get(correlation_id=id)
-        sequence.sequence = "%s,%s" % (sequence.sequence, sequence_num)
-        return sequence
-    except SequenceInfo.DoesNotExist:
-        sequence = SequenceInfo(correlation_id=id, node=node_name,
-                                sequence=str(sequence_num))
-        sequence.save()
-        return sequence
-
-
-def validate_sequence(sequence_info):
-    sequence = sequence_info.sequence.split(',')
-    prev_num = -1
-
-    for num in sequence:
-        if int(num) <= prev_num:
-            raise "Worklow sequence is out of sync in transaction %s from %s!" % (
-            sequence_info.correlation_id, sequence_info.node)
-        prev_num = int(num)
+    """
+    Records the sequence number of a message of a transaction, it has to be
+    higher than the last one of the node. The check and the update are one
+    conditional update, so workers handling messages of the same
+    transaction at once never both pass.
+
+    :param id: String of correlation_id of the transaction
+    :param node_name: String of the node the message is with
+    :param sequence_num: Integer of the sequence of the message
+    :raises DPNWorkflowError: if the sequence is out of order
+    """
+    sequence_num = int(sequence_num)
+    sequences = SequenceInfo.objects.filter(correlation_id=id, node=node_name)
 
-    return True
+    def update():
+        return sequences.filter(last_sequence__lt=sequence_num).update(
+            last_sequence=sequence_num, updated_at=timezone.now())
 
+    if update():
+        return
 
-def download_bag(node, location, protocol):
+    try:
+        with transaction.atomic():
+            SequenceInfo.objects.create(correlation_id=id, node=node_name,
+                                        last_sequence=sequence_num)
+    except IntegrityError:
+        # another worker created the row first, ours may still be higher
+        if update():
+            return
+        last = sequences.values_list('last_sequence', flat=True)
+        raise DPNWorkflowError(
+            "Workflow sequence is out of sync in transaction %s from %s! "
+            "%d received after %s" % (id, node_name, sequence_num,
+                                      last[0] if last else None))
+
+
+def delete_finished_sequences(now=None):
     """
-    Transfers the bag according to the selected protocol
-    
+    Deletes the sequences of the transactions with no workflow in progress
+    for DPN_SEQUENCE_CLEANUP_AGE seconds, and of any transaction idle for
+    DPN_SEQUENCE_MAX_AGE seconds.
+
+    :return: Integer of sequences deleted
+    """
+    now = now or timezone.now()
+    cleanup_age = getattr(settings, 'DPN_SEQUENCE_CLEANUP_AGE', 60 * 60)
+    max_age = getattr(settings, 'DPN_SEQUENCE_MAX_AGE', 30 * 24 * 60 * 60)
+
+    # the last step of each side of a transaction: the verify reply of a
+    # replication, the transfer reply of the node serving a recovery, the
+    # transfer status of the node recovering it, and our own action once
+    # our query chose its nodes
+    finished_steps = (
+        Q(step=VERIFY_REPLY) |
+        Q(action=RECOVERY, step__in=[TRANSFER_REPLY, TRANSFER_STATUS],
+          state=SUCCESS) |
+        Q(node=settings.DPN_NODE_NAME,
+          step__in=[LOCATION_REPLY, TRANSFER_REQUEST])
+    )
+    in_progress = Workflow.objects.exclude(finished_steps).exclude(
+        state__in=[FAILED, CANCELLED, COMPLETE]
+    ).values('correlation_id')
+    finished = SequenceInfo.objects.filter(
+        updated_at__lt=now - timedelta(seconds=cleanup_age)
+    ).exclude(correlation_id__in=in_progress)
+    idle = SequenceInfo.objects.filter(
+        updated_at__lt=now - timedelta(seconds=max_age))
+
+    deleted = 0
+    for sequences in [finished, idle]:
+        deleted += sequences.count()
+        sequences.delete()
+    return deleted
+
+
+def download_bag(node, location, protocol, algorithm='sha256', action=None):
+    """
+    Transfers the bag according to the selected protocol and calculates
+    its fixity value while the bytes arrive, so the bag does not need to
+    be read again from disk once the transfer is complete.
+
     :param node: String of node name
     :param location: String url of the bag 
     :param protocol: selected protocol by node
-    :returns: bag file
+    :param algorithm: String of the fixity algorithm to use
+    :param action: Workflow instance to record the transfer progress in
+    :returns: tuple of (local bag path, fixity value)
     """
 
     print("Trying to transfer via %s protocol" % protocol)
@@ -97,25 +163,55 @@ def download_bag(node, location, protocol):
         basefile = os.path.basename(location)
         local_bagfile = os.path.join(settings.DPN_REPLICATION_ROOT, basefile)
 
-        # TODO: catch exceptions. Need to define behavior in case of errors (same to rsync)
-        r = requests.get(location, stream=True)
-        with open(local_bagfile, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=1024):
-                if chunk:
-                    f.write(chunk)
-                    f.flush()
-
-        return local_bagfile
+        progress = TransferProgress(action)
+        fixity_value = https_download(location, local_bagfile, algorithm,
+                                      action, progress)
+        progress.finish()
+        remember_fixity(local_bagfile, algorithm, fixity_value)
+        return local_bagfile, fixity_value
 
     elif protocol == 'rsync':
         filename = os.path.basename(location.split(":")[1])
         dst = os.path.join(settings.DPN_REPLICATION_ROOT, filename)
-        command = ["rsync", "-Lav", "--compress",
-                   "--compress-level=0", location, dst]
+
+        # rsync only writes a new file sequentially, so we can hash it
+        # as it grows. A partial copy already on disk will be patched by
+        # rsync in place, in that case we hash the result afterwards.
+        resumed = os.path.exists(dst)
+        command = ["rsync", "-Lav", "--inplace", _rsync_progress_option(),
+                   "--compress", "--compress-level=0", location, dst]
+        progress = TransferProgress(action)
+        if resumed:
+            progress.resume(os.path.getsize(dst))
         try:
             with subprocess.Popen(command, stdout=subprocess.PIPE) as proc:
-                logger.info("%s" % str(proc.communicate()[0], "utf-8"))
-            return dst
+                follower = None
+                if not resumed:
+                    follower = _FileHashFollower(dst, proc, algorithm)
+                    follower.start()
+                logger.info("%s" % _follow_rsync_progress(proc.stdout,
+                                                          progress))
+                proc.wait()
+
+            if follower:
+                follower.join()
+
+            if proc.returncode != 0:
+                raise OSError("rsync exited with status %s transferring %s"
+                              % (proc.returncode, location))
+
+            if follower and follower.complete(os.path.getsize(dst)):
+                fixity_value = follower.hexdigest()
+                progress.add_hash_time(follower.hash_elapsed)
+                progress.finish()
+                remember_fixity(dst, algorithm, fixity_value)
+                return dst, fixity_value
+
+            hash_start = time.time()
+            fixity_value = generate_fixity(dst, algorithm)
+            progress.add_hash_time(time.time() - hash_start)
+            progress.finish()
+            return dst, fixity_value
 
         except Exception as err:
             logger.error("ERROR Transfer failed: %s" % err)
@@ -125,29 +221,125 @@ def download_bag(node, location, protocol):
         raise NotImplementedError
 
 
-def generate_fixity(bag_path, algorithm='sha256'):
+_RSYNC_PROGRESS = re.compile(br'^\s*([\d,]+)\s+\d+%')
+_RSYNC_VERSION = re.compile(br'version\s+(\d+)\.(\d+)')
+_rsync_option = None
+
+
+def _rsync_progress_option():
     """
-    Returns the fixity value for a given bag file
-    stored in local 
+    Returns the rsync option printing the progress of the transfer.
+    --info=progress2 needs rsync 3.1 or later, older versions print the
+    same progress lines for each file with --progress, a bag is a single
+    file anyway. The version is read once per process.
+    """
+    global _rsync_option
+    if _rsync_option is None:
+        try:
+            match = _RSYNC_VERSION.search(
+                subprocess.check_output(["rsync", "--version"]))
+        except (OSError, subprocess.CalledProcessError) as err:
+            logger.warning("Unable to read the rsync version: %s" % err)
+            match = None
+        if match and tuple(int(v) for v in match.groups()) >= (3, 1):
+            _rsync_option = "--info=progress2"
+        else:
+            _rsync_option = "--progress"
+    return _rsync_option
+
+
+def _follow_rsync_progress(stream, progress):
+    """
+    Reads the output of rsync --info=progress2 or --progress updating the
+    progress of the transfer with the bytes copied so far.
 
-    :param bag_path: The path of the local bag file
-    :return 
+    :param stream: stdout of the rsync process
+    :param progress: TransferProgress of the transfer
+    :return: String with the rest of the rsync output
+    """
+    output = []
+    pending = b''
+    while True:
+        data = os.read(stream.fileno(), 65536)
+        if not data:
+            break
+        # progress lines are rewritten with carriage returns
+        lines = re.split(br'[\r\n]', pending + data)
+        pending = lines.pop()
+        for line in lines:
+            match = _RSYNC_PROGRESS.match(line)
+            if match:
+                progress.set(int(match.group(1).replace(b',', b'')))
+                progress.flush()
+            elif line.strip():
+                output.append(line)
+    if pending.strip():
+        output.append(pending)
+    return str(b'\n'.join(output), 'utf-8', 'replace')
+
+
+class _FileHashFollower(threading.Thread):
+    """
+    Hashes a file while another process is still writing it, reading
+    each new block right after it lands in the page cache.
     """
-    blocksize = 65536
+    poll_interval = 0.5
+
+    def __init__(self, path, proc, algorithm='sha256'):
+        super(_FileHashFollower, self).__init__()
+        self.daemon = True
+        self.path = path
+        self.proc = proc
+        self.hasher = new_hasher(algorithm)
+        self.blocksize = get_blocksize()
+        self.bytes_read = 0
+        self.hash_elapsed = 0.0
+
+    def run(self):
+        while not os.path.exists(self.path):
+            if self.proc.poll() is not None:
+                return
+            time.sleep(self.poll_interval)
+
+        with open(self.path, 'rb') as f:
+            while True:
+                # check the writer before reading so that the last
+                # read after it exits always reaches the real EOF
+                finished = self.proc.poll() is not None
+                buf = f.read(self.blocksize)
+                if buf:
+                    start = time.time()
+                    self.hasher.update(buf)
+                    self.hash_elapsed += time.time() - start
+                    self.bytes_read += len(buf)
+                elif finished:
+                    return
+                else:
+                    time.sleep(self.poll_interval)
 
-    if algorithm not in settings.DPN_FIXITY_CHOICES:
-        raise NotImplementedError
+    def complete(self, size):
+        """
+        Returns True if every byte of the file went through the hasher.
 
-    if algorithm == 'sha256':
-        hasher = hashlib.sha256()
-        with open(bag_path, 'rb') as f:
-            buf = f.read(blocksize)
-            while len(buf) > 0:
-                hasher.update(buf)
-                buf = f.read(blocksize)
-        return hasher.hexdigest()
+        :param size: Integer of the final size of the file
+        """
+        return self.bytes_read == size
 
-        # TODO: implement hashing checksum for other algorithms
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
+def generate_fixity(bag_path, algorithm='sha256'):
+    """
+    Returns the fixity value for a given bag file
+    stored in local. The value is read from the fixity cache
+    while the file has not changed since it was last hashed.
+
+    :param bag_path: The path of the local bag file
+    :param algorithm: String of the fixity algorithm to use
+    :return: String of the hexdigest
+    """
+    return cached_fixity(bag_path, algorithm)
 
 
 def protocol_str2db(protocol_str):
@@ -173,6 +365,7 @@ def remove_bag(bag_path):
 
     try:
         os.remove(bag_path)
+        forget_fixity(bag_path)
     except OSError as err:
         logger.info(err)
         return False
@@ -266,7 +459,13 @@ class ModelToDict(object):
                     flat = True
                     flat_fields = ['pk']
 
-                if instance_attr:
+                prefetched = getattr(instance, '_prefetched_objects_cache',
+                                     {}).get(field)
+                if prefetched is not None:
+                    # use the objects from prefetch_related, no queries
+                    self[key] = self.get_prefetched_values(
+                        prefetched, flat_fields, flat)
+                elif instance_attr:
                     self[key] = list(
                         instance_attr.all().values_list(*flat_fields,
                                                         flat=flat))
@@ -280,6 +479,14 @@ class ModelToDict(object):
     def __setitem__(self, key, item):
         setattr(self, key, item)
 
+    def get_prefetched_values(self, objects, fields, flat=False):
+        """
+        Returns the same list values_list would for already fetched objects
+        """
+        if flat:
+            return [getattr(obj, fields[0]) for obj in objects]
+        return [tuple(getattr(obj, f) for f in fields) for obj in objects]
+
     def as_dict(self):
         dicc = copy.copy(self.__dict__)
         del dicc['instance']
@@ -0,0 +1,7 @@
+from django.contrib import admin
+from dpnmq.models import OutboxMessage
+
+class OutboxMessageAdmin(admin.ModelAdmin):
+    list_display = ('directive', 'routing_key', 'state', 'attempts', 'next_attempt', 'created_at', 'sent_at')
+    list_filter = ('state', 'directive')
+admin.site.register(OutboxMessage, OutboxMessageAdmin)
@@ -6,25 +6,104 @@
 """
 
 from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import queue
 import logging
+import threading
 
+from django.conf import settings
+from django.db import close_old_connections
 from kombu.mixins import ConsumerMixin
 from kombu import Queue, Exchange
 
 from dpnode.settings import DPN_NODE_NAME
 from dpnode.exceptions import DPNMessageError
 from dpnmq.handlers import broadcast_router, local_router
-from dpnmq.utils import dpn_strptime, dpn_strftime, json_loads
+from dpnmq.utils import dpn_strptime, json_loads
 
 logger = logging.getLogger('dpnmq.console')
 
+DEFAULT_BROADCAST_PREFETCH = 8
+DEFAULT_LOCAL_PREFETCH = 16
+
+
+class _DeferredAckMessage(object):
+    """
+    Wraps a kombu message handled in a worker thread. Channels are not
+    thread safe, so acks and rejects are queued to be sent by the thread
+    running the consumer loop.
+    """
+
+    def __init__(self, msg, acks):
+        self._msg = msg
+        self._acks = acks
+        self.settled = False
+
+    def __getattr__(self, name):
+        return getattr(self._msg, name)
+
+    def _defer(self, fun, *args, **kwargs):
+        self.settled = True
+        self._acks.put((fun, args, kwargs))
+
+    def ack(self):
+        self._defer(self._msg.ack)
+
+    def reject(self, *args, **kwargs):
+        self._defer(self._msg.reject, *args, **kwargs)
+
+    def requeue(self):
+        self._defer(self._msg.requeue)
+
+
+class _SerialKeyExecutor(object):
+    """
+    Runs jobs in a pool of threads. Jobs submitted with the same key run
+    one after the other in the order they were submitted.
+    """
+
+    def __init__(self, workers):
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, fun, *args):
+        with self._lock:
+            if key in self._pending:
+                # a job with this key is running, it runs this one next
+                self._pending[key].append((fun, args))
+                return
+            self._pending[key] = deque()
+        self._pool.submit(self._run, key, fun, args)
+
+    def _run(self, key, fun, args):
+        while True:
+            try:
+                fun(*args)
+            except Exception as err:
+                logger.exception("Error handling a message: %s" % err)
+            with self._lock:
+                if not self._pending[key]:
+                    del self._pending[key]
+                    return
+                fun, args = self._pending[key].popleft()
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
 
 class DPNConsumer(ConsumerMixin):
     def __init__(self, conn, exchng, bcast_queue, bcast_rtkey, local_queue,
                  local_rtkey, ignore_own=True, local_rtr=local_router,
-                 broadcast_rtr=broadcast_router):
+                 broadcast_rtr=broadcast_router, workers=None,
+                 bcast_prefetch=None, local_prefetch=None):
         """A basic consumer that listens on DPN broadcast and local queues.
 
+        Messages are handled in the consumer loop unless workers is set,
+        then they are handled by a pool of threads. Messages with the same
+        correlation_id are still handled in the order they were received.
+
         :param conn:  Connection object to amqp server.
         :param exchng:  String of exchange to use on conn.
         :param bcast_queue:  String of broadcast queue name to use.
@@ -33,6 +112,13 @@ class DPNConsumer(ConsumerMixin):
         :param local_rtkey:  String of the local routing key to use
         :param ignore_own:  Boolean weather to reply to your own messages.
                             Usually only test to False for testing.
+        :param workers:  Integer of threads handling messages, defaults to
+                         DPN_CONSUMER_WORKERS. 0 handles them in the loop.
+        :param bcast_prefetch:  Integer of unacked broadcast messages the
+                                broker delivers, defaults to
+                                DPN_BROADCAST_PREFETCH. 0 means no limit.
+        :param local_prefetch:  Same for the local queue, defaults to
+                                DPN_LOCAL_PREFETCH.
 
         """
         self.connection = conn
@@ -45,6 +131,18 @@ class DPNConsumer(ConsumerMixin):
         self.local_router = local_rtr
         self.broadcast_router = broadcast_rtr
 
+        if workers is None:
+            workers = getattr(settings, 'DPN_CONSUMER_WORKERS', 0)
+        if bcast_prefetch is None:
+            bcast_prefetch = getattr(settings, 'DPN_BROADCAST_PREFETCH',
+                                     DEFAULT_BROADCAST_PREFETCH)
+        if local_prefetch is None:
+            local_prefetch = getattr(settings, 'DPN_LOCAL_PREFETCH',
+                                     DEFAULT_LOCAL_PREFETCH)
+        self.prefetch = [bcast_prefetch, local_prefetch]
+        self.executor = _SerialKeyExecutor(workers) if workers else None
+        self._acks = queue.Queue()
+
     def get_consumers(self, Consumer, chan):
         consumers = [
             Consumer(queues=[self.bcast_queue, ],
@@ -52,14 +150,80 @@ class DPNConsumer(ConsumerMixin):
             Consumer(queues=[self.direct_queue, ],
                      callbacks=[self.route_local, ], auto_declare=True)
         ]
+        for consumer, prefetch in zip(consumers, self.prefetch):
+            # basic_qos applies to the consumers started after it on the
+            # channel, so each one is started right after its own limit,
+            # a 0 is set as well or it would inherit the previous one
+            consumer.qos(prefetch_count=prefetch)
+            consumer.consume()
         return consumers
 
-    def _route_message(self, router, msg):
+    def on_iteration(self):
+        self.flush_acks()
+
+    def flush_acks(self):
+        """
+        Sends the acks and rejects of messages handled in worker threads.
+        """
+        while True:
+            try:
+                fun, args, kwargs = self._acks.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                fun(*args, **kwargs)
+            except Exception as err:
+                # the channel of the message is gone, it will be redelivered
+                logger.info("Unable to settle message: %s" % err)
+
+    def close(self):
+        """
+        Waits for the messages being handled and settles them.
+        """
+        if self.executor:
+            self.executor.shutdown(wait=True)
+        self.flush_acks()
+
+    def _handle(self, router, message_name, msg, decoded_body):
+        try:
+            router.dispatch(message_name, msg, decoded_body)
+        except DPNMessageError as err:
+            logger.info("DPN Message Error: %s" % err)
+        except Exception as err:
+            logger.exception("Error handling %s: %s" % (message_name, err))
+        finally:
+            if not msg.settled:
+                # do not hold the prefetch window with a message that
+                # would fail again
+                msg.reject()
+            close_old_connections()
+
+    def _dispatch(self, router, message_name, msg, decoded_body):
+        if self.executor is None:
+            router.dispatch(message_name, msg, decoded_body)
+            return
+        # messages without correlation_id do not need to wait for others
+        key = msg.headers.get('correlation_id') or object()
+        self.executor.submit(key, self._handle, router, message_name,
+                             _DeferredAckMessage(msg, self._acks),
+                             decoded_body)
+
+    def _decode(self, body, msg):
+        """
+        Returns the message body as a dict. kombu already decodes json
+        messages, only bodies sent with other content types are decoded here.
+        """
+        if isinstance(body, dict):
+            return body
+        return json_loads(msg.body)
+
+    def _route_message(self, router, msg, body=None):
         """
         Sends the original message to the appropriate dispatcher provided by router.
 
         :param router:  TaskRouter instance to dispatch this message.
         :param msg: kombu.transport.base.Message to decode and dispatch.
+        :param body: body of the message as decoded by kombu.
         """
         current_time = datetime.now()
         if not self._is_alive(msg, current_time):
@@ -69,7 +233,7 @@ class DPNConsumer(ConsumerMixin):
                 (msg.headers, msg.body, current_time)
             )
 
-        decoded_body = json_loads(msg.body)
+        decoded_body = self._decode(body, msg)
 
         try:
             message_name = decoded_body['message_name']
@@ -77,7 +241,7 @@ class DPNConsumer(ConsumerMixin):
             raise DPNMessageError(
                 "Invalid message received with no 'message_body' set!")
 
-        router.dispatch(message_name, msg, decoded_body)
+        self._dispatch(router, message_name, msg, decoded_body)
 
     def route_local(self, body, msg):
         """
@@ -93,8 +257,8 @@ class DPNConsumer(ConsumerMixin):
             msg.ack()
             return None
         try:
-            self._route_message(self.local_router, msg)
-            logger.info("LOCAL MSG %s" % self._get_logentry(msg))
+            self._route_message(self.local_router, msg, body)
+            logger.info("LOCAL MSG %s" % self._get_logentry(msg, body))
         except DPNMessageError as err:
             logger.info("DPN Message Error: %s" % err)
 
@@ -112,20 +276,21 @@ class DPNConsumer(ConsumerMixin):
             msg.ack()
             return None
         try:
-            self._route_message(self.broadcast_router, msg)
-            logger.info("BROADCAST MSG %s" % self._get_logentry(msg))
+            self._route_message(self.broadcast_router, msg, body)
+            logger.info("BROADCAST MSG %s" % self._get_logentry(msg, body))
         except DPNMessageError as err:
             logger.info("DPN Message Error: %s" % err)
 
-    def _get_logentry(self, msg):
+    def _get_logentry(self, msg, body=None):
         """
         Logs the receipt of a message from the queue.
         :param msg:  kombu.transport.base.Message instance.
+        :param body:  body of the message as decoded by kombu.
         :return: None
         """
         # No validation at this point so form log whatever fields you can find.
         try:
-            data = json_loads(msg.body)
+            data = dict(self._decode(body, msg))
             data.update(msg.headers)
             fields = ['message_name', 'from', 'correlation_id', 'sequence']
             parts = ["%s: %s" % (field, data[field]) for field in fields if
@@ -157,9 +322,8 @@ class DPNConsumer(ConsumerMixin):
         """
         try:
             ttl = dpn_strptime(msg.headers['ttl'])
-            now = dpn_strptime(dpn_strftime(current_time))
-
-            return ttl > now
+            # DPN dates have no microseconds
+            return ttl > current_time.replace(microsecond=0)
 
         except KeyError:
             msg.ack()
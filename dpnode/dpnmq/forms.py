@@ -8,7 +8,9 @@ import json
 import datetime
 
 from django import forms
+from django.core.exceptions import NON_FIELD_ERRORS, ValidationError
 from django.db import models
+from django.forms.utils import ErrorDict, ErrorList
 from django.db.models.query import QuerySet
 
 from dpnmq.utils import dpn_strftime
@@ -129,9 +131,16 @@ class _DPNBaseForm(forms.Form):
     field_map = []
 
     def __init__(self, data=None, *args, **kwargs):
-        data = map_to_fields(self.field_map, data)
+        data = self.prepare_data(data)
         super(_DPNBaseForm, self).__init__(data, *args, **kwargs)
 
+    @classmethod
+    def prepare_data(cls, data):
+        """
+        Returns the message data as expected by the fields of the form.
+        """
+        return map_to_fields(cls.field_map, data)
+
     def as_dpn_dict(self):
         """
         Returns a dictionary formatted fields filtered as needed
@@ -318,21 +327,26 @@ class RegistryDateRangeSyncForm(_DPNBaseForm):
     end_date = forms.DateTimeField(input_formats=[DPN_DATE_FORMAT, ])
 
     def __init__(self, data={}, *args, **kwargs):
+        super(RegistryDateRangeSyncForm, self).__init__(data, *args, **kwargs)
+
+    @classmethod
+    def prepare_data(cls, data):
         date_range = data.get("date_range",
             []) or []  # in case none passed explicity
         # handle both normal data or dpn json data
         if "start_date" not in data and len(date_range) == 2:
-            data['start_date'] = self._parse_date(date_range, 0)
+            data['start_date'] = cls._parse_date(date_range, 0)
         if "end_date" not in data and len(date_range) == 2:
-            data['end_date'] = self._parse_date(date_range, 1)
-        super(RegistryDateRangeSyncForm, self).__init__(data, *args, **kwargs)
+            data['end_date'] = cls._parse_date(date_range, 1)
+        return super(RegistryDateRangeSyncForm, cls).prepare_data(data)
 
     def as_dpn_dict(self):
         data = super(RegistryDateRangeSyncForm, self).as_dpn_dict()
         data["date_range"] = [data.pop("start_date"), data.pop("end_date")]
         return data
 
-    def _parse_date(self, dates, idx):
+    @staticmethod
+    def _parse_date(dates, idx):
         try:
             return dates[idx]
         except IndexError:  # for bad lengths
@@ -355,16 +369,21 @@ class RegistryListDateRangeForm(RegistryDateRangeSyncForm):
     message_name = forms.ChoiceField(
         choices=_format_choices(['registry-list-daterange-reply']))
 
-    def __init__(self, data={}, *args, **kwargs):
-        self.reg_sync_list = data.get("reg_sync_list", None)
-        super(RegistryListDateRangeForm, self).__init__(data, *args, **kwargs)
+    # Long lists are sent in several parts. Replies without these fields
+    # are a single part list.
+    part = forms.IntegerField(min_value=1, required=False)
+    last_part = forms.BooleanField(required=False)
 
     def clean(self):
         cleaned_data = super(RegistryDateRangeSyncForm, self).clean()
-        if not isinstance(self.reg_sync_list, list):
+        reg_sync_list = self.data.get("reg_sync_list", None)
+        if not isinstance(reg_sync_list, list):
             raise forms.ValidationError("reg_sync_list must be a list not %s"
-                                        % type(self.reg_sync_list).__name__)
-        cleaned_data["reg_sync_list"] = self.reg_sync_list
+                                        % type(reg_sync_list).__name__)
+        cleaned_data["reg_sync_list"] = reg_sync_list
+        if not cleaned_data.get("part"):
+            cleaned_data["part"] = 1
+            cleaned_data["last_part"] = True
         return cleaned_data
 
 
@@ -580,3 +599,74 @@ class NodeEntryForm(_RegistryEntryForm):
     class Meta:
         model = NodeEntry
         exclude = ['state', ]
+
+
+# Compiled Validation
+# -------------------
+# Validating through a form instance deep copies every field of the form for
+# each message. Messages are validated instead with the fields of the form
+# class, which are only read, giving the same cleaned data and errors.
+
+class _CompiledForm(object):
+
+    def __init__(self, form_class):
+        self.form_class = form_class
+        self.fields = [
+            (name, field, getattr(form_class, 'clean_%s' % name, None))
+            for name, field in form_class.base_fields.items()
+        ]
+
+    def validate(self, data):
+        """
+        Returns a tuple of (cleaned_data, errors) for data.
+        """
+        data = self.form_class.prepare_data(dict(data))
+        # a form that is never initialized, only used to run the clean
+        # methods the form class defines
+        form = self.form_class.__new__(self.form_class)
+        form.data = data
+        form.cleaned_data = {}
+        errors = ErrorDict()
+
+        for name, field, clean_field in self.fields:
+            value = field.widget.value_from_datadict(data, None, name)
+            try:
+                form.cleaned_data[name] = field.clean(value)
+                if clean_field:
+                    form.cleaned_data[name] = clean_field(form)
+            except ValidationError as err:
+                errors[name] = ErrorList(err.messages)
+                form.cleaned_data.pop(name, None)
+
+        try:
+            cleaned_data = form.clean()
+        except ValidationError as err:
+            errors[NON_FIELD_ERRORS] = ErrorList(err.messages)
+        else:
+            if cleaned_data is not None:
+                form.cleaned_data = cleaned_data
+
+        return form.cleaned_data, errors
+
+
+_compiled_forms = {}
+
+
+def validate_data(form_class, data):
+    """
+    Validates message data with a form class without creating a form.
+    Model forms need their instance and are validated by the form itself.
+
+    :param form_class: Form class of the message headers or body
+    :param data: Dict of the message data, it is not modified
+    :return: tuple of (cleaned_data, errors)
+    """
+    if issubclass(form_class, forms.ModelForm):
+        frm = form_class(dict(data))
+        frm.is_valid()
+        return getattr(frm, 'cleaned_data', {}), frm.errors
+
+    compiled = _compiled_forms.get(form_class)
+    if compiled is None:
+        compiled = _compiled_forms[form_class] = _CompiledForm(form_class)
+    return compiled.validate(data)
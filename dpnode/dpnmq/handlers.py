@@ -29,7 +29,8 @@ from dpn_workflows.tasks.inbound import (
 )
 from dpn_workflows.tasks.outbound import ( 
     respond_to_replication_query, verify_fixity_and_reply,
-    respond_to_recovery_query, respond_to_recovery_transfer
+    respond_to_recovery_query, respond_to_recovery_transfer,
+    choose_and_send_location, choose_node_and_recover
 ) 
 from dpn_workflows.tasks.registry import (
     reply_with_item_list,
@@ -118,7 +119,7 @@ def replication_init_query_handler(msg, body):
                               % err)
 
     # Request seems correct, check if node is available to replicate bag
-    respond_to_replication_query.apply_async((req,))
+    respond_to_replication_query.apply_async((req.payload(),))
 
 
 @local_router.register('replication-available-reply')
@@ -139,7 +140,7 @@ def replication_available_reply_handler(msg, body):
         raise DPNMessageError("Received bad message body: %s"
                               % err)
 
-    send_available_workflow(
+    action = send_available_workflow(
         node=req.headers['from'],
         id=req.headers['correlation_id'],
         protocol=body['protocol'],
@@ -147,6 +148,10 @@ def replication_available_reply_handler(msg, body):
         reply_key=req.headers['reply_key']
     )
 
+    # nodes are chosen as soon as enough of them are available
+    if action.state == SUCCESS:
+        choose_and_send_location.apply_async((action.correlation_id,))
+
 
 @local_router.register('replication-location-cancel')
 def replication_location_cancel_handler(msg, body):
@@ -171,7 +176,7 @@ def replication_location_cancel_handler(msg, body):
     action = receive_cancel_workflow(node, correlation_id)
 
     # wait until the transfer is already completed
-    delete_until_transferred.apply_async((action,))
+    delete_until_transferred.apply_async((action.pk,))
 
 
 @local_router.register('replication-location-reply')
@@ -202,7 +207,8 @@ def replication_location_reply_handler(msg, body):
     )
 
     # call the task responsible to transfer the content
-    transfer_content.apply_async((req, action), task_id=correlation_id)
+    transfer_content.apply_async((req.payload(), action.pk),
+                                 task_id=correlation_id)
     
     # QUESTION: ask if we need the task id for anything
     # action.task_id = task.task_id
@@ -227,7 +233,7 @@ def replication_transfer_reply_handler(msg, body):
                               % err)
 
     # Check if fixity value is good and reply to replicating node
-    verify_fixity_and_reply.apply_async((req, ))
+    verify_fixity_and_reply.apply_async((req.payload(), ))
 
 
 @local_router.register('replication-verify-reply')
@@ -351,7 +357,7 @@ def registry_daterange_sync_request_handler(msg, body):
         raise DPNMessageError("Received bad message body: %s"
                               % err)
 
-    reply_with_item_list.apply_async((req, ))
+    reply_with_item_list.apply_async((req.payload(), ))
 
 
 @local_router.register('registry-list-daterange-reply')
@@ -374,7 +380,7 @@ def registry_list_daterange_reply(msg, body):
                               % err)
 
     node = msg.headers['from']
-    save_registries_from(node, req)
+    save_registries_from.apply_async((node, req.payload()))
 
 
 # Recovery workflow handlers
@@ -398,7 +404,7 @@ def recovery_init_query_handler(msg, body):
                               % err)
 
     # Request seems correct, check if node is available to replicate bag
-    respond_to_recovery_query.apply_async((req,))
+    respond_to_recovery_query.apply_async((req.payload(),))
 
 
 @local_router.register('recovery-available-reply')
@@ -420,13 +426,17 @@ def recovery_available_reply_handler(msg, body):
         raise DPNMessageError("Received bad message body: %s"
                               % err)
 
-    rcv_available_recovery_workflow(
+    action = rcv_available_recovery_workflow(
         node=req.headers['from'],
         protocol=body['protocol'],
         correlation_id=req.headers['correlation_id'],
         reply_key=req.headers['reply_key']
     )
 
+    # the first node available is asked for the bag
+    choose_node_and_recover.apply_async(
+        (action.correlation_id, action.dpn_object_id))
+
 
 @local_router.register('recovery-transfer-request')
 def recovery_transfer_request_handler(msg, body):
@@ -448,7 +458,7 @@ def recovery_transfer_request_handler(msg, body):
                               % err)
 
     # Request seems correct, send response with location to start the transfer
-    respond_to_recovery_transfer.apply_async((req,))
+    respond_to_recovery_transfer.apply_async((req.payload(),))
 
 
 @local_router.register('recovery-transfer-reply')
@@ -471,7 +481,7 @@ def recovery_transfer_reply_handler(msg, body):
                               % err)
 
     # Recover the bag and check integrity of the bag with fixity value
-    recover_and_check_integrity.apply_async((req,))
+    recover_and_check_integrity.apply_async((req.payload(),))
 
 
 @local_router.register('recovery-transfer-status')
@@ -1,19 +1,20 @@
 import os
 import time
 import logging
+import threading
+from fnmatch import fnmatch
+from optparse import make_option
 
+from django.conf import settings
 from django.core.management.base import BaseCommand
 from watchdog.observers import Observer
 from watchdog.events import PatternMatchingEventHandler
 
-from dpn_registry.utils import create_entry
+from dpn_registry.models import RegistryEntry
 from dpnode.settings import (
-    DPN_INGEST_DIR_OUT, DPN_BAGS_FILE_EXT,
-    DPN_MAX_SIZE, DPN_TTL, DPN_MSG_TTL
-)
-from dpn_workflows.tasks.outbound import (
-    initiate_ingest, choose_and_send_location
+    DPN_INGEST_DIR_OUT, DPN_BAGS_FILE_EXT, DPN_MAX_SIZE
 )
+from dpn_workflows.tasks.ingest import ingest_bag
 
 logger = logging.getLogger('dpnmq.console')
 
@@ -21,81 +22,152 @@ logger = logging.getLogger('dpnmq.console')
 class Command(BaseCommand):
     help = 'Checks for new bags deposited in a directory'
 
+    option_list = BaseCommand.option_list + (
+        make_option('--no-scan',
+                    action='store_false',
+                    dest='scan',
+                    default=True,
+                    help='Do not look for bags deposited while the watcher was down.'),
+    )
+
     def handle(self, *args, **options):
+        interval = getattr(settings, 'DPN_BAG_POLL_INTERVAL', 5)
+        tracker = BagTracker(getattr(settings, 'DPN_BAG_STABLE_SECONDS', 5))
+
         pattern = ['*.%s' % DPN_BAGS_FILE_EXT]
-        event_handler = DPNFileEventHandler(patterns=pattern)
+        event_handler = DPNFileEventHandler(tracker, patterns=pattern)
         observer = Observer()
         observer.schedule(event_handler, DPN_INGEST_DIR_OUT, recursive=False)
         observer.start()
 
+        # scanned once the observer runs so no bag falls in between
+        if options['scan']:
+            found = scan_ingest_dir(tracker, DPN_INGEST_DIR_OUT)
+            print("%d bags deposited while the watcher was down" % found)
+
         print("Watching for new bags (%s). Press CTRL+C to exit." % DPN_INGEST_DIR_OUT)
 
         try:
             while True:
-                time.sleep(1)
+                time.sleep(interval)
+                for path, size in tracker.poll():
+                    ingest(path, size)
         except KeyboardInterrupt:
             observer.stop()
             print("Good Bye. No more bag watching!")
         observer.join()
 
 
+class BagTracker(object):
+    """
+    Tracks the bags being written to the ingest directory, all of them from
+    one poll loop. A bag is stable once its size and modification time did
+    not change for stable_seconds.
+    """
+
+    def __init__(self, stable_seconds, clock=time.time):
+        self.stable_seconds = stable_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._pending = {}  # path -> (size, mtime, unchanged since)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def track(self, path):
+        with self._lock:
+            self._pending.setdefault(path, None)
+
+    def poll(self):
+        """
+        Checks every tracked bag once.
+
+        :return: list of (path, size) of the bags that became stable, they
+            are no longer tracked
+        """
+        now = self.clock()
+        with self._lock:
+            pending = list(self._pending.items())
+
+        stable, gone = [], []
+        for path, last in pending:
+            try:
+                stat = os.stat(path)
+            except OSError as err:
+                logger.error("Error processing the new bag %s. Msg -> %s"
+                             % (os.path.basename(path), err))
+                gone.append(path)
+                continue
+
+            current = (stat.st_size, stat.st_mtime)
+            if last is None or last[:2] != current:
+                with self._lock:
+                    self._pending[path] = current + (now,)
+            elif now - last[2] >= self.stable_seconds:
+                stable.append((path, stat.st_size))
+                gone.append(path)
+
+        with self._lock:
+            for path in gone:
+                self._pending.pop(path, None)
+        return stable
+
+
 class DPNFileEventHandler(PatternMatchingEventHandler):
-    def on_created(self, event):
-        if not event.is_directory:
-            bag_error = False
-            filename = base = os.path.basename(event.src_path)
-            initial_filesize = os.path.getsize(event.src_path)
 
-            if type(filename) == bytes:
-                filename = filename.decode('utf-8')
+    def __init__(self, tracker, **kwargs):
+        super(DPNFileEventHandler, self).__init__(**kwargs)
+        self.tracker = tracker
 
-            logger.info(
-                "New bag detected: %s. Let's wait 5 seconds and check size again..."
-                % base
-            )
-            while True:
-                # NOTE: how long should we wait to get the final size of the bag??
-                # discuss this with the team
-
-                # wait 5 seconds to check bag size again
-                time.sleep(5)
-                try:
-                    filesize_now = os.path.getsize(event.src_path)
-
-                    # if initial filesize is equal to the filesize now
-                    # we can start the bag ingestion
-                    if initial_filesize == filesize_now:
-                        filesize = filesize_now
-                        break
-                    else:
-                        initial_filesize = filesize_now
-                        print("Bag is not ready, check again in 5 seconds...")
-                except Exception as err:
-                    bag_error = err
-                    break
-
-            if bag_error:
-                logger.error(
-                    "Error processing the new bag %s. Msg -> %s" 
-                    % (base, bag_error)
-                )
-            elif filesize < DPN_MAX_SIZE:
-                print("Creating registry entry about new detected bag")
-                filename_id = os.path.splitext(filename)[0]
-                create_entry(filename_id, event.src_path)
-
-                # start ingestion and link task to choose nodes                
-                logger.info("Registry entry created. Starting ingestion of %s..." % base)
-                delay = DPN_MSG_TTL.get('replication-init-query', DPN_TTL)
-
-                initiate_ingest.apply_async(
-                    (filename_id, filesize),
-                    link=choose_and_send_location.subtask((), countdown=delay)
-                )
-                # execute choose_and_send_location task DPN_TTL seconds after 
-                # ReplicationInitQuery has been sent to broadcast queue
-                # using countdown parameter of celery task to do that
-
-            else:
-                logger.info(
-                    "Bag %s is too big to be replicated. Not ingested!" % base)
+    def on_created(self, event):
+        if not event.is_directory:
+            logger.info("New bag detected: %s. Waiting for its size to settle..."
+                        % os.path.basename(event.src_path))
+            self.tracker.track(event.src_path)
+
+    def on_moved(self, event):
+        # bags may be written elsewhere and moved in when complete, the
+        # event also comes when a bag is renamed to something else
+        if not event.is_directory and any(
+                fnmatch(event.dest_path, pattern) for pattern in self.patterns):
+            self.tracker.track(event.dest_path)
+
+
+def scan_ingest_dir(tracker, directory):
+    """
+    Tracks the bags of the directory that are not in the registry yet.
+
+    :param tracker: BagTracker instance
+    :param directory: String of the directory to scan
+    :return: Integer of bags tracked
+    """
+    suffix = '.%s' % DPN_BAGS_FILE_EXT
+    bags = dict((_object_id(name), os.path.join(directory, name))
+                for name in os.listdir(directory) if name.endswith(suffix))
+    ingested = set(RegistryEntry.objects.filter(
+        dpn_object_id__in=bags.keys()).values_list('dpn_object_id', flat=True))
+
+    found = 0
+    for object_id, path in bags.items():
+        if object_id not in ingested and os.path.isfile(path):
+            tracker.track(path)
+            found += 1
+    return found
+
+
+def ingest(path, size):
+    """
+    Hands a stable bag to celery to be hashed and ingested.
+    """
+    base = os.path.basename(path)
+    if size < DPN_MAX_SIZE:
+        logger.info("Bag %s is ready. Queueing its ingestion..." % base)
+        ingest_bag.apply_async((_object_id(base), path))
+    else:
+        logger.info("Bag %s is too big to be replicated. Not ingested!" % base)
+
+
+def _object_id(filename):
+    if type(filename) == bytes:
+        filename = filename.decode('utf-8')
+    return os.path.splitext(os.path.basename(filename))[0]
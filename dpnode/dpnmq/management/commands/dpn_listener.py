@@ -43,6 +43,7 @@ class Command(BaseCommand):
                 try:
                     cnsmr.run()
                 except KeyboardInterrupt:
+                    cnsmr.close()
                     conn.close()
                     print("Exiting.  No longer consuming!")
                     break
@@ -0,0 +1,70 @@
+import time
+from datetime import datetime
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from kombu import Connection
+from kombu.utils import uuid
+
+from dpnode.settings import DPN_EXCHANGE
+from dpnmq import publisher
+from dpnmq.messages import ReplicationInitQuery
+from dpnmq.utils import dpn_strftime
+
+
+def _connection_per_message(msg, rt_key):
+    # how DPNMessage.send used to publish, kept to compare against the pool
+    with Connection(settings.DPN_BROKER_URL) as conn:
+        with conn.Producer(serializer='json') as producer:
+            producer.publish(msg.body, headers=msg.headers,
+                             exchange=DPN_EXCHANGE, routing_key=rt_key)
+
+
+def _pooled(msg, rt_key):
+    publisher.publish(msg.body, msg.headers, DPN_EXCHANGE, rt_key)
+
+
+class Command(BaseCommand):
+    help = 'Measures messages/sec sent to the broker with a new connection per message and with the producer pool.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--count',
+                    default=500,
+                    help='Number of messages to send in each run.'),
+        make_option('--routing-key',
+                    dest='routing_key',
+                    default='dpn.benchmark',
+                    help='Routing key to send the messages to. Use a key '
+                         'without bound queues to have them discarded.'),
+    )
+
+    def handle(self, *args, **options):
+        count = int(options['count'])
+        rt_key = options['routing_key']
+
+        msg = ReplicationInitQuery({
+            'correlation_id': uuid(),
+            'sequence': 0,
+            'date': dpn_strftime(datetime.now())
+        }, {
+            'replication_size': 4502,
+            'protocol': ['https', 'rsync'],
+            'dpn_object_id': uuid()
+        })
+        msg._set_date()
+        msg.validate()
+
+        print("Sending %d messages to %s -> %s" % (
+            count, settings.DPN_BROKER_URL, rt_key))
+
+        for name, send in [("connection per message", _connection_per_message),
+                           ("producer pool", _pooled)]:
+            start = time.time()
+            for _ in range(count):
+                send(msg, rt_key)
+            elapsed = time.time() - start
+            print("%25s: %.2fs -> %.1f msg/s" % (
+                name, elapsed, count / elapsed if elapsed else 0))
+
+        publisher.reset()
@@ -0,0 +1,99 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from dpnode.celery import (
+    app, TASK_QUEUES, CONTROL_QUEUE, TRANSFER_QUEUE, FIXITY_QUEUE,
+    DEFAULT_QUEUE
+)
+
+QUEUES = [CONTROL_QUEUE, TRANSFER_QUEUE, FIXITY_QUEUE, DEFAULT_QUEUE]
+
+
+def check_routes():
+    """
+    Returns the problems of the routing of the tasks: every task of the
+    node needs an explicit route, a control task routed to another queue
+    waits behind bulk work.
+    """
+    # the task modules are imported as a worker does
+    app.loader.import_default_modules()
+    router = app.amqp.router
+    routed = dict((task, queue) for queue, tasks in TASK_QUEUES.items()
+                  for task in tasks)
+    problems = []
+    for task in sorted(app.tasks):
+        if not task.startswith('dpn'):
+            continue
+        if task not in routed:
+            problems.append("%s has no route" % task)
+            continue
+        queue = router.route({}, task)['queue'].name
+        if queue != routed[task]:
+            problems.append("%s is routed to %s" % (task, queue))
+    for task in sorted(set(routed) - set(app.tasks)):
+        problems.append("%s is routed but not a task" % task)
+    return problems
+
+
+def check_workers(active_queues):
+    """
+    Returns the problems of the workers running: the control queue needs a
+    worker of its own, one that consumes bulk queues too may have every
+    process busy with them.
+
+    :param active_queues: dict of worker name to the list of the names of
+        the queues it consumes
+    :return: list of Strings of the problems
+    """
+    problems = []
+    control_workers = [worker for worker, queues in active_queues.items()
+                       if CONTROL_QUEUE in queues]
+    if not control_workers:
+        problems.append("No worker consumes %s" % CONTROL_QUEUE)
+    for worker in sorted(control_workers):
+        bulk = sorted(set(active_queues[worker]) - set([CONTROL_QUEUE]))
+        if bulk:
+            problems.append("%s consumes %s together with %s"
+                            % (worker, CONTROL_QUEUE, ", ".join(bulk)))
+
+    consumed = set(q for queues in active_queues.values() for q in queues)
+    for queue in QUEUES:
+        if queue != CONTROL_QUEUE and queue not in consumed:
+            problems.append("No worker consumes %s" % queue)
+    return problems
+
+
+def queue_depths():
+    """
+    Returns the messages waiting and the consumers of every queue.
+    """
+    depths = {}
+    with app.connection() as conn:
+        channel = conn.default_channel
+        for queue in QUEUES:
+            _, waiting, consumers = channel.queue_declare(queue, passive=True)
+            depths[queue] = (waiting, consumers)
+    return depths
+
+
+class Command(BaseCommand):
+    help = 'Checks that control-plane tasks never wait behind transfers or fixity checks: their routes, the queues of the running workers and the messages waiting in each queue.'
+
+    def handle(self, *args, **options):
+        problems = check_routes()
+
+        replies = app.control.inspect().active_queues() or {}
+        active_queues = dict(
+            (worker, [queue['name'] for queue in queues])
+            for worker, queues in replies.items()
+        )
+        for worker, queues in sorted(active_queues.items()):
+            print("%-30s %s" % (worker, ", ".join(queues)))
+        problems += check_workers(active_queues)
+
+        for queue, (waiting, consumers) in sorted(queue_depths().items()):
+            print("%-14s %6d waiting %3d consumers" % (queue, waiting,
+                                                         consumers))
+
+        if problems:
+            raise CommandError("\n".join(problems))
+        print("Control tasks have a queue and a worker of their own.")
@@ -0,0 +1,72 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from dpnmq import forms
+from dpnmq.tests import fixtures
+
+# message body fixtures validated by each body form
+BODIES = [
+    (forms.RepInitQueryForm, fixtures.REP_INIT_QUERY),
+    (forms.RepAvailableReplyForm, fixtures.REP_AVAILABLE_REPLY_ACK),
+    (forms.RepAvailableReplyForm, fixtures.REP_AVAILABLE_REPLY_NAK),
+    (forms.RepLocationReplyForm, fixtures.REP_LOCATION_REPLY),
+    (forms.RepLocationCancelForm, fixtures.REP_LOCATION_CANCEL),
+    (forms.RepTransferReplyForm, fixtures.REP_TRANSFER_REPLY_ACK),
+    (forms.RepTransferReplyForm, fixtures.REP_TRANSFER_REPLY_NAK),
+    (forms.RepVerificationReplyForm, fixtures.REP_VERIFICATION_REPLY),
+    (forms.RegistryDateRangeSyncForm, fixtures.REGISTRY_DATERANGE_SYNC),
+    (forms.RegistryListDateRangeForm, fixtures.REGISTRY_LIST_DATERANGE),
+    (forms.RecoveryInitQueryForm, fixtures.REC_INIT_QUERY),
+    (forms.RecoveryAvailableReplyForm, fixtures.REC_AVAILABLE_REPLY_ACK),
+    (forms.RecoveryAvailableReplyForm, fixtures.REC_AVAILABLE_REPLY_NAK),
+    (forms.RecoveryTransferRequestForm, fixtures.REC_TRANSFER_REQUEST),
+    (forms.RecoveryTransferReplyForm, fixtures.REC_TRANSFER_REPLY),
+    (forms.RecoveryTransferStatusForm, fixtures.REC_TRANSFER_STATUS_ACK),
+]
+
+
+def _form_instance(form_class, data):
+    # how messages used to be validated, kept to compare against
+    frm = form_class(data.copy())
+    return frm.is_valid()
+
+
+def _compiled(form_class, data):
+    cleaned_data, errors = forms.validate_data(form_class, data)
+    return not errors
+
+
+class Command(BaseCommand):
+    help = 'Measures validations/sec of the DPN message fixtures with form instances and with compiled validation.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--count',
+                    default=200,
+                    help='Number of times each fixture is validated.'),
+    )
+
+    def handle(self, *args, **options):
+        count = int(options['count'])
+        headers = fixtures.make_headers()
+        messages = []
+        for form_class, data in [(forms.MsgHeaderForm, headers)] + BODIES:
+            if _form_instance(form_class, data) and _compiled(form_class, data):
+                messages.append((form_class, data))
+            else:
+                print("%s does not validate its fixture, skipped"
+                      % form_class.__name__)
+
+        print("Validating %d fixtures %d times each" % (len(messages), count))
+
+        for name, validate in [("form instance", _form_instance),
+                               ("compiled", _compiled)]:
+            start = time.time()
+            for _ in range(count):
+                for form_class, data in messages:
+                    validate(form_class, data)
+            elapsed = time.time() - start
+            total = count * len(messages)
+            print("%15s: %.2fs -> %.1f validations/s" % (
+                name, elapsed, total / elapsed if elapsed else 0))
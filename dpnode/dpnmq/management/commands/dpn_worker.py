@@ -0,0 +1,70 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from dpnode.celery import (
+    app, CONTROL_QUEUE, TRANSFER_QUEUE, FIXITY_QUEUE, DEFAULT_QUEUE
+)
+
+# pool and concurrency of the worker of each queue, DPN_WORKERS overrides
+# them. Control tasks are short, transfers wait on the network and fixity
+# on the disk, so long tasks are given to free processes only (-O fair).
+DEFAULT_WORKERS = {
+    CONTROL_QUEUE: {'pool': 'prefork', 'concurrency': 4},
+    TRANSFER_QUEUE: {'pool': 'prefork', 'concurrency': 8,
+                     'optimization': 'fair'},
+    FIXITY_QUEUE: {'pool': 'prefork', 'concurrency': 2,
+                   'optimization': 'fair'},
+    DEFAULT_QUEUE: {'pool': 'prefork', 'concurrency': 2},
+}
+
+
+def worker_options(queue):
+    """
+    Returns the options of the worker of a queue.
+    """
+    workers = dict(DEFAULT_WORKERS)
+    workers.update(getattr(settings, 'DPN_WORKERS', {}))
+    try:
+        return workers[queue]
+    except KeyError:
+        raise CommandError("Unknown queue %s, choose one of %s"
+                           % (queue, ", ".join(sorted(workers))))
+
+
+def worker_argv(queue, loglevel='INFO'):
+    """
+    Returns the command line of a celery worker consuming only one queue.
+    """
+    options = worker_options(queue)
+    argv = [
+        'worker',
+        '--queues', queue,
+        '--pool', options.get('pool', 'prefork'),
+        '--concurrency', str(options.get('concurrency', 1)),
+        '--hostname', '%s@%%h' % queue,
+        '--loglevel', loglevel,
+    ]
+    if options.get('optimization'):
+        argv += ['-O', options['optimization']]
+    return argv
+
+
+class Command(BaseCommand):
+    args = '<queue>'
+    help = 'Runs the celery worker of one queue (dpn.control, dpn.transfer, dpn.fixity or celery) with its own pool and concurrency.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--loglevel',
+                    default='INFO',
+                    help='Log level of the worker.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give the queue of the worker, one of %s"
+                               % ", ".join(sorted(DEFAULT_WORKERS)))
+        argv = worker_argv(args[0], options['loglevel'])
+        print("Starting: celery %s" % " ".join(argv))
+        app.worker_main(argv)
@@ -5,16 +5,17 @@
             - Emo Philips
 """
 
+import json
 import logging
 from datetime import datetime
 
 from django.conf import settings
-from kombu import Connection
 
 from dpnode.settings import DPN_TTL, DPN_NODE_NAME, DPN_EXCHANGE
 from dpnode.settings import DPN_LOCAL_KEY, DPN_MSG_TTL
 from dpnode.exceptions import DPNMessageError
-from . import forms
+from . import forms, publisher
+from .models import OutboxMessage
 from .utils import dpn_strftime, str_expire_on
 
 
@@ -63,9 +64,10 @@ class DPNMessage(object):
             self.headers["ttl"] = str_expire_on(now, self._get_ttl())
 
     def validate_headers(self):
-        frm = self.header_form(self.headers.copy())
-        if not frm.is_valid():
-            raise DPNMessageError("Invalid message header %s" % frm.errors)
+        cleaned_data, errors = forms.validate_data(self.header_form,
+                                                   self.headers)
+        if errors:
+            raise DPNMessageError("Invalid message header %s" % errors)
 
     def send(self, rt_key):
         """
@@ -76,19 +78,44 @@ class DPNMessage(object):
         """
         self._set_date()  # Set date just before it's sent.
         self.validate()
-        # TODO change this to a connection pool
-        try:  # importing from settings to allow for testsuite overrides
-            with Connection(settings.DPN_BROKER_URL) as conn:
-                with conn.Producer(serializer='json') as producer:
-                    producer.publish(self.body, headers=self.headers,
-                                     exchange=DPN_EXCHANGE, routing_key=rt_key)
-
-                conn.close()
+        try:
+            publisher.publish(self.body, self.headers, DPN_EXCHANGE, rt_key)
             self._log_send_msg(rt_key)
         except OSError:
             logger.error(
                 "Error sending message, Unable to connect to %s" % settings.DPN_BROKER_URL)
 
+    def queue(self, rt_key):
+        """
+        Saves this message in the outbox instead of sending it. It is sent
+        by the flush_outbox task once the current transaction commits, so
+        it is never sent for changes rolled back nor lost if the broker is
+        down.
+
+        :param rt_key:  String of the routingkey to send this message to.
+        :return: OutboxMessage instance
+        """
+        self._set_date()
+        self.validate()
+        return OutboxMessage.objects.create(
+            directive=self.directive,
+            routing_key=rt_key,
+            headers=json.dumps(self.headers),
+            body=json.dumps(self.body),
+        )
+
+    def payload(self):
+        """
+        Returns the message as a plain dict to pass it to celery tasks, it
+        is turned back into a message with from_payload.
+
+        :return: dict with the headers and body of the message
+        """
+        return {
+            'headers': dict(self.headers),
+            'body': dict(self.body),
+        }
+
     def _log_send_msg(self, rt_key):
         """
         Logs information about the message prefixing the log entry with the 
@@ -128,9 +155,9 @@ class DPNMessage(object):
 
         self._set_message_name()
 
-        frm = self.body_form(self.body.copy())
-        if not frm.is_valid():
-            raise DPNMessageError("Invalid Body: %s" % dict(frm.errors))
+        cleaned_data, errors = forms.validate_data(self.body_form, self.body)
+        if errors:
+            raise DPNMessageError("Invalid Body: %s" % dict(errors))
 
     def set_body(self, **kwargs):
         try:
@@ -246,4 +273,24 @@ class RecoveryTransferReply(DPNMessage):
 class RecoveryTransferStatus(DPNMessage):
     directive = 'recovery-transfer-status'
     body_form = forms.RecoveryTransferStatusForm
-    sequence = 4
\ No newline at end of file
+    sequence = 4
+
+
+def from_payload(payload):
+    """
+    Builds the message a payload was taken from with DPNMessage.payload.
+    It is not validated again.
+
+    :param payload: dict with the headers and body of the message
+    :return: DPNMessage instance of the class of its message_name
+    """
+    name = payload['body'].get('message_name')
+    try:
+        message_class = MESSAGE_CLASSES[name]
+    except KeyError:
+        raise DPNMessageError("No message class for message_name %s" % name)
+    return message_class(payload['headers'], payload['body'])
+
+
+MESSAGE_CLASSES = dict((cls.directive, cls)
+                       for cls in DPNMessage.__subclasses__())
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxMessage',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('directive', models.CharField(max_length=50)),
+                ('routing_key', models.CharField(max_length=100)),
+                ('headers', models.TextField(help_text='JSON of the message headers.')),
+                ('body', models.TextField(help_text='JSON of the message body.')),
+                ('state', models.CharField(max_length=1, default='P', choices=[('P', 'Pending'), ('S', 'Sent'), ('E', 'Expired')])),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('sent_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='outboxmessage',
+            index_together=set([('state', 'next_attempt')]),
+        ),
+    ]
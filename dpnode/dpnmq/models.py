@@ -8,9 +8,24 @@
 # ------------------------------
 # register some signals handlers
 # ------------------------------
+import json
+from datetime import timedelta
+
 from celery.signals import after_task_publish
 
 from celery import current_app as celery
+from django.db import models
+from django.utils import timezone
+
+# OUTBOX STATE INFORMATION
+PENDING = 'P'
+SENT = 'S'
+EXPIRED = 'E'
+OUTBOX_STATE_CHOICES = (
+    (PENDING, 'Pending'),
+    (SENT, 'Sent'),
+    (EXPIRED, 'Expired'),
+)
 
 
 @after_task_publish.connect
@@ -22,4 +37,52 @@ def update_sent_state(sender=None, body=None, **kwargs):
 
     task = celery.tasks.get(sender)
     backend = task.backend if task else celery.backend
-    backend.store_result(body['id'], None, "SENT")
\ No newline at end of file
+    backend.store_result(body['id'], None, "SENT")
+
+
+class OutboxMessage(models.Model):
+    """
+    A DPN message saved in the same transaction as the workflow changes
+    it reports, to be published by the flush_outbox task.
+    """
+    directive = models.CharField(max_length=50)
+    routing_key = models.CharField(max_length=100)
+    headers = models.TextField(help_text="JSON of the message headers.")
+    body = models.TextField(help_text="JSON of the message body.")
+    state = models.CharField(max_length=1, choices=OUTBOX_STATE_CHOICES,
+                             default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default='')
+
+    # Timestamps
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        index_together = [("state", "next_attempt")]
+
+    def __unicode__(self):
+        return '%s to %s' % (self.directive, self.routing_key)
+
+    def __str__(self):
+        return '%s' % self.__unicode__()
+
+    def get_headers(self):
+        return json.loads(self.headers)
+
+    def get_body(self):
+        return json.loads(self.body)
+
+    def backoff(self, error, base, limit):
+        """
+        Records a failed attempt and delays the next one exponentially.
+
+        :param error: Exception or String of the error
+        :param base: Integer of seconds to wait after the first failure
+        :param limit: Integer of max seconds to wait
+        """
+        self.attempts += 1
+        self.last_error = "%s" % error
+        delay = min(base * 2 ** (self.attempts - 1), limit)
+        self.next_attempt = timezone.now() + timedelta(seconds=delay)
@@ -0,0 +1,96 @@
+"""
+    Eighty percent of success is showing up.
+
+            - Woody Allen
+"""
+
+# Long lived AMQP producers used to send DPN messages. Connections and
+# channels are kept in a pool per process and reused between messages
+# instead of doing a TCP and AMQP handshake for each one of them.
+#
+# Pools are never shared with a forked child (e.g. Celery prefork workers),
+# a new one is created the first time a message is sent from a new pid.
+
+import os
+import threading
+
+from django.conf import settings
+from kombu import Connection
+from kombu.pools import ProducerPool
+
+DEFAULT_POOL_LIMIT = 10
+DEFAULT_RETRY_POLICY = {
+    'max_retries': 3,
+    'interval_start': 0,
+    'interval_step': 1,
+    'interval_max': 5,
+}
+
+_lock = threading.Lock()
+_state = {'pid': None, 'key': None, 'pool': None}
+
+
+def _pool_key():
+    return (
+        settings.DPN_BROKER_URL,
+        getattr(settings, 'DPN_PUBLISH_CONFIRM', False),
+        getattr(settings, 'DPN_PUBLISH_POOL_LIMIT', DEFAULT_POOL_LIMIT),
+    )
+
+
+def producer_pool():
+    """
+    Returns the producer pool of the current process for the broker
+    in settings. Settings are read on every call to allow testsuite
+    overrides.
+    """
+    key = _pool_key()
+    pid = os.getpid()
+    with _lock:
+        if _state['pid'] != pid:
+            # the connections of the parent process belong to it, just
+            # forget them without closing the sockets
+            _state.update(pid=pid, key=None, pool=None)
+
+        if _state['key'] != key:
+            if _state['pool'] is not None:
+                _state['pool'].force_close_all()
+            url, confirm, limit = key
+            connection = Connection(
+                url, transport_options={'confirm_publish': confirm})
+            _state.update(key=key, pool=ProducerPool(connection.Pool(limit),
+                                                     limit=limit))
+        return _state['pool']
+
+
+def reset():
+    """
+    Closes every pooled connection of the current process.
+    """
+    with _lock:
+        if _state['pool'] is not None and _state['pid'] == os.getpid():
+            _state['pool'].force_close_all()
+        _state.update(pid=None, key=None, pool=None)
+
+
+def publish(body, headers, exchange, routing_key, producer=None):
+    """
+    Publishes a message using a pooled producer. Lost connections are
+    reestablished following DPN_PUBLISH_RETRY_POLICY.
+
+    :param body: dict of the message body
+    :param headers: dict of the message headers
+    :param exchange: String name of the exchange
+    :param routing_key: String of the routing key
+    :param producer: Producer acquired from the pool to send several
+        messages with, one is acquired for this message if not given
+    """
+    if producer is None:
+        with producer_pool().acquire(block=True) as producer:
+            return publish(body, headers, exchange, routing_key, producer)
+
+    retry_policy = getattr(settings, 'DPN_PUBLISH_RETRY_POLICY',
+                           DEFAULT_RETRY_POLICY)
+    producer.publish(body, headers=headers, exchange=exchange,
+                     routing_key=routing_key, serializer='json',
+                     retry=True, retry_policy=retry_policy)
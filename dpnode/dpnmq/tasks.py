@@ -0,0 +1,143 @@
+"""
+    A ship in harbor is safe, but that is not what ships are built for.
+
+            - John A. Shedd
+"""
+
+# Messages queued with DPNMessage.queue are saved in the outbox together
+# with the workflow changes they report and published from here, in order,
+# over a pooled connection. Messages that fail are retried with an
+# exponential backoff until their TTL expires. Sent and expired messages
+# are deleted by purge_outbox after DPN_OUTBOX_KEEP seconds.
+
+import logging
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Min, Q
+from django.utils import timezone
+
+from dpnode.celery import app
+from dpnode.settings import DPN_EXCHANGE
+from dpnmq import publisher
+from dpnmq.models import OutboxMessage, PENDING, SENT, EXPIRED
+from dpnmq.utils import dpn_strptime, dpn_strftime
+
+logger = logging.getLogger('dpnmq.console')
+
+
+@contextmanager
+def outbox_transaction():
+    """
+    Runs a block in a transaction, the messages queued in it are flushed
+    as soon as the outermost transaction commits. Inside a transaction of
+    the caller they are not visible to the flush yet, they are sent by the
+    flush of the outer outbox_transaction or the periodic one.
+    """
+    with transaction.atomic():
+        yield
+    if not transaction.get_connection().in_atomic_block:
+        flush_outbox.apply_async()
+
+
+@app.task
+def flush_outbox(batch_size=None):
+    """
+    Publishes the pending messages of the outbox in the order they were
+    queued, at most batch_size of them, and queues itself again while
+    there are more. A message is never sent before an older one to the
+    same routing key that is waiting to be retried.
+
+    :param batch_size: Integer of messages to send, defaults to
+        DPN_OUTBOX_BATCH
+    :return: dict with the number of messages sent, failed and expired
+    """
+    batch_size = batch_size or getattr(settings, 'DPN_OUTBOX_BATCH', 100)
+    retry_delay = getattr(settings, 'DPN_OUTBOX_RETRY_DELAY', 5)
+    max_retry_delay = getattr(settings, 'DPN_OUTBOX_MAX_RETRY_DELAY', 300)
+    stats = dict(sent=0, failed=0, expired=0)
+
+    with transaction.atomic():
+        now = timezone.now()
+        # messages to a routing key wait behind the oldest one of the key
+        # still backing off, newer steps never overtake it
+        due = OutboxMessage.objects.filter(state=PENDING,
+                                           next_attempt__lte=now)
+        waiting = OutboxMessage.objects.filter(
+            state=PENDING, next_attempt__gt=now
+        ).values('routing_key').annotate(first=Min('pk'))
+        for key in waiting:
+            due = due.exclude(routing_key=key['routing_key'],
+                              pk__gt=key['first'])
+
+        # rows stay locked while they are sent so two flushes never
+        # send the same message
+        pending = list(due.select_for_update().order_by('pk')[:batch_size])
+        if not pending:
+            return stats
+
+        sent, expired, error = [], [], None
+        try:
+            with publisher.producer_pool().acquire(block=True) as producer:
+                for msg in pending:
+                    headers = msg.get_headers()
+                    now = datetime.now()
+                    if dpn_strptime(headers['ttl']) <= now:
+                        expired.append(msg.pk)
+                        continue
+                    # dated when sent, not when queued
+                    headers['date'] = dpn_strftime(now)
+                    publisher.publish(msg.get_body(), headers, DPN_EXCHANGE,
+                                      msg.routing_key, producer)
+                    sent.append(msg.pk)
+                    logger.info("SENT %s to %s->%s with id: %s, sequence: %s"
+                                % (msg.directive, DPN_EXCHANGE,
+                                   msg.routing_key, headers['correlation_id'],
+                                   headers['sequence']))
+        except Exception as err:
+            error = err
+            logger.error("Error sending outbox messages to %s: %s"
+                         % (settings.DPN_BROKER_URL, err))
+
+        OutboxMessage.objects.filter(pk__in=sent).update(
+            state=SENT, sent_at=timezone.now())
+        OutboxMessage.objects.filter(pk__in=expired).update(state=EXPIRED)
+
+        # the rest of the batch waits as well, and the messages queued
+        # later to the same routing keys wait behind it
+        if error is not None:
+            done = set(sent + expired)
+            for msg in pending:
+                if msg.pk not in done:
+                    msg.backoff(error, retry_delay, max_retry_delay)
+                    msg.save(update_fields=['attempts', 'last_error',
+                                            'next_attempt'])
+                    stats['failed'] += 1
+
+    stats['sent'], stats['expired'] = len(sent), len(expired)
+    if error is None and len(pending) == batch_size:
+        flush_outbox.apply_async((batch_size,))
+    return stats
+
+
+@app.task
+def purge_outbox():
+    """
+    Deletes the messages sent or expired more than DPN_OUTBOX_KEEP seconds
+    ago, so the outbox only grows with the messages still pending.
+
+    :return: Integer of messages deleted
+    """
+    keep = getattr(settings, 'DPN_OUTBOX_KEEP', 7 * 24 * 60 * 60)
+    before = timezone.now() - timedelta(seconds=keep)
+    old = OutboxMessage.objects.filter(
+        Q(state=SENT, sent_at__lt=before) |
+        Q(state=EXPIRED, created_at__lt=before)
+    )
+    deleted = old.count()
+    old.delete()
+    logger.info("Purged %d sent or expired messages from the outbox"
+                % deleted)
+    return deleted
@@ -1,5 +1,8 @@
+import time
+import threading
 from datetime import datetime, timedelta
 
+from django.conf import settings
 from django.test import TestCase
 from kombu.connection import Connection
 from kombu.message import Message
@@ -8,7 +11,7 @@ from kombu.tests.case import Mock
 from dpnode.settings import DPN_BROADCAST_QUEUE, DPN_BROADCAST_KEY
 from dpnode.settings import DPN_LOCAL_QUEUE, DPN_LOCAL_KEY, DPN_EXCHANGE
 from dpnmq.utils import dpn_strftime
-from dpnmq.consumer import DPNConsumer
+from dpnmq.consumer import DPNConsumer, DEFAULT_BROADCAST_PREFETCH
 
 class MockRouter():
 
@@ -18,6 +21,20 @@ class MockRouter():
     def dispatch(self, name, msg, body):
         self.msgs[name] = (msg, body)
 
+class OrderRecordingRouter():
+
+    def __init__(self):
+        self.handled = []
+        self.lock = threading.Lock()
+
+    def dispatch(self, name, msg, body):
+        # the first messages are the slowest ones
+        time.sleep(0.01 * (5 - msg.headers['sequence']))
+        with self.lock:
+            self.handled.append((msg.headers['correlation_id'],
+                                 msg.headers['sequence']))
+        msg.ack()
+
 class DPNConsumerTestCase(TestCase):
 
     def setUp(self):
@@ -94,5 +111,48 @@ class DPNConsumerTestCase(TestCase):
         self.assertTrue(bst_good == 1, "Expected 1 but returned %d" % bst_good)
         self.assertTrue(lcl_good == 0, "Expected 0 but returned %d" % lcl_good)
 
-
-
+    def test_get_consumers_prefetch(self):
+        csmr = DPNConsumer(self.conn, DPN_EXCHANGE, DPN_BROADCAST_QUEUE,
+                           DPN_BROADCAST_KEY, DPN_LOCAL_QUEUE, DPN_LOCAL_KEY,
+                           bcast_prefetch=4, local_prefetch=8)
+        Consumer = Mock()
+        csmr.get_consumers(Consumer, Mock())
+        self.assertEqual([4, 8], [
+            kwargs['prefetch_count'] for args, kwargs in
+            Consumer.return_value.qos.call_args_list])
+
+    def test_get_consumers_default_prefetch(self):
+        # a prefetch left unset keeps its default, not the unbounded 0
+        with self.settings(DPN_LOCAL_PREFETCH=32):
+            del settings.DPN_BROADCAST_PREFETCH
+            csmr = DPNConsumer(self.conn, DPN_EXCHANGE, DPN_BROADCAST_QUEUE,
+                               DPN_BROADCAST_KEY, DPN_LOCAL_QUEUE,
+                               DPN_LOCAL_KEY)
+        self.assertEqual([DEFAULT_BROADCAST_PREFETCH, 32], csmr.prefetch)
+
+    def test_concurrent_dispatch(self):
+        router = OrderRecordingRouter()
+        csmr = DPNConsumer(self.conn, DPN_EXCHANGE, DPN_BROADCAST_QUEUE,
+                           DPN_BROADCAST_KEY, DPN_LOCAL_QUEUE, DPN_LOCAL_KEY,
+                           broadcast_rtr=router, local_rtr=router, workers=4)
+        msgs = []
+        for sequence in range(5):
+            for correlation_id in ['first', 'second']:
+                msg = Message(Mock(), '{"message_name": "test"}', headers={
+                    "ttl": dpn_strftime(datetime.now() + timedelta(days=3)),
+                    "from": "test",
+                    "correlation_id": correlation_id,
+                    "sequence": sequence,
+                })
+                msgs.append(msg)
+                csmr.route_local(None, msg)
+
+        csmr.executor.shutdown(wait=True)
+        for correlation_id in ['first', 'second']:
+            self.assertEqual(list(range(5)), [
+                seq for cid, seq in router.handled if cid == correlation_id])
+
+        # acks are only sent from the consumer loop
+        self.assertFalse(any(msg.acknowledged for msg in msgs))
+        csmr.on_iteration()
+        self.assertTrue(all(msg.acknowledged for msg in msgs))
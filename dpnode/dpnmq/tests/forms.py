@@ -8,6 +8,7 @@ import pprint
 import json
 from datetime import datetime
 
+from django.forms import ModelForm
 from django.test import TestCase
 from dpnode.settings import DPN_DEFAULT_XFER_PROTOCOL, DPN_NODE_LIST
 from dpn_registry.models import RegistryEntry, Node
@@ -20,7 +21,8 @@ from dpnmq.forms import RegistryEntryCreatedForm, RegistryDateRangeSyncForm
 from dpnmq.forms import RegistryListDateRangeForm, RegistryEntryCreatedForm
 from dpnmq.forms import RecoveryInitQueryForm, RecoveryAvailableReplyForm
 from dpnmq.forms import RecoveryTransferRequestForm, RecoveryTransferReplyForm
-from dpnmq.forms import RecoveryTransferStatusForm
+from dpnmq.forms import RecoveryTransferStatusForm, validate_data
+from dpnmq.management.commands.dpn_validation_benchmark import BODIES
 from dpnmq.tests import fixtures
 
 
@@ -58,6 +60,47 @@ class TestMsgHeaderForm(TestCase):
         self.assertTrue(frm.is_valid())
 
 
+class CompiledValidationTest(TestMsgHeaderForm):
+    """
+    Tests that validate_data gives the same result as the forms.
+    """
+
+    def _assert_compiled(self, form_class, data, msg):
+        frm = form_class(data.copy())
+        valid = frm.is_valid()
+        cleaned_data, errors = validate_data(form_class, data)
+        self.assertEqual(valid, not errors, msg)
+        self.assertEqual(frm.errors, errors, msg)
+        if valid and not isinstance(frm, ModelForm):
+            # model forms clean related fields to querysets
+            self.assertEqual(frm.cleaned_data, cleaned_data, msg)
+
+    def test_validation(self):
+        for k, v in self.fail_headers.items():
+            tst_data = fixtures.make_headers()
+            for val in v:
+                tst_data[k] = val
+                self._assert_compiled(MsgHeaderForm, tst_data,
+                                      "Value %r of %s" % (val, k))
+            del tst_data[k]
+            self._assert_compiled(MsgHeaderForm, tst_data, "Missing %s" % k)
+        self._assert_compiled(MsgHeaderForm, fixtures.make_headers(),
+                              "Good headers")
+
+    def test_bodies(self):
+        for form_class, good_body in BODIES:
+            name = form_class.__name__
+            self._assert_compiled(form_class, good_body, name)
+            for k in good_body:
+                tst_data = good_body.copy()
+                del tst_data[k]
+                self._assert_compiled(form_class, tst_data,
+                                      "%s missing %s" % (name, k))
+                tst_data[k] = None
+                self._assert_compiled(form_class, tst_data,
+                                      "%s with an empty %s" % (name, k))
+
+
 class DPNBodyFormTest(TestCase):
     def _test_validation(self, form_class, good_body, bad_body,
                          skip_missing=[]):
@@ -7,12 +7,16 @@
 from django.test import TestCase
 from kombu.message import Message
 from kombu.tests.case import Mock
+from mock import patch
 
 from dpnmq import handlers
 from dpnmq.tests import fixtures
 from dpn_registry.models import RegistryEntry, NodeEntry
 from dpnode.exceptions import DPNMessageError, DPNWorkflowError
 from dpnode.exceptions import DPNOutboundError
+from dpn_workflows.models import (
+    Workflow, REPLICATE, INIT_QUERY, SUCCESS
+)
 
 def _msg():
     return Message(Mock(), "{}")
@@ -124,6 +128,25 @@ class ReplicationAvailableReplyHandlerTestCase(BasicHandlerTestCase):
                           handlers.replication_available_reply_handler,
                           msg, fixtures.REP_AVAILABLE_REPLY_ACK)
 
+    @patch("dpnmq.handlers.choose_and_send_location")
+    def test_choose_location_on_ack(self, choose_and_send_location):
+        headers = fixtures.make_headers()
+        Workflow.objects.create(
+            correlation_id=headers['correlation_id'],
+            dpn_object_id="dpn_object_id",
+            node=headers['from'],
+            action=REPLICATE,
+            step=INIT_QUERY,
+            state=SUCCESS
+        )
+        msg = Message(Mock(), fixtures.REP_AVAILABLE_REPLY_ACK.copy(),
+                      headers=headers)
+        handlers.replication_available_reply_handler(
+            msg, fixtures.REP_AVAILABLE_REPLY_ACK)
+
+        choose_and_send_location.apply_async.assert_called_once_with(
+            (headers['correlation_id'],))
+
 class ReplicationLocationCancelHandlerTestCase(BasicHandlerTestCase):
 
     def test_replication_location_cancel_handler(self):
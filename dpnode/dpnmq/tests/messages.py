@@ -2,6 +2,8 @@
     'No one can make you feel inferior without your consent.'
     ― Eleanor Roosevelt
 """
+import json
+
 from django.test import TestCase
 
 from dpnode.settings import DPN_NODE_NAME, DPN_LOCAL_KEY
@@ -80,6 +82,20 @@ class TestDPNMessage(TestCase):
         for k, v in good_args.items():
             self.assertTrue(msg.body[k] == v)
 
+    def test_payload(self):
+        msg = messages.ReplicationLocationReply(fixtures.make_headers(),
+                                                fixtures.REP_LOCATION_REPLY)
+        payload = json.loads(json.dumps(msg.payload()))
+
+        rebuilt = messages.from_payload(payload)
+        self.assertIsInstance(rebuilt, messages.ReplicationLocationReply)
+        self.assertEqual(msg.headers, rebuilt.headers)
+        self.assertEqual(msg.body, rebuilt.body)
+
+        payload['body']['message_name'] = "not-a-message"
+        self.assertRaises(messages.DPNMessageError, messages.from_payload,
+                          payload)
+
 class TestDPNMessageImplementations(TestCase):
     def _test_expected_defaults(self, msg, exp):
         self.assertTrue(msg.body["message_name"], exp["message_name"])
@@ -0,0 +1,56 @@
+"""
+    'Quality is not an act, it is a habit.'
+    ― Aristotle
+"""
+import mock
+
+from django.test import TestCase
+from kombu import Connection, Exchange, Queue
+
+from dpnode.settings import DPN_EXCHANGE
+from dpnmq import publisher
+from dpnmq.messages import ReplicationInitQuery
+from dpnmq.tests import fixtures
+
+# #####################################
+# tests for dpnmq/publisher.py
+
+class TestPublisher(TestCase):
+
+    def setUp(self):
+        publisher.reset()
+
+    def tearDown(self):
+        publisher.reset()
+
+    def test_producer_pool(self):
+        pool = publisher.producer_pool()
+        self.assertIs(pool, publisher.producer_pool(),
+                      "The pool should be reused between messages")
+
+        # a forked process never uses the pool of its parent
+        with mock.patch("os.getpid", return_value=-1):
+            self.assertIsNot(pool, publisher.producer_pool())
+
+        # changing the broker settings creates a new pool
+        with self.settings(DPN_PUBLISH_CONFIRM=True):
+            self.assertIsNot(pool, publisher.producer_pool())
+
+    def test_publish(self):
+        exchange = Exchange(DPN_EXCHANGE, type='direct')
+        queue = Queue('publisher-test', exchange, routing_key='test.dpn')
+        with Connection("memory://") as conn:
+            queue(conn.default_channel).declare()
+
+            msg = ReplicationInitQuery(fixtures.make_headers(),
+                                       fixtures.REP_INIT_QUERY)
+            for _ in range(3):
+                msg.send('test.dpn')
+
+            received = [conn.SimpleQueue(queue).get(timeout=1)
+                        for _ in range(3)]
+
+        for message in received:
+            self.assertEqual(msg.body, message.payload)
+            self.assertEqual(msg.headers['correlation_id'],
+                             message.headers['correlation_id'])
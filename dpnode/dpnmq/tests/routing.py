@@ -0,0 +1,74 @@
+from django.test import TestCase
+from mock import patch
+
+from dpnode.celery import (
+    app, TASK_QUEUES, CONTROL_QUEUE, TRANSFER_QUEUE, FIXITY_QUEUE,
+    DEFAULT_QUEUE
+)
+from dpnmq.management.commands.dpn_queue_check import (
+    check_routes, check_workers
+)
+from dpnmq.management.commands.dpn_worker import worker_argv
+
+
+class TaskRoutingTestCase(TestCase):
+
+    def _queue(self, task):
+        return app.amqp.router.route({}, task)['queue'].name
+
+    def test_routes(self):
+        for queue, tasks in TASK_QUEUES.items():
+            for task in tasks:
+                self.assertIn(task, app.tasks)
+                self.assertEqual(queue, self._queue(task))
+        self.assertEqual([], check_routes())
+
+    @patch.dict(TASK_QUEUES)
+    def test_unrouted_task(self):
+        TASK_QUEUES[DEFAULT_QUEUE] = [
+            task for task in TASK_QUEUES[DEFAULT_QUEUE]
+            if not task.endswith('.cleanup_sequences')]
+        self.assertEqual(
+            ["dpn_workflows.tasks.outbound.cleanup_sequences has no route"],
+            check_routes())
+
+    def test_control_tasks(self):
+        for task in ['respond_to_replication_query',
+                     'choose_and_send_location',
+                     'respond_to_recovery_query']:
+            self.assertEqual(CONTROL_QUEUE, self._queue(
+                'dpn_workflows.tasks.outbound.%s' % task))
+        self.assertEqual(TRANSFER_QUEUE, self._queue(
+            'dpn_workflows.tasks.inbound.transfer_content'))
+        self.assertEqual(FIXITY_QUEUE, self._queue(
+            'dpn_workflows.tasks.outbound.verify_fixity_and_reply'))
+        self.assertEqual(DEFAULT_QUEUE, self._queue(
+            'dpn_workflows.tasks.registry.solve_registry_conflicts'))
+
+    def test_check_workers(self):
+        separate = {
+            'control@dpn': [CONTROL_QUEUE],
+            'transfer@dpn': [TRANSFER_QUEUE],
+            'fixity@dpn': [FIXITY_QUEUE, DEFAULT_QUEUE],
+        }
+        self.assertEqual([], check_workers(separate))
+
+        shared = {'celery@dpn': [DEFAULT_QUEUE, CONTROL_QUEUE,
+                                 TRANSFER_QUEUE, FIXITY_QUEUE]}
+        self.assertEqual(
+            ["celery@dpn consumes dpn.control together with celery, "
+             "dpn.fixity, dpn.transfer"], check_workers(shared))
+
+        self.assertEqual(["No worker consumes dpn.control",
+                          "No worker consumes dpn.fixity",
+                          "No worker consumes celery"],
+                         check_workers({'transfer@dpn': [TRANSFER_QUEUE]}))
+
+    def test_worker_argv(self):
+        with self.settings(DPN_WORKERS={FIXITY_QUEUE: {
+                'pool': 'solo', 'concurrency': 1}}):
+            self.assertEqual(
+                ['worker', '--queues', FIXITY_QUEUE, '--pool', 'solo',
+                 '--concurrency', '1', '--hostname', 'dpn.fixity@%h',
+                 '--loglevel', 'INFO'], worker_argv(FIXITY_QUEUE))
+        self.assertEqual(['-O', 'fair'], worker_argv(TRANSFER_QUEUE)[-2:])
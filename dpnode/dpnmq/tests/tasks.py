@@ -0,0 +1,171 @@
+"""
+    'It is not enough to be busy. So are the ants.'
+    ― Henry David Thoreau
+"""
+import mock
+from datetime import datetime, timedelta
+
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from dpnmq import publisher
+from dpnmq.messages import ReplicationInitQuery
+from dpnmq.models import OutboxMessage, PENDING, SENT, EXPIRED
+from dpnmq.tasks import flush_outbox, outbox_transaction, purge_outbox
+from dpnmq.tests import fixtures
+from dpnmq.utils import dpn_strftime
+
+# #####################################
+# tests for dpnmq/tasks.py
+
+class TestOutbox(TestCase):
+
+    def setUp(self):
+        publisher.reset()
+
+    def tearDown(self):
+        publisher.reset()
+
+    def _queue(self, **headers):
+        msg = ReplicationInitQuery(dict(fixtures.make_headers(), **headers),
+                                   fixtures.REP_INIT_QUERY.copy())
+        return msg.queue("broadcast")
+
+    def test_queue_and_flush(self):
+        with outbox_transaction():
+            self._queue()
+            self._queue()
+        self.assertEqual(2, OutboxMessage.objects.filter(
+            state=PENDING).count())
+
+        with mock.patch("dpnmq.publisher.publish") as publish:
+            stats = flush_outbox()
+        self.assertEqual(2, stats['sent'])
+        self.assertEqual(2, publish.call_count)
+        self.assertEqual(2, OutboxMessage.objects.filter(state=SENT).count())
+
+    def test_rolled_back_messages(self):
+        try:
+            with outbox_transaction():
+                self._queue()
+                raise ValueError("workflow not saved")
+        except ValueError:
+            pass
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    def test_flush_backoff(self):
+        msg = self._queue()
+        with mock.patch("dpnmq.publisher.publish",
+                        side_effect=OSError("broker down")):
+            stats = flush_outbox()
+
+        self.assertEqual(1, stats['failed'])
+        msg = OutboxMessage.objects.get(pk=msg.pk)
+        self.assertEqual(PENDING, msg.state)
+        self.assertEqual(1, msg.attempts)
+        self.assertEqual("broker down", msg.last_error)
+        self.assertGreater(msg.next_attempt, timezone.now())
+
+        # the message is not sent again before its next attempt
+        with mock.patch("dpnmq.publisher.publish") as publish:
+            self.assertEqual(0, flush_outbox()['sent'])
+            OutboxMessage.objects.update(next_attempt=timezone.now())
+            self.assertEqual(1, flush_outbox()['sent'])
+        self.assertEqual(1, publish.call_count)
+
+    def test_flush_keeps_order_after_failure(self):
+        first = self._queue()
+        with mock.patch("dpnmq.publisher.publish",
+                        side_effect=OSError("broker down")):
+            flush_outbox()
+
+        # the next step of the transaction is queued while the first one
+        # is backing off, other routing keys are not held
+        second = self._queue(sequence=1)
+        other = ReplicationInitQuery(fixtures.make_headers(),
+                                     fixtures.REP_INIT_QUERY.copy()
+                                     ).queue("tdr.reply")
+        with mock.patch("dpnmq.publisher.publish") as publish:
+            self.assertEqual(1, flush_outbox()['sent'])
+            self.assertEqual(SENT, OutboxMessage.objects.get(
+                pk=other.pk).state)
+
+            OutboxMessage.objects.filter(pk=first.pk).update(
+                next_attempt=timezone.now())
+            self.assertEqual(2, flush_outbox()['sent'])
+        sent = [call[0][3] for call in publish.call_args_list]
+        self.assertEqual(["tdr.reply", "broadcast", "broadcast"], sent)
+        self.assertEqual(SENT, OutboxMessage.objects.get(pk=second.pk).state)
+
+    def test_flush_dates_messages(self):
+        msg = self._queue(date="2015-01-01T00:00:00Z")
+        with mock.patch("dpnmq.publisher.publish") as publish:
+            flush_outbox()
+        headers = publish.call_args[0][1]
+        self.assertNotEqual("2015-01-01T00:00:00Z", headers['date'])
+        self.assertEqual(msg.get_headers()['correlation_id'],
+                         headers['correlation_id'])
+
+    def test_flush_expired(self):
+        msg = self._queue(ttl=dpn_strftime(datetime.now() - timedelta(1)))
+        with mock.patch("dpnmq.publisher.publish") as publish:
+            stats = flush_outbox()
+        self.assertEqual(1, stats['expired'])
+        self.assertFalse(publish.called)
+        self.assertEqual(EXPIRED, OutboxMessage.objects.get(pk=msg.pk).state)
+
+    def test_flush_in_batches(self):
+        for _ in range(3):
+            self._queue()
+        with mock.patch("dpnmq.publisher.publish") as publish:
+            stats = flush_outbox(batch_size=2)
+
+        # a full batch queues the next flush
+        self.assertEqual(2, stats['sent'])
+        self.assertEqual(3, publish.call_count)
+        self.assertFalse(OutboxMessage.objects.filter(
+            state=PENDING).exists())
+
+    def test_purge_outbox(self):
+        sent, expired, pending = [self._queue() for _ in range(3)]
+        long_ago = timezone.now() - timedelta(days=30)
+        OutboxMessage.objects.filter(pk=sent.pk).update(
+            state=SENT, sent_at=long_ago)
+        OutboxMessage.objects.filter(pk=expired.pk).update(
+            state=EXPIRED, created_at=long_ago)
+        OutboxMessage.objects.filter(pk=pending.pk).update(
+            created_at=long_ago)
+        recent = self._queue()
+        OutboxMessage.objects.filter(pk=recent.pk).update(
+            state=SENT, sent_at=timezone.now())
+
+        with self.settings(DPN_OUTBOX_KEEP=24 * 60 * 60):
+            self.assertEqual(2, purge_outbox())
+        self.assertEqual([pending.pk, recent.pk], sorted(
+            OutboxMessage.objects.values_list('pk', flat=True)))
+
+
+class TestOutboxCommit(TransactionTestCase):
+
+    def _queue(self):
+        msg = ReplicationInitQuery(fixtures.make_headers(),
+                                   fixtures.REP_INIT_QUERY.copy())
+        return msg.queue("broadcast")
+
+    @mock.patch.object(flush_outbox, 'apply_async')
+    def test_flush_after_commit(self, flush):
+        with outbox_transaction():
+            self._queue()
+            with outbox_transaction():
+                self._queue()
+            # the outer transaction did not commit yet
+            self.assertFalse(flush.called)
+        flush.assert_called_once_with()
+
+    @mock.patch.object(flush_outbox, 'apply_async')
+    def test_no_flush_inside_transaction(self, flush):
+        with transaction.atomic():
+            with outbox_transaction():
+                self._queue()
+        self.assertFalse(flush.called)
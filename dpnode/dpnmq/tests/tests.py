@@ -10,3 +10,7 @@ from .forms import *
 from .messages import *
 from .utils import *
 from .handlers import *
+from .publisher import *
+from .tasks import *
+from .watcher import *
+from .routing import *
@@ -25,6 +25,10 @@ class TestDPNUtils(TestCase):
     def test_dpn_strptime(self):
         self.failUnlessEqual(self.datetime, dpn_strptime(self.timestring))
 
+    def test_dpn_strptime_invalid(self):
+        for bad in ["2014-13-01T01:00:00Z", "2014-01-01 01:00:00", ""]:
+            self.assertRaises(ValueError, dpn_strptime, bad)
+
     def test_expire_on(self):
         exp = datetime(2014, 1, 1, 1, 0, 10)
         self.failUnlessEqual(exp, expire_on(self.datetime, 10))
@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+from mock import patch
+from watchdog.events import FileMovedEvent
+
+from dpnmq.management.commands.dpn_bag_watcher import (
+    BagTracker, DPNFileEventHandler, scan_ingest_dir, ingest
+)
+from dpn_registry.models import RegistryEntry
+
+
+class BagTrackerTestCase(TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.directory = tempfile.mkdtemp()
+        self.tracker = BagTracker(10, clock=lambda: self.now)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _bag(self, name, data=b"bag"):
+        path = os.path.join(self.directory, name)
+        with open(path, 'ab') as bag:
+            bag.write(data)
+        return path
+
+    def test_stable_bags(self):
+        growing = self._bag("growing.tar")
+        done = self._bag("done.tar")
+        for path in [growing, done]:
+            self.tracker.track(path)
+
+        self.assertEqual([], self.tracker.poll())
+        self.now = 5
+        self._bag("growing.tar", b"more data")
+        self.assertEqual([], self.tracker.poll())
+
+        # many bags settle from the same poll
+        self.now = 10
+        self.assertEqual([(done, 3)], self.tracker.poll())
+        self.assertEqual(1, len(self.tracker))
+        self.now = 15
+        self.assertEqual([(growing, 12)], self.tracker.poll())
+        self.assertEqual(0, len(self.tracker))
+
+    def test_removed_bag(self):
+        path = self._bag("removed.tar")
+        self.tracker.track(path)
+        os.remove(path)
+
+        self.assertEqual([], self.tracker.poll())
+        self.assertEqual(0, len(self.tracker))
+
+    def test_moved_bags(self):
+        handler = DPNFileEventHandler(self.tracker, patterns=['*.tar'])
+        bag = os.path.join(self.directory, "bag.tar")
+        for src, dest in [("/tmp/upload.part", bag),
+                          (bag, bag + ".done")]:
+            handler.dispatch(FileMovedEvent(src, dest))
+
+        # only the bag moved in is tracked, not the one renamed away
+        self.assertEqual(1, len(self.tracker))
+        self._bag("bag.tar")
+        self.tracker.poll()
+        self.now = 10
+        self.assertEqual([bag], [path for path, size in self.tracker.poll()])
+
+    def test_scan_ingest_dir(self):
+        self._bag("new-bag.tar")
+        self._bag("notes.txt")
+        self._bag("old-bag.tar")
+        RegistryEntry.objects.create(
+            dpn_object_id="old-bag",
+            first_node_name="aptrust",
+            version_number=1,
+            fixity_algorithm="sha256",
+            fixity_value="0" * 64,
+            last_fixity_date="2014-01-01T00:00:00Z",
+            creation_date="2014-01-01T00:00:00Z",
+            last_modified_date="2014-01-01T00:00:00Z",
+            bag_size=3,
+        )
+
+        found = scan_ingest_dir(self.tracker, self.directory)
+
+        self.assertEqual(1, found)
+        self.tracker.poll()
+        self.now = 10
+        self.assertEqual([os.path.join(self.directory, "new-bag.tar")],
+                         [path for path, size in self.tracker.poll()])
+
+    @patch("dpnmq.management.commands.dpn_bag_watcher.ingest_bag")
+    def test_ingest(self, ingest_bag):
+        path = os.path.join(self.directory, "new-bag.tar")
+        ingest(path, 1024)
+        ingest_bag.apply_async.assert_called_once_with(("new-bag", path))
@@ -3,6 +3,7 @@ import os
 from django.conf import settings
 
 from celery import Celery
+from kombu import Queue
 
 
 # set the default Django settings module for the 'celery' program.
@@ -18,4 +19,60 @@ app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 # using django-celery just for result backend
 app.conf.update(
     CELERY_RESULT_BACKEND='redis://localhost:6379/0',
-)
\ No newline at end of file
+    # tasks get primary keys and message payloads, never pickled objects
+    CELERY_TASK_SERIALIZER='json',
+    CELERY_RESULT_SERIALIZER='json',
+    CELERY_ACCEPT_CONTENT=['json'],
+)
+
+# Tasks are split in queues so the replies with a short TTL never wait for a
+# worker busy for hours with a transfer or a fixity, each queue is consumed
+# by its own worker, see the dpn_worker command.
+CONTROL_QUEUE = 'dpn.control'    # message replies and node selection
+TRANSFER_QUEUE = 'dpn.transfer'  # downloads and copies of bags
+FIXITY_QUEUE = 'dpn.fixity'      # hashing of whole bags
+DEFAULT_QUEUE = 'celery'         # registry syncs and housekeeping
+
+TASK_QUEUES = {
+    CONTROL_QUEUE: [
+        'dpnmq.tasks.flush_outbox',
+        'dpn_workflows.tasks.outbound.initiate_ingest',
+        'dpn_workflows.tasks.outbound.respond_to_replication_query',
+        'dpn_workflows.tasks.outbound.choose_and_send_location',
+        'dpn_workflows.tasks.outbound.send_transfer_status',
+        'dpn_workflows.tasks.outbound.broadcast_item_creation',
+        'dpn_workflows.tasks.outbound.respond_to_recovery_query',
+        'dpn_workflows.tasks.outbound.choose_node_and_recover',
+        'dpn_workflows.tasks.inbound.delete_until_transferred',
+        'dpn_workflows.tasks.ingest.admit_ingests',
+    ],
+    TRANSFER_QUEUE: [
+        'dpn_workflows.tasks.inbound.transfer_content',
+        'dpn_workflows.tasks.inbound.recover_and_check_integrity',
+        'dpn_workflows.tasks.outbound.respond_to_recovery_transfer',
+    ],
+    FIXITY_QUEUE: [
+        'dpn_workflows.tasks.ingest.ingest_bag',
+        'dpn_workflows.tasks.outbound.verify_fixity_and_reply',
+        'dpn_workflows.tasks.registry.create_registry_entry',
+    ],
+    DEFAULT_QUEUE: [
+        'dpn_workflows.tasks.registry.reply_with_item_list',
+        'dpn_workflows.tasks.registry.save_registries_from',
+        'dpn_workflows.tasks.registry.solve_registry_conflicts',
+        'dpn_workflows.tasks.registry.reconcile_registry_stats',
+        'dpn_workflows.tasks.outbound.cleanup_sequences',
+        'dpnmq.tasks.purge_outbox',
+    ],
+}
+
+app.conf.update(
+    CELERY_DEFAULT_QUEUE=DEFAULT_QUEUE,
+    CELERY_QUEUES=[Queue(name, routing_key=name) for name in
+                   (DEFAULT_QUEUE, CONTROL_QUEUE, TRANSFER_QUEUE,
+                    FIXITY_QUEUE)],
+    CELERY_ROUTES=dict(
+        (task, {'queue': queue, 'routing_key': queue})
+        for queue, tasks in TASK_QUEUES.items() for task in tasks
+    ),
+)